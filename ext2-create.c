@@ -1,10 +1,13 @@
 #include <assert.h>
 #include <errno.h>
 #include <fcntl.h>
+#include <getopt.h>
+#include <inttypes.h>
 #include <stdint.h>
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <sys/resource.h>
 #include <sys/stat.h>
 #include <time.h>
 #include <unistd.h>
@@ -12,11 +15,13 @@
 typedef uint8_t u8;
 typedef uint16_t u16;
 typedef uint32_t u32;
+typedef uint64_t u64;
 typedef int16_t i16;
 typedef int32_t i32;
 
-#define BLOCK_SIZE 1024
-#define BLOCK_OFFSET(i) (i * BLOCK_SIZE)
+/* The block size is set with -b; buffers are sized for the largest */
+#define MAX_BLOCK_SIZE 4096
+#define BLOCK_OFFSET(i) ((off_t) (i) * block_size)
 #define NUM_BLOCKS 1024
 #define NUM_INODES 128
 
@@ -25,18 +30,49 @@ typedef int32_t i32;
 #define HELLO_INO          13
 #define LAST_INO           HELLO_INO
 
-#define SUPERBLOCK_BLOCKNO             1
-#define BLOCK_GROUP_DESCRIPTOR_BLOCKNO 2
-#define BLOCK_BITMAP_BLOCKNO           3
-#define INODE_BITMAP_BLOCKNO           4
-#define INODE_TABLE_BLOCKNO            5
-#define ROOT_DIR_BLOCKNO               21
-#define LOST_AND_FOUND_DIR_BLOCKNO     22
-#define HELLO_WORLD_FILE_BLOCKNO       23
+/* The superblock always starts 1024 bytes in, which is block 1 with 1 KiB
+   blocks and part of block 0 with larger ones. The first group starts with
+   the block holding it, so with 1 KiB blocks these are blocks 1, 2, 3, 4,
+   5 to 20, then 21 to 24. */
+#define SUPERBLOCK_OFFSET              1024
+#define SUPERBLOCK_BLOCKNO             first_data_block
+#define BLOCK_GROUP_DESCRIPTOR_BLOCKNO (first_data_block + 1)
+#define BLOCK_BITMAP_BLOCKNO           (first_data_block + 2)
+#define INODE_BITMAP_BLOCKNO           (first_data_block + 3)
+#define INODE_TABLE_BLOCKNO            (first_data_block + 4)
+#define INODE_TABLE_BLOCKS             (NUM_INODES * inode_size / block_size)
+#define ROOT_DIR_BLOCKNO               (INODE_TABLE_BLOCKNO + INODE_TABLE_BLOCKS)
+#define LOST_AND_FOUND_DIR_BLOCKNO     (ROOT_DIR_BLOCKNO + 1)
+#define HELLO_WORLD_FILE_BLOCKNO       (ROOT_DIR_BLOCKNO + 2)
 #define LAST_BLOCK                     HELLO_WORLD_FILE_BLOCKNO
+#define ROOT_DIR_LEAF_BLOCKNO          (ROOT_DIR_BLOCKNO + 3) /* Only used with -i */
+
+/* With -n the root also holds a directory, big, whose entries are all
+   hard links to one empty file. Its blocks follow the root's leaf block. */
+#define BIG_DIR_INO     14
+#define BIG_FILE_INO    15
+#define BIG_DIR_BLOCKNO (ROOT_DIR_LEAF_BLOCKNO + 1)
 
 #define NUM_FREE_BLOCKS (NUM_BLOCKS - LAST_BLOCK - 1)
-#define NUM_FREE_INODES (NUM_INODES - LAST_INO)
+#define NUM_FREE_INODES (NUM_INODES - LAST_INO - (big_entries ? 2 : 0))
+
+/* With -g the image has several groups, each as large as one bitmap block
+   can describe. Every group after the first starts with backups of the
+   superblock and descriptor table, then its bitmaps and inode table, then a
+   directory holding one file. */
+#define GROUP_BLOCKS             (block_size * 8)
+#define GROUP_BLOCK_BITMAP       2
+#define GROUP_INODE_BITMAP       3
+#define GROUP_INODE_TABLE        4
+#define GROUP_DIR_BLOCK          (GROUP_INODE_TABLE + INODE_TABLE_BLOCKS)
+#define GROUP_FILE_BLOCK         (GROUP_DIR_BLOCK + 1)
+#define GROUP_FILE_BLOCKS        EXT2_NDIR_BLOCKS
+#define GROUP_USED_BLOCKS        (GROUP_FILE_BLOCK + GROUP_FILE_BLOCKS)
+#define GROUP_DIR_INO(group)     ((group) * NUM_INODES + 1)
+#define GROUP_FILE_INO(group)    ((group) * NUM_INODES + 2)
+
+/* The descriptor table is kept to one block */
+#define MAX_GROUPS (MAX_BLOCK_SIZE / sizeof(struct ext2_block_group_descriptor))
 
 #define EXT2_SUPER_MAGIC 0xEF53
 
@@ -48,6 +84,19 @@ typedef int32_t i32;
 #define EXT2_GOOD_OLD_FIRST_INO 11
 
 #define EXT2_GOOD_OLD_REV 0
+#define EXT2_DYNAMIC_REV  1
+
+#define EXT2_GOOD_OLD_INODE_SIZE 128
+
+#define EXT2_FEATURE_COMPAT_DIR_INDEX       0x0020
+#define EXT2_FEATURE_INCOMPAT_FILETYPE      0x0002
+#define EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER 0x0001
+
+#define EXT2_FLAGS_UNSIGNED_HASH 0x0002
+
+#define EXT2_INDEX_FL 0x00001000
+
+#define EXT2_HASH_HALF_MD4 1
 
 #define EXT2_S_IFSOCK 0xC000
 #define EXT2_S_IFLNK  0xA000
@@ -77,6 +126,14 @@ typedef int32_t i32;
 
 #define EXT2_NAME_LEN 255
 
+#define EXT2_LINK_MAX 32000
+
+#define EXT2_FT_REG_FILE 1
+#define EXT2_FT_DIR      2
+#define EXT2_FT_SYMLINK  7
+
+#define DIR_REC_LEN(name_len) (8 + (((name_len) + 3) & ~3))
+
 struct ext2_superblock {
 	u32 s_inodes_count;
 	u32 s_blocks_count;
@@ -103,12 +160,44 @@ struct ext2_superblock {
 	u32 s_rev_level;
 	u16 s_def_resuid;
 	u16 s_def_resgid;
-	u32 s_pad[5];
+	/* EXT2_DYNAMIC_REV only */
+	u32 s_first_ino;
+	u16 s_inode_size;
+	u16 s_block_group_nr;
+	u32 s_feature_compat;
+	u32 s_feature_incompat;
+	u32 s_feature_ro_compat;
 	u8 s_uuid[16];
 	u8 s_volume_name[16];
-	u32 s_reserved[229];
+	u8 s_last_mounted[64];
+	u32 s_algo_bitmap;
+	u8 s_prealloc_blocks;
+	u8 s_prealloc_dir_blocks;
+	u16 s_padding1;
+	u8 s_journal_uuid[16];
+	u32 s_journal_inum;
+	u32 s_journal_dev;
+	u32 s_last_orphan;
+	u32 s_hash_seed[4];
+	u8 s_def_hash_version;
+	u8 s_reserved_char_pad;
+	u16 s_reserved_word_pad;
+	u32 s_default_mount_opts;
+	u32 s_first_meta_bg;
+	u32 s_mkfs_time;
+	u32 s_jnl_blocks[17];
+	u32 s_blocks_count_hi;
+	u32 s_r_blocks_count_hi;
+	u32 s_free_blocks_count_hi;
+	u16 s_min_extra_isize;
+	u16 s_want_extra_isize;
+	u32 s_flags;
+	u32 s_reserved[167];
 };
 
+_Static_assert(sizeof(struct ext2_superblock) == 1024,
+               "superblock must be 1024 bytes");
+
 struct ext2_block_group_descriptor
 {
 	u32 bg_block_bitmap;
@@ -145,22 +234,100 @@ struct ext2_inode {
 	u32 i_reserved2[2];
 };
 
+/* Revision 0 reads name_len and file_type together as a u16 name length,
+   so file_type is left 0 unless the filetype feature is on */
 struct ext2_dir_entry {
 	u32 inode;
 	u16 rec_len;
-	u16 name_len;
+	u8  name_len;
+	u8  file_type;
 	u8  name[EXT2_NAME_LEN];
 };
 
+/* Hashed b-tree directory index (dir_index), see
+   https://www.kernel.org/doc/html/latest/filesystems/ext4/directory.html */
+struct dx_root_info {
+	u32 reserved_zero;
+	u8  hash_version;
+	u8  info_length;
+	u8  indirect_levels;
+	u8  unused_flags;
+};
+
+struct dx_countlimit {
+	u16 limit;
+	u16 count;
+};
+
+struct dx_entry {
+	u32 hash;
+	u32 block;
+};
+
+#define DX_ROOT_LIMIT ((block_size - 32) / sizeof(struct dx_entry))
+#define DX_NODE_LIMIT ((block_size - 8) / sizeof(struct dx_entry))
+
+struct dir_index_entry {
+	u32 inode;
+	const char *name;
+	u8 file_type;
+	u32 hash;
+	u32 minor_hash;
+};
+
+/* Replaced by one derived from --seed, see set_uuid_from_seed */
+static u8 fs_uuid[16] = {
+	0x5A, 0x1E, 0xAB, 0x1E, 0x13, 0x37, 0x13, 0x37,
+	0x13, 0x37, 0xC0, 0xFF, 0xEE, 0xC0, 0xFF, 0xEE,
+};
+
+/* Stamped into the superblock and every inode, read once so that all of
+   them agree, see get_build_time */
+static u32 build_time;
+
+static int dir_index = 0;
+
+/* Set from -b before anything is written */
+static u32 block_size = 1024;
+static u32 first_data_block = 1;
+
+/* -r writes a revision 1 image with the filetype and sparse_super
+   features, and -I (which implies -r) sets its inode size */
+static int dynamic_rev = 0;
+static u32 inode_size = EXT2_GOOD_OLD_INODE_SIZE;
+
+/* The entries of big, hashed and sorted once the options are known, and
+   the blocks it takes: its directory blocks, then its indirect block if
+   it needs one */
+static u32 big_entries = 0;
+static char (*big_names)[16];
+static struct dir_index_entry *big_index;
+static u32 big_leaves = 0;
+static u32 big_dir_blocks = 0;
+static u32 big_blocks = 0;
+
+/* Free counts of each group, folded into the superblock and descriptor
+   table once every group has been written */
+struct group_summary {
+	u16 free_blocks_count;
+	u16 free_inodes_count;
+	u16 used_dirs_count;
+};
+
+static u32 num_groups = 1;
+static struct group_summary group_summaries[MAX_GROUPS];
+static char group_dir_names[MAX_GROUPS][20];
+
 #define errno_exit(str)                                                        \
 	do { int err = errno; perror(str); exit(err); } while (0)
 
-#define dir_entry_set(entry, inode_num, str)                                   \
+#define dir_entry_set(entry, inode_num, str, type)                             \
 	do {                                                                   \
 		char *s = str;                                                 \
 		size_t len = strlen(s);                                        \
 		entry.inode = inode_num;                                       \
 		entry.name_len = len;                                          \
+		entry.file_type = dir_file_type(type);                         \
 		memcpy(&entry.name, s, len);                                   \
 		if ((len % 4) != 0) {                                          \
 			entry.rec_len = 12 + len / 4 * 4;                      \
@@ -170,14 +337,118 @@ struct ext2_dir_entry {
 		}                                                              \
 	} while (0)
 
+/* The last entry of a block stretches past the struct to the end of the
+   block, so the entry is copied into a zeroed block first */
 #define dir_entry_write(entry, fd)                                             \
 	do {                                                                   \
+		u8 padded[MAX_BLOCK_SIZE] = {0};                               \
 		size_t size = entry.rec_len;                                   \
-		if (write(fd, &entry, size) != size) {                         \
+		memcpy(padded, &entry, DIR_REC_LEN(entry.name_len));           \
+		if (counted_write(fd, padded, size) != size) {                 \
 			errno_exit("write");                                   \
 		}                                                              \
 	} while (0)
 
+/* Counts of the calls that write the image, for --stats */
+struct io_counter {
+	unsigned long long calls;
+	unsigned long long bytes;
+};
+
+static unsigned long long lseek_calls;
+static struct io_counter write_calls;
+static struct io_counter pwrite_calls;
+
+off_t counted_lseek(int fd, off_t offset, int whence) {
+	lseek_calls++;
+	return lseek(fd, offset, whence);
+}
+
+ssize_t counted_write(int fd, const void *buf, size_t count) {
+	ssize_t n = write(fd, buf, count);
+	write_calls.calls++;
+	if (n > 0) {
+		write_calls.bytes += n;
+	}
+	return n;
+}
+
+ssize_t counted_pwrite(int fd, const void *buf, size_t count, off_t offset) {
+	ssize_t n = pwrite(fd, buf, count, offset);
+	pwrite_calls.calls++;
+	if (n > 0) {
+		pwrite_calls.bytes += n;
+	}
+	return n;
+}
+
+/* Monotonic time spent in each phase of main() */
+struct phase_time {
+	const char *name;
+	u64 ns;
+};
+
+#define MAX_PHASES 16
+
+static struct phase_time phase_times[MAX_PHASES];
+static int num_phases = 0;
+static int print_stats = 0;
+
+u64 monotonic_ns() {
+	struct timespec ts;
+	if (clock_gettime(CLOCK_MONOTONIC, &ts)) {
+		errno_exit("clock_gettime");
+	}
+	return (u64) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
+#define timed_phase(phase, call)                                               \
+	do {                                                                   \
+		u64 start = monotonic_ns();                                    \
+		call;                                                          \
+		assert(num_phases < MAX_PHASES);                               \
+		phase_times[num_phases].name = phase;                          \
+		phase_times[num_phases].ns = monotonic_ns() - start;           \
+		num_phases++;                                                  \
+	} while (0)
+
+void print_io_counter(const char *name, struct io_counter *counter,
+                      int last) {
+	printf("    \"%s\": {\"calls\": %llu, \"bytes\": %llu}%s\n", name,
+	       counter->calls, counter->bytes,
+	       last ? "" : ",");
+}
+
+void write_stats(u64 total_ns) {
+	struct rusage usage;
+	if (getrusage(RUSAGE_SELF, &usage)) {
+		errno_exit("getrusage");
+	}
+#ifdef __APPLE__
+	long peak_rss_kb = usage.ru_maxrss / 1024; /* Bytes on macOS */
+#else
+	long peak_rss_kb = usage.ru_maxrss;
+#endif
+
+	printf("{\n");
+	printf("  \"groups\": %" PRIu32 ",\n", num_groups);
+	printf("  \"block_size\": %" PRIu32 ",\n", block_size);
+	printf("  \"phases_ns\": {\n");
+	for (int i = 0; i < num_phases; i++) {
+		printf("    \"%s\": %" PRIu64 "%s\n", phase_times[i].name,
+		       phase_times[i].ns, i + 1 < num_phases ? "," : "");
+	}
+	printf("  },\n");
+	printf("  \"total_ns\": %" PRIu64 ",\n", total_ns);
+	printf("  \"syscalls\": {\n");
+	printf("    \"lseek\": {\"calls\": %llu},\n", lseek_calls);
+	print_io_counter("write", &write_calls, 0);
+	print_io_counter("pwrite", &pwrite_calls, 1);
+	printf("  },\n");
+	printf("  \"peak_rss_kb\": %ld\n", peak_rss_kb);
+	printf("}\n");
+}
+
 u32 get_current_time() {
 	time_t t = time(NULL);
 	if (t == ((time_t) -1)) {
@@ -186,38 +457,411 @@ u32 get_current_time() {
 	return t;
 }
 
-void write_superblock(int fd) {
-	off_t off = lseek(fd, BLOCK_OFFSET(1), SEEK_SET);
+/* SOURCE_DATE_EPOCH when it is set, see
+   https://reproducible-builds.org/specs/source-date-epoch/ */
+u32 get_build_time() {
+	const char *epoch = getenv("SOURCE_DATE_EPOCH");
+	if (epoch == NULL) {
+		return get_current_time();
+	}
+	char *end;
+	errno = 0;
+	unsigned long long t = strtoull(epoch, &end, 10);
+	if (*epoch == '\0' || *end != '\0' || errno || t > UINT32_MAX) {
+		fprintf(stderr, "SOURCE_DATE_EPOCH must be a time between 0 and "
+		        "%" PRIu32 "\n", UINT32_MAX);
+		exit(EXIT_FAILURE);
+	}
+	return t;
+}
+
+static u64 splitmix64(u64 *state) {
+	u64 z = (*state += 0x9E3779B97F4A7C15ULL);
+	z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+	z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+	return z ^ (z >> 31);
+}
+
+/* A random-looking version 4 UUID that depends only on the seed */
+void set_uuid_from_seed(u64 seed) {
+	u64 state = seed;
+	for (int i = 0; i < 16; i += 8) {
+		u64 word = splitmix64(&state);
+		memcpy(fs_uuid + i, &word, 8);
+	}
+	fs_uuid[6] = (fs_uuid[6] & 0x0F) | 0x40;
+	fs_uuid[8] = (fs_uuid[8] & 0x3F) | 0x80;
+}
+
+/* The file type stored in a directory entry, which stays 0 without the
+   filetype feature */
+u8 dir_file_type(u8 type) {
+	return dynamic_rev ? type : 0;
+}
+
+u32 num_free_blocks() {
+	/* An indexed root directory needs a leaf block next to its dx_root */
+	return NUM_FREE_BLOCKS - (dir_index ? 1 : 0) - big_blocks;
+}
+
+u32 blocks_per_group() {
+	return num_groups > 1 ? GROUP_BLOCKS : NUM_BLOCKS;
+}
+
+u32 num_blocks() {
+	return num_groups > 1 ? first_data_block + num_groups * GROUP_BLOCKS
+	                      : NUM_BLOCKS;
+}
+
+u32 group_first_block(u32 group) {
+	return first_data_block + group * blocks_per_group();
+}
+
+/* Whether a group starts with copies of the superblock and descriptor
+   table: every group, or with sparse_super only groups 0, 1 and powers of
+   3, 5 and 7 */
+int group_has_super(u32 group) {
+	if (group <= 1 || !dynamic_rev) {
+		return 1;
+	}
+	for (u32 base = 3; base <= 7; base += 2) {
+		u32 n = base;
+		while (n < group) {
+			n *= base;
+		}
+		if (n == group) {
+			return 1;
+		}
+	}
+	return 0;
+}
+
+/* The single group revision 0 image with 1 KiB blocks keeps the layout it
+   always had: block 24 marked used, and no padding bits set. An indexed
+   root makes the image revision 1, so -i images get their padding. */
+int legacy_layout() {
+	return num_groups == 1 && block_size == 1024 && !dynamic_rev
+	       && !dir_index;
+}
+
+/* Blocks marked used at the start of the first group */
+u32 first_group_used_blocks() {
+	if (legacy_layout()) {
+		return ROOT_DIR_LEAF_BLOCKNO - first_data_block + 1 + big_blocks;
+	}
+	return LAST_BLOCK - first_data_block + 1 + (dir_index ? 1 : 0)
+	       + big_blocks;
+}
+
+/* Sets the bits of a bitmap block from the first bit past the end of what
+   it describes, as e2fsck expects */
+void set_bitmap_padding(u8 *bitmap, u32 first_bit) {
+	for (u32 i = first_bit; i < block_size * 8; i++) {
+		bitmap[i / 8] |= 1 << (i % 8);
+	}
+}
+
+void pwrite_all(int fd, const void *buf, size_t size, off_t off) {
+	if (counted_pwrite(fd, buf, size, off) != (ssize_t) size) {
+		errno_exit("pwrite");
+	}
+}
+
+/* The superblock is 1024 bytes whatever the block size */
+void write_superblock_copy(int fd, off_t offset,
+                           const struct ext2_superblock *superblock) {
+	if (counted_lseek(fd, offset, SEEK_SET) == -1) {
+		errno_exit("lseek");
+	}
+	ssize_t size = sizeof(*superblock);
+	if (counted_write(fd, superblock, size) != size) {
+		errno_exit("write");
+	}
+}
+
+void write_block(int fd, u32 block, const void *buf) {
+	off_t off = counted_lseek(fd, BLOCK_OFFSET(block), SEEK_SET);
 	if (off == -1) {
 		errno_exit("lseek");
 	}
 
-	u32 current_time = get_current_time();
+	if (counted_write(fd, buf, block_size) != block_size) {
+		errno_exit("write");
+	}
+}
+
+/* Directory hashing, as in e2fsprogs lib/ext2fs/dirhash.c (unsigned chars) */
+
+#define HASH_F(x, y, z) ((z) ^ ((x) & ((y) ^ (z))))
+#define HASH_G(x, y, z) (((x) & (y)) + (((x) ^ (y)) & (z)))
+#define HASH_H(x, y, z) ((x) ^ (y) ^ (z))
+#define HASH_ROUND(f, a, b, c, d, x, s)                                        \
+	(a += f(b, c, d) + x, a = (a << s) | (a >> (32 - s)))
+#define HASH_K2 013240474631UL
+#define HASH_K3 015666365641UL
+
+static void half_md4_transform(u32 buf[4], const u32 in[8]) {
+	u32 a = buf[0], b = buf[1], c = buf[2], d = buf[3];
+
+	HASH_ROUND(HASH_F, a, b, c, d, in[0],  3);
+	HASH_ROUND(HASH_F, d, a, b, c, in[1],  7);
+	HASH_ROUND(HASH_F, c, d, a, b, in[2], 11);
+	HASH_ROUND(HASH_F, b, c, d, a, in[3], 19);
+	HASH_ROUND(HASH_F, a, b, c, d, in[4],  3);
+	HASH_ROUND(HASH_F, d, a, b, c, in[5],  7);
+	HASH_ROUND(HASH_F, c, d, a, b, in[6], 11);
+	HASH_ROUND(HASH_F, b, c, d, a, in[7], 19);
+
+	HASH_ROUND(HASH_G, a, b, c, d, in[1] + HASH_K2,  3);
+	HASH_ROUND(HASH_G, d, a, b, c, in[3] + HASH_K2,  5);
+	HASH_ROUND(HASH_G, c, d, a, b, in[5] + HASH_K2,  9);
+	HASH_ROUND(HASH_G, b, c, d, a, in[7] + HASH_K2, 13);
+	HASH_ROUND(HASH_G, a, b, c, d, in[0] + HASH_K2,  3);
+	HASH_ROUND(HASH_G, d, a, b, c, in[2] + HASH_K2,  5);
+	HASH_ROUND(HASH_G, c, d, a, b, in[4] + HASH_K2,  9);
+	HASH_ROUND(HASH_G, b, c, d, a, in[6] + HASH_K2, 13);
+
+	HASH_ROUND(HASH_H, a, b, c, d, in[3] + HASH_K3,  3);
+	HASH_ROUND(HASH_H, d, a, b, c, in[7] + HASH_K3,  9);
+	HASH_ROUND(HASH_H, c, d, a, b, in[2] + HASH_K3, 11);
+	HASH_ROUND(HASH_H, b, c, d, a, in[6] + HASH_K3, 15);
+	HASH_ROUND(HASH_H, a, b, c, d, in[1] + HASH_K3,  3);
+	HASH_ROUND(HASH_H, d, a, b, c, in[5] + HASH_K3,  9);
+	HASH_ROUND(HASH_H, c, d, a, b, in[0] + HASH_K3, 11);
+	HASH_ROUND(HASH_H, b, c, d, a, in[4] + HASH_K3, 15);
+
+	buf[0] += a;
+	buf[1] += b;
+	buf[2] += c;
+	buf[3] += d;
+}
+
+static void str2hashbuf(const u8 *msg, int len, u32 *buf, int num) {
+	u32 pad = (u32) len | ((u32) len << 8);
+	pad |= pad << 16;
+
+	u32 val = pad;
+	if (len > num * 4) {
+		len = num * 4;
+	}
+	for (int i = 0; i < len; i++) {
+		val = msg[i] + (val << 8);
+		if ((i % 4) == 3) {
+			*buf++ = val;
+			val = pad;
+			num--;
+		}
+	}
+	if (--num >= 0) {
+		*buf++ = val;
+	}
+	while (--num >= 0) {
+		*buf++ = pad;
+	}
+}
+
+void dir_index_hash(const char *name, u32 *hash, u32 *minor_hash) {
+	u32 buf[4];
+	u32 in[8];
+
+	/* The hash seed is the filesystem UUID, see write_superblock */
+	memcpy(buf, fs_uuid, sizeof(buf));
+
+	const u8 *p = (const u8 *) name;
+	int len = strlen(name);
+	while (len > 0) {
+		str2hashbuf(p, len, in, 8);
+		half_md4_transform(buf, in);
+		len -= 32;
+		p += 32;
+	}
+
+	*hash = buf[1] & ~1;
+	*minor_hash = buf[2];
+}
+
+static int dir_index_entry_cmp(const void *a, const void *b) {
+	const struct dir_index_entry *x = a;
+	const struct dir_index_entry *y = b;
+	if (x->hash != y->hash) {
+		return x->hash < y->hash ? -1 : 1;
+	}
+	if (x->minor_hash != y->minor_hash) {
+		return x->minor_hash < y->minor_hash ? -1 : 1;
+	}
+	return 0;
+}
+
+/* Hashes the entries and sorts them into the order they are stored in the
+   leaf blocks, returns how many leaf blocks they fill */
+u32 dir_index_prepare(struct dir_index_entry *entries, size_t n) {
+	for (size_t i = 0; i < n; i++) {
+		dir_index_hash(entries[i].name, &entries[i].hash,
+		               &entries[i].minor_hash);
+	}
+	qsort(entries, n, sizeof(*entries), dir_index_entry_cmp);
+
+	u32 leaves = 1;
+	size_t used = 0;
+	for (size_t i = 0; i < n; i++) {
+		size_t rec_len = DIR_REC_LEN(strlen(entries[i].name));
+		if (used + rec_len > block_size) {
+			leaves++;
+			used = 0;
+		}
+		used += rec_len;
+	}
+	return leaves;
+}
+
+/* Number of blocks (dx_root, dx_nodes and leaves) an indexed directory with
+   the given number of leaves needs */
+u32 dir_index_nblocks(u32 leaves) {
+	if (leaves <= DX_ROOT_LIMIT) {
+		return 1 + leaves;
+	}
+	u32 nodes = (leaves + DX_NODE_LIMIT - 1) / DX_NODE_LIMIT;
+	if (nodes > DX_ROOT_LIMIT) {
+		fprintf(stderr, "directory too large to index\n");
+		exit(EXIT_FAILURE);
+	}
+	return 1 + nodes + leaves;
+}
+
+/* Writes an indexed directory from entries prepared by dir_index_prepare.
+   blocks maps each logical block of the directory to its block number: the
+   dx_root comes first, then any dx_nodes, then the leaves in hash order. */
+void write_indexed_dir(int fd, u32 inode, u32 parent_inode,
+                       const struct dir_index_entry *entries, size_t n,
+                       u32 leaves, const u32 *blocks) {
+	u32 nodes = dir_index_nblocks(leaves) - 1 - leaves;
+	u32 *leaf_hash = malloc(leaves * sizeof(u32));
+	if (leaf_hash == NULL) {
+		errno_exit("malloc");
+	}
+	u8 block[MAX_BLOCK_SIZE];
+
+	size_t i = 0;
+	for (u32 leaf = 0; leaf < leaves; leaf++) {
+		memset(block, 0, block_size);
+		/* The low bit marks a hash that continues from the previous leaf */
+		leaf_hash[leaf] = 0;
+		if (i < n) {
+			leaf_hash[leaf] = entries[i].hash;
+			if (i > 0 && entries[i - 1].hash == entries[i].hash) {
+				leaf_hash[leaf] |= 1;
+			}
+		}
+
+		size_t used = 0;
+		struct ext2_dir_entry *last = NULL;
+		while (i < n) {
+			size_t len = strlen(entries[i].name);
+			if (used + DIR_REC_LEN(len) > block_size) {
+				break;
+			}
+			struct ext2_dir_entry *entry = (void *) (block + used);
+			entry->inode = entries[i].inode;
+			entry->rec_len = DIR_REC_LEN(len);
+			entry->name_len = len;
+			entry->file_type = dir_file_type(entries[i].file_type);
+			memcpy(entry->name, entries[i].name, len);
+			used += entry->rec_len;
+			last = entry;
+			i++;
+		}
+		if (last == NULL) {
+			((struct ext2_dir_entry *) block)->rec_len = block_size;
+		}
+		else {
+			last->rec_len += block_size - used;
+		}
+		write_block(fd, blocks[1 + nodes + leaf], block);
+	}
+
+	for (u32 node = 0; node < nodes; node++) {
+		memset(block, 0, block_size);
+		((struct ext2_dir_entry *) block)->rec_len = block_size;
+
+		u32 first = node * DX_NODE_LIMIT;
+		u32 count = leaves - first < DX_NODE_LIMIT ? leaves - first
+		                                           : DX_NODE_LIMIT;
+		struct dx_entry *dx = (void *) (block + 8);
+		for (u32 j = 0; j < count; j++) {
+			dx[j].hash = leaf_hash[first + j];
+			dx[j].block = 1 + nodes + first + j;
+		}
+		struct dx_countlimit *countlimit = (void *) dx;
+		countlimit->limit = DX_NODE_LIMIT;
+		countlimit->count = count;
+		write_block(fd, blocks[1 + node], block);
+	}
+
+	memset(block, 0, block_size);
+	struct ext2_dir_entry *dot = (void *) block;
+	dot->inode = inode;
+	dot->rec_len = 12;
+	dot->name_len = 1;
+	dot->file_type = dir_file_type(EXT2_FT_DIR);
+	memcpy(dot->name, ".", 1);
+	struct ext2_dir_entry *dotdot = (void *) (block + 12);
+	dotdot->inode = parent_inode;
+	dotdot->rec_len = block_size - 12;
+	dotdot->name_len = 2;
+	dotdot->file_type = dir_file_type(EXT2_FT_DIR);
+	memcpy(dotdot->name, "..", 2);
+
+	struct dx_root_info *info = (void *) (block + 24);
+	info->hash_version = EXT2_HASH_HALF_MD4;
+	info->info_length = sizeof(struct dx_root_info);
+	info->indirect_levels = nodes > 0 ? 1 : 0;
+
+	struct dx_entry *dx = (void *) (block + 32);
+	u32 count = nodes > 0 ? nodes : leaves;
+	for (u32 j = 0; j < count; j++) {
+		dx[j].hash = nodes > 0 ? leaf_hash[j * DX_NODE_LIMIT] : leaf_hash[j];
+		dx[j].block = 1 + j;
+	}
+	struct dx_countlimit *countlimit = (void *) dx;
+	countlimit->limit = DX_ROOT_LIMIT;
+	countlimit->count = count;
+	write_block(fd, blocks[0], block);
+
+	free(leaf_hash);
+}
+
+void write_superblock(int fd) {
+	u32 free_blocks = 0;
+	u32 free_inodes = 0;
+	for (u32 group = 0; group < num_groups; group++) {
+		free_blocks += group_summaries[group].free_blocks_count;
+		free_inodes += group_summaries[group].free_inodes_count;
+	}
 
 	struct ext2_superblock superblock = {0};
 
 	// TODO It's all yours
 	// TODO finish the superblock number setting
-	superblock.s_inodes_count = NUM_INODES;
-	superblock.s_blocks_count = NUM_BLOCKS;
+	superblock.s_inodes_count = NUM_INODES * num_groups;
+	superblock.s_blocks_count = num_blocks();
 	superblock.s_r_blocks_count = 0;
-	superblock.s_free_blocks_count = NUM_FREE_BLOCKS;
-	superblock.s_free_inodes_count = NUM_FREE_INODES;
-	superblock.s_first_data_block = 1; /* First Data Block */
-	superblock.s_log_block_size = 0;					/* 1024 */
-	superblock.s_log_frag_size = 0;						/* 1024 */
-	superblock.s_blocks_per_group = NUM_BLOCKS;
-	superblock.s_frags_per_group = NUM_BLOCKS;
+	superblock.s_free_blocks_count = free_blocks;
+	superblock.s_free_inodes_count = free_inodes;
+	superblock.s_first_data_block = first_data_block; /* First Data Block */
+	superblock.s_log_block_size = __builtin_ctz(block_size) - 10; /* 1024 << n */
+	superblock.s_log_frag_size = superblock.s_log_block_size;
+	superblock.s_blocks_per_group = blocks_per_group();
+	superblock.s_frags_per_group = blocks_per_group();
 	superblock.s_inodes_per_group = NUM_INODES;
 	superblock.s_mtime = 0;				/* Mount time */
-	superblock.s_wtime = current_time;	/* Write time */
+	superblock.s_wtime = build_time;	/* Write time */
 	superblock.s_mnt_count         = 0; /* Number of times mounted so far */
 	superblock.s_max_mnt_count     = -1; /* Make this unlimited */
 	superblock.s_magic = EXT2_SUPER_MAGIC; /* ext2 Signature */
 	superblock.s_state             = 1; /* File system is clean */
 	superblock.s_errors            = 1; /* Ignore the error (continue on) */
 	superblock.s_minor_rev_level   = 0; /* Leave this as 0 */
-	superblock.s_lastcheck = current_time; /* Last check time */
+	superblock.s_lastcheck = build_time; /* Last check time */
 	superblock.s_checkinterval     = 1; /* Force checks by making them every 1 second */
 	superblock.s_creator_os        = 0; /* Linux */
 	superblock.s_rev_level         = 0; /* Leave this as 0 */
@@ -226,70 +870,93 @@ void write_superblock(int fd) {
 
 	/* You can leave everything below this line the same, delete this
 	   comment when you're done the lab */
-	superblock.s_uuid[0] = 0x5A;
-	superblock.s_uuid[1] = 0x1E;
-	superblock.s_uuid[2] = 0xAB;
-	superblock.s_uuid[3] = 0x1E;
-	superblock.s_uuid[4] = 0x13;
-	superblock.s_uuid[5] = 0x37;
-	superblock.s_uuid[6] = 0x13;
-	superblock.s_uuid[7] = 0x37;
-	superblock.s_uuid[8] = 0x13;
-	superblock.s_uuid[9] = 0x37;
-	superblock.s_uuid[10] = 0xC0;
-	superblock.s_uuid[11] = 0xFF;
-	superblock.s_uuid[12] = 0xEE;
-	superblock.s_uuid[13] = 0xC0;
-	superblock.s_uuid[14] = 0xFF;
-	superblock.s_uuid[15] = 0xEE;
+	memcpy(&superblock.s_uuid, fs_uuid, sizeof(fs_uuid));
 
 	memcpy(&superblock.s_volume_name, "cs111-base", 10);
 
-	ssize_t size = sizeof(superblock);
-	if (write(fd, &superblock, size) != size) {
-		errno_exit("write");
+	if (dir_index || dynamic_rev) {
+		/* Feature flags only exist from the dynamic revision on */
+		superblock.s_rev_level = EXT2_DYNAMIC_REV;
+		superblock.s_first_ino = EXT2_GOOD_OLD_FIRST_INO;
+		superblock.s_inode_size = inode_size;
+	}
+	if (dynamic_rev) {
+		superblock.s_feature_incompat |= EXT2_FEATURE_INCOMPAT_FILETYPE;
+		superblock.s_feature_ro_compat |= EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER;
+	}
+	if (dir_index) {
+		superblock.s_feature_compat |= EXT2_FEATURE_COMPAT_DIR_INDEX;
+		memcpy(&superblock.s_hash_seed, fs_uuid, sizeof(fs_uuid));
+		superblock.s_def_hash_version = EXT2_HASH_HALF_MD4;
+		superblock.s_flags |= EXT2_FLAGS_UNSIGNED_HASH;
 	}
-}
 
-void write_block_group_descriptor_table(int fd) {
-	off_t off = lseek(fd, BLOCK_OFFSET(BLOCK_GROUP_DESCRIPTOR_BLOCKNO), SEEK_SET);
-	if (off == -1) {
-		errno_exit("lseek");
+	write_superblock_copy(fd, SUPERBLOCK_OFFSET, &superblock);
+	/* Backups sit at the start of the first block of their group, and
+	   from revision 1 on record which group that is */
+	for (u32 group = 1; group < num_groups; group++) {
+		if (!group_has_super(group)) {
+			continue;
+		}
+		if (superblock.s_rev_level == EXT2_DYNAMIC_REV) {
+			superblock.s_block_group_nr = group;
+		}
+		write_superblock_copy(fd, BLOCK_OFFSET(group_first_block(group)),
+		                      &superblock);
 	}
+}
 
-	struct ext2_block_group_descriptor block_group_descriptor = {0};
+void write_block_group_descriptor_table(int fd) {
+	struct ext2_block_group_descriptor table[MAX_GROUPS] = {0};
 
 	// TODO It's all yours
 	// TODO finish the block group descriptor number setting
-	block_group_descriptor.bg_block_bitmap = BLOCK_BITMAP_BLOCKNO;
-	block_group_descriptor.bg_inode_bitmap = INODE_BITMAP_BLOCKNO;
-	block_group_descriptor.bg_inode_table = INODE_TABLE_BLOCKNO;
-	block_group_descriptor.bg_free_blocks_count = NUM_FREE_BLOCKS;
-	block_group_descriptor.bg_free_inodes_count = NUM_FREE_INODES;
-	block_group_descriptor.bg_used_dirs_count = 2;
-
-	ssize_t size = sizeof(block_group_descriptor);
-	if (write(fd, &block_group_descriptor, size) != size) {
-		errno_exit("write");
+	table[0].bg_block_bitmap = BLOCK_BITMAP_BLOCKNO;
+	table[0].bg_inode_bitmap = INODE_BITMAP_BLOCKNO;
+	table[0].bg_inode_table = INODE_TABLE_BLOCKNO;
+	for (u32 group = 1; group < num_groups; group++) {
+		u32 first = group_first_block(group);
+		table[group].bg_block_bitmap = first + GROUP_BLOCK_BITMAP;
+		table[group].bg_inode_bitmap = first + GROUP_INODE_BITMAP;
+		table[group].bg_inode_table = first + GROUP_INODE_TABLE;
+	}
+	for (u32 group = 0; group < num_groups; group++) {
+		struct group_summary *summary = &group_summaries[group];
+		table[group].bg_free_blocks_count = summary->free_blocks_count;
+		table[group].bg_free_inodes_count = summary->free_inodes_count;
+		table[group].bg_used_dirs_count = summary->used_dirs_count;
+	}
+
+	_Static_assert(sizeof(table) == MAX_BLOCK_SIZE,
+	               "descriptor table must fill the largest block");
+	write_block(fd, BLOCK_GROUP_DESCRIPTOR_BLOCKNO, table);
+	for (u32 group = 1; group < num_groups; group++) {
+		if (group_has_super(group)) {
+			write_block(fd, group_first_block(group) + 1, table);
+		}
 	}
 }
 
 void write_block_bitmap(int fd)
 {
-	off_t off = lseek(fd, BLOCK_OFFSET(BLOCK_BITMAP_BLOCKNO), SEEK_SET);
+	off_t off = counted_lseek(fd, BLOCK_OFFSET(BLOCK_BITMAP_BLOCKNO), SEEK_SET);
 	if (off == -1)
 	{
 		errno_exit("lseek");
 	}
 
 	// TODO It's all yours
-	u8 map_value[BLOCK_SIZE] = {0};
-	map_value[0] = 0xFF;
-	map_value[1] = 0xFF;  
-	map_value[2] = 0xFF; 
+	u8 map_value[MAX_BLOCK_SIZE] = {0};
+	for (u32 i = 0; i < first_group_used_blocks(); i++) {
+		map_value[i / 8] |= 1 << (i % 8);
+	}
+	if (!legacy_layout()) {
+		set_bitmap_padding(map_value, num_groups > 1 ? GROUP_BLOCKS
+		                              : NUM_BLOCKS - first_data_block);
+	}
 
 
-	if (write(fd, map_value, BLOCK_SIZE) != BLOCK_SIZE)
+	if (counted_write(fd, map_value, block_size) != block_size)
 	{
 		errno_exit("write");
 	}
@@ -297,41 +964,75 @@ void write_block_bitmap(int fd)
 
 void write_inode_bitmap(int fd)
 {
-	off_t off = lseek(fd, BLOCK_OFFSET(INODE_BITMAP_BLOCKNO), SEEK_SET);
+	off_t off = counted_lseek(fd, BLOCK_OFFSET(INODE_BITMAP_BLOCKNO), SEEK_SET);
 	if (off == -1)
 	{
 		errno_exit("lseek");
 	}
 
 	// TODO It's all yours
-	u8 map_value[BLOCK_SIZE] = {0};
+	u8 map_value[MAX_BLOCK_SIZE] = {0};
 	map_value[0] = 0xFF; 
-	map_value[1] = 0x1F; 
+	map_value[1] = big_entries ? 0x7F : 0x1F;
+	if (!legacy_layout()) {
+		/* Bits past the last inode of a group are set */
+		set_bitmap_padding(map_value, NUM_INODES);
+	}
 
 
-	if (write(fd, map_value, BLOCK_SIZE) != BLOCK_SIZE)
+	if (counted_write(fd, map_value, block_size) != block_size)
 	{
 		errno_exit("write");
 	}
 }
 
 void write_inode(int fd, u32 index, struct ext2_inode *inode) {
-	off_t off = BLOCK_OFFSET(INODE_TABLE_BLOCKNO)
-	            + (index - 1) * sizeof(struct ext2_inode);
-	off = lseek(fd, off, SEEK_SET);
+	off_t off = BLOCK_OFFSET(INODE_TABLE_BLOCKNO) + (index - 1) * inode_size;
+	off = counted_lseek(fd, off, SEEK_SET);
 	if (off == -1) {
 		errno_exit("lseek");
 	}
 
 	ssize_t size = sizeof(struct ext2_inode);
-	if (write(fd, inode, size) != size) {
+	if (counted_write(fd, inode, size) != size) {
 		errno_exit("write");
 	}
 }
 
-void write_inode_table(int fd) {
-	u32 current_time = get_current_time();
+/* Directories much larger than one block are only written for -n */
+void write_big_inodes(int fd) {
+	struct ext2_inode dir_inode = {0};
+	dir_inode.i_mode = EXT2_S_IFDIR | EXT2_S_IRUSR | EXT2_S_IWUSR
+	                   | EXT2_S_IXUSR | EXT2_S_IRGRP | EXT2_S_IXGRP
+	                   | EXT2_S_IROTH | EXT2_S_IXOTH;
+	dir_inode.i_size = big_dir_blocks * block_size;
+	dir_inode.i_atime = build_time;
+	dir_inode.i_ctime = build_time;
+	dir_inode.i_mtime = build_time;
+	dir_inode.i_links_count = 2;
+	dir_inode.i_blocks = big_blocks * (block_size / 512);
+	dir_inode.i_flags = EXT2_INDEX_FL;
+	for (u32 i = 0; i < big_dir_blocks && i < EXT2_NDIR_BLOCKS; i++) {
+		dir_inode.i_block[i] = BIG_DIR_BLOCKNO + i;
+	}
+	if (big_dir_blocks > EXT2_NDIR_BLOCKS) {
+		dir_inode.i_block[EXT2_IND_BLOCK] = BIG_DIR_BLOCKNO + big_dir_blocks;
+	}
+	write_inode(fd, BIG_DIR_INO, &dir_inode);
+
+	struct ext2_inode file_inode = {0};
+	file_inode.i_mode = EXT2_S_IFREG | EXT2_S_IRUSR | EXT2_S_IWUSR
+	                    | EXT2_S_IRGRP | EXT2_S_IROTH;
+	file_inode.i_uid = 1000;
+	file_inode.i_atime = build_time;
+	file_inode.i_ctime = build_time;
+	file_inode.i_mtime = build_time;
+	file_inode.i_gid = 1000;
+	file_inode.i_links_count = big_entries;
+	write_inode(fd, BIG_FILE_INO, &file_inode);
+}
 
+void write_inode_table(int fd) {
 	struct ext2_inode lost_and_found_inode = {0};
 	lost_and_found_inode.i_mode = EXT2_S_IFDIR
 	                              | EXT2_S_IRUSR
@@ -342,14 +1043,14 @@ void write_inode_table(int fd) {
 	                              | EXT2_S_IROTH
 	                              | EXT2_S_IXOTH;
 	lost_and_found_inode.i_uid = 0;
-	lost_and_found_inode.i_size = 1024;
-	lost_and_found_inode.i_atime = current_time;
-	lost_and_found_inode.i_ctime = current_time;
-	lost_and_found_inode.i_mtime = current_time;
+	lost_and_found_inode.i_size = block_size;
+	lost_and_found_inode.i_atime = build_time;
+	lost_and_found_inode.i_ctime = build_time;
+	lost_and_found_inode.i_mtime = build_time;
 	lost_and_found_inode.i_dtime = 0;
 	lost_and_found_inode.i_gid = 0;
 	lost_and_found_inode.i_links_count = 2;
-	lost_and_found_inode.i_blocks = 2; /* These are oddly 512 blocks */
+	lost_and_found_inode.i_blocks = block_size / 512; /* These are oddly 512 blocks */
 	lost_and_found_inode.i_block[0] = LOST_AND_FOUND_DIR_BLOCKNO;
 	write_inode(fd, LOST_AND_FOUND_INO, &lost_and_found_inode);
 
@@ -358,15 +1059,19 @@ void write_inode_table(int fd) {
 	struct ext2_inode root_inode = {0};
 	root_inode.i_mode = EXT2_S_IFDIR | EXT2_S_IRUSR | EXT2_S_IWUSR | EXT2_S_IXUSR | EXT2_S_IRGRP | EXT2_S_IXGRP | EXT2_S_IROTH | EXT2_S_IXOTH;
 	root_inode.i_uid = 0;
-	root_inode.i_size = 1024;
-	root_inode.i_atime = current_time;
-	root_inode.i_ctime = current_time;
-	root_inode.i_mtime = current_time;
+	root_inode.i_size = dir_index ? 2 * block_size : block_size;
+	root_inode.i_atime = build_time;
+	root_inode.i_ctime = build_time;
+	root_inode.i_mtime = build_time;
 	root_inode.i_dtime = 0;
 	root_inode.i_gid = 0;
-	root_inode.i_links_count = 3;
-	root_inode.i_blocks = 2;
+	root_inode.i_links_count = 3 + (num_groups - 1) + (big_entries ? 1 : 0);
+	root_inode.i_blocks = root_inode.i_size / 512;
 	root_inode.i_block[0] = ROOT_DIR_BLOCKNO;
+	if (dir_index) {
+		root_inode.i_flags |= EXT2_INDEX_FL;
+		root_inode.i_block[1] = ROOT_DIR_LEAF_BLOCKNO;
+	}
 	write_inode(fd, EXT2_ROOT_INO, &root_inode);
 
 	struct ext2_inode hello_world_inode = {0};
@@ -374,13 +1079,13 @@ void write_inode_table(int fd) {
 							| EXT2_S_IRGRP | EXT2_S_IROTH;
 	hello_world_inode.i_uid = 1000;
 	hello_world_inode.i_size = 12;
-	hello_world_inode.i_atime = current_time;
-	hello_world_inode.i_ctime = current_time;
-	hello_world_inode.i_mtime = current_time;
+	hello_world_inode.i_atime = build_time;
+	hello_world_inode.i_ctime = build_time;
+	hello_world_inode.i_mtime = build_time;
 	hello_world_inode.i_dtime = 0;
 	hello_world_inode.i_gid = 1000;
 	hello_world_inode.i_links_count = 1;
-	hello_world_inode.i_blocks = 2;
+	hello_world_inode.i_blocks = block_size / 512;
 	hello_world_inode.i_block[0] = HELLO_WORLD_FILE_BLOCKNO;
 	write_inode(fd, HELLO_WORLD_INO, &hello_world_inode);
 
@@ -389,9 +1094,9 @@ void write_inode_table(int fd) {
 						| EXT2_S_IRGRP | EXT2_S_IROTH;
 	hello_inode.i_uid = 1000;
 	hello_inode.i_size = 11;
-	hello_inode.i_atime = current_time;
-	hello_inode.i_ctime = current_time;
-	hello_inode.i_mtime = current_time;
+	hello_inode.i_atime = build_time;
+	hello_inode.i_ctime = build_time;
+	hello_inode.i_mtime = build_time;
 	hello_inode.i_dtime = 0;
 	hello_inode.i_gid = 1000;
 	hello_inode.i_links_count = 1;
@@ -399,62 +1104,158 @@ void write_inode_table(int fd) {
 	memcpy(hello_inode.i_block, "hello-world", 11);
 	write_inode(fd, HELLO_INO, &hello_inode);
 
+	if (big_entries) {
+		write_big_inodes(fd);
+	}
+}
+
+void write_indexed_root_dir(int fd)
+{
+	struct dir_index_entry entries[4 + MAX_GROUPS] = {
+		{ .inode = LOST_AND_FOUND_INO, .name = "lost+found",
+		  .file_type = EXT2_FT_DIR },
+		{ .inode = HELLO_WORLD_INO,    .name = "hello-world",
+		  .file_type = EXT2_FT_REG_FILE },
+		{ .inode = HELLO_INO,          .name = "hello",
+		  .file_type = EXT2_FT_SYMLINK },
+	};
+	size_t n = 3;
+	for (u32 group = 1; group < num_groups; group++) {
+		entries[n].inode = GROUP_DIR_INO(group);
+		entries[n].name = group_dir_names[group];
+		entries[n].file_type = EXT2_FT_DIR;
+		n++;
+	}
+	if (big_entries) {
+		entries[n].inode = BIG_DIR_INO;
+		entries[n].name = "big";
+		entries[n].file_type = EXT2_FT_DIR;
+		n++;
+	}
+
+	u32 leaves = dir_index_prepare(entries, n);
+	u32 blocks[] = { ROOT_DIR_BLOCKNO, ROOT_DIR_LEAF_BLOCKNO };
+	assert(dir_index_nblocks(leaves) == sizeof(blocks) / sizeof(blocks[0]));
+	write_indexed_dir(fd, EXT2_ROOT_INO, EXT2_ROOT_INO, entries, n, leaves,
+	                  blocks);
+}
+
+/* Names and hashes the entries of big, and works out how many blocks it
+   takes. Returns 0 if they do not fit the first group or the block
+   pointers this writes: the direct ones and one indirect block. */
+int prepare_big_dir() {
+	big_names = malloc(big_entries * sizeof(*big_names));
+	big_index = malloc(big_entries * sizeof(*big_index));
+	if (big_names == NULL || big_index == NULL) {
+		errno_exit("malloc");
+	}
+	for (u32 i = 0; i < big_entries; i++) {
+		snprintf(big_names[i], sizeof(big_names[i]), "file-%u", i);
+		big_index[i].inode = BIG_FILE_INO;
+		big_index[i].name = big_names[i];
+		big_index[i].file_type = EXT2_FT_REG_FILE;
+	}
+	big_leaves = dir_index_prepare(big_index, big_entries);
+	big_dir_blocks = dir_index_nblocks(big_leaves);
+	if (big_dir_blocks > EXT2_NDIR_BLOCKS + block_size / 4) {
+		return 0;
+	}
+	big_blocks = big_dir_blocks + (big_dir_blocks > EXT2_NDIR_BLOCKS);
+	u32 group_blocks = num_groups > 1 ? GROUP_BLOCKS
+	                                  : NUM_BLOCKS - first_data_block;
+	return first_group_used_blocks() <= group_blocks;
+}
+
+/* Writes big's dx_root, dx_nodes and leaves in consecutive blocks, then
+   the indirect block mapping those past the twelfth */
+void write_big_dir(int fd) {
+	u32 *blocks = malloc(big_dir_blocks * sizeof(u32));
+	if (blocks == NULL) {
+		errno_exit("malloc");
+	}
+	for (u32 i = 0; i < big_dir_blocks; i++) {
+		blocks[i] = BIG_DIR_BLOCKNO + i;
+	}
+	write_indexed_dir(fd, BIG_DIR_INO, EXT2_ROOT_INO, big_index, big_entries,
+	                  big_leaves, blocks);
+	if (big_dir_blocks > EXT2_NDIR_BLOCKS) {
+		u8 indirect[MAX_BLOCK_SIZE] = {0};
+		memcpy(indirect, blocks + EXT2_NDIR_BLOCKS,
+		       (big_dir_blocks - EXT2_NDIR_BLOCKS) * sizeof(u32));
+		write_block(fd, BIG_DIR_BLOCKNO + big_dir_blocks, indirect);
+	}
+	free(blocks);
 }
 
 void write_root_dir_block(int fd)
 {
+	if (dir_index) {
+		write_indexed_root_dir(fd);
+		return;
+	}
+
 	// TODO It's all yours
 	off_t off = BLOCK_OFFSET(ROOT_DIR_BLOCKNO);
-	off = lseek(fd, off, SEEK_SET);
+	off = counted_lseek(fd, off, SEEK_SET);
 	if (off == -1) {
 		errno_exit("lseek");
 	}
 
-	ssize_t bytes_remaining = BLOCK_SIZE;
+	ssize_t bytes_remaining = block_size;
 
 	struct ext2_dir_entry current_entry = {0};
-	dir_entry_set(current_entry, EXT2_ROOT_INO, ".");
+	dir_entry_set(current_entry, EXT2_ROOT_INO, ".", EXT2_FT_DIR);
 	dir_entry_write(current_entry, fd);
 	bytes_remaining -= current_entry.rec_len;
 
 	struct ext2_dir_entry parent_entry = {0};
-	dir_entry_set(parent_entry, EXT2_ROOT_INO, "..");
+	dir_entry_set(parent_entry, EXT2_ROOT_INO, "..", EXT2_FT_DIR);
 	dir_entry_write(parent_entry, fd);
 	bytes_remaining -= parent_entry.rec_len;
 
 	struct ext2_dir_entry lost_found_entry = {0};
-	dir_entry_set(lost_found_entry, LOST_AND_FOUND_INO, "lost+found");
+	dir_entry_set(lost_found_entry, LOST_AND_FOUND_INO, "lost+found",
+	              EXT2_FT_DIR);
 	dir_entry_write(lost_found_entry, fd);
 	bytes_remaining -= lost_found_entry.rec_len;
 
 	struct ext2_dir_entry hello_world_entry = {0};
-	dir_entry_set(hello_world_entry, HELLO_WORLD_INO, "hello-world");
+	dir_entry_set(hello_world_entry, HELLO_WORLD_INO, "hello-world",
+	              EXT2_FT_REG_FILE);
 	dir_entry_write(hello_world_entry, fd);
 	bytes_remaining -= hello_world_entry.rec_len;
 
+	for (u32 group = 1; group < num_groups; group++) {
+		struct ext2_dir_entry group_entry = {0};
+		dir_entry_set(group_entry, GROUP_DIR_INO(group),
+		              group_dir_names[group], EXT2_FT_DIR);
+		dir_entry_write(group_entry, fd);
+		bytes_remaining -= group_entry.rec_len;
+	}
+
 	struct ext2_dir_entry hello_entry = {0};
-	dir_entry_set(hello_entry, HELLO_INO, "hello");
+	dir_entry_set(hello_entry, HELLO_INO, "hello", EXT2_FT_SYMLINK);
 	hello_entry.rec_len = bytes_remaining;
 	dir_entry_write(hello_entry, fd);
 }
 
 void write_lost_and_found_dir_block(int fd) {
 	off_t off = BLOCK_OFFSET(LOST_AND_FOUND_DIR_BLOCKNO);
-	off = lseek(fd, off, SEEK_SET);
+	off = counted_lseek(fd, off, SEEK_SET);
 	if (off == -1) {
 		errno_exit("lseek");
 	}
 
-	ssize_t bytes_remaining = BLOCK_SIZE;
+	ssize_t bytes_remaining = block_size;
 
 	struct ext2_dir_entry current_entry = {0};
-	dir_entry_set(current_entry, LOST_AND_FOUND_INO, ".");
+	dir_entry_set(current_entry, LOST_AND_FOUND_INO, ".", EXT2_FT_DIR);
 	dir_entry_write(current_entry, fd);
 
 	bytes_remaining -= current_entry.rec_len;
 
 	struct ext2_dir_entry parent_entry = {0};
-	dir_entry_set(parent_entry, EXT2_ROOT_INO, "..");
+	dir_entry_set(parent_entry, EXT2_ROOT_INO, "..", EXT2_FT_DIR);
 	dir_entry_write(parent_entry, fd);
 
 	bytes_remaining -= parent_entry.rec_len;
@@ -467,19 +1268,227 @@ void write_lost_and_found_dir_block(int fd) {
 void write_hello_world_file_block(int fd)
 {
 	// TODO It's all yours
-	off_t off = lseek(fd, BLOCK_OFFSET(HELLO_WORLD_FILE_BLOCKNO), SEEK_SET);
+	off_t off = counted_lseek(fd, BLOCK_OFFSET(HELLO_WORLD_FILE_BLOCKNO), SEEK_SET);
 	if (off == -1) {
 		errno_exit("lseek");
 	}
 
 	const char *s = "Hello world\n";
 	size_t len = strlen(s);
-	if (write(fd, s, len) != (ssize_t)len) {
+	if (counted_write(fd, s, len) != (ssize_t)len) {
 		errno_exit("write");
 	}
 }
 
+/* Writes everything in a group after the first: its bitmaps, its inode
+   table, and a directory holding one file of GROUP_FILE_BLOCKS blocks,
+   with pwrite to the group's own blocks. A group without superblock and
+   descriptor copies leaves their two blocks free. */
+void write_group(int fd, u32 group, struct group_summary *summary) {
+	u32 first = group_first_block(group);
+	u32 unused = group_has_super(group) ? 0 : GROUP_BLOCK_BITMAP;
+	u8 block_bitmap[MAX_BLOCK_SIZE] = {0};
+	for (u32 i = unused; i < GROUP_USED_BLOCKS; i++) {
+		block_bitmap[i / 8] |= 1 << (i % 8);
+	}
+	pwrite_all(fd, block_bitmap, block_size,
+	           BLOCK_OFFSET(first + GROUP_BLOCK_BITMAP));
+
+	u8 inode_bitmap[MAX_BLOCK_SIZE];
+	memset(inode_bitmap, 0xFF, block_size);
+	memset(inode_bitmap, 0, NUM_INODES / 8);
+	inode_bitmap[0] = 0x03;
+	pwrite_all(fd, inode_bitmap, block_size,
+	           BLOCK_OFFSET(first + GROUP_INODE_BITMAP));
+
+	/* Inodes larger than the struct are zero past it */
+	u8 *table = calloc(NUM_INODES, inode_size);
+	if (table == NULL) {
+		errno_exit("calloc");
+	}
+	struct ext2_inode *dir_inode = (void *) table;
+	dir_inode->i_mode = EXT2_S_IFDIR | EXT2_S_IRUSR | EXT2_S_IWUSR
+	                    | EXT2_S_IXUSR | EXT2_S_IRGRP | EXT2_S_IXGRP
+	                    | EXT2_S_IROTH | EXT2_S_IXOTH;
+	dir_inode->i_size = block_size;
+	dir_inode->i_atime = build_time;
+	dir_inode->i_ctime = build_time;
+	dir_inode->i_mtime = build_time;
+	dir_inode->i_links_count = 2;
+	dir_inode->i_blocks = block_size / 512;
+	dir_inode->i_block[0] = first + GROUP_DIR_BLOCK;
+
+	struct ext2_inode *file_inode = (void *) (table + inode_size);
+	file_inode->i_mode = EXT2_S_IFREG | EXT2_S_IRUSR | EXT2_S_IWUSR
+	                     | EXT2_S_IRGRP | EXT2_S_IROTH;
+	file_inode->i_uid = 1000;
+	file_inode->i_size = GROUP_FILE_BLOCKS * block_size;
+	file_inode->i_atime = build_time;
+	file_inode->i_ctime = build_time;
+	file_inode->i_mtime = build_time;
+	file_inode->i_gid = 1000;
+	file_inode->i_links_count = 1;
+	file_inode->i_blocks = GROUP_FILE_BLOCKS * block_size / 512;
+	for (u32 i = 0; i < GROUP_FILE_BLOCKS; i++) {
+		file_inode->i_block[i] = first + GROUP_FILE_BLOCK + i;
+	}
+	pwrite_all(fd, table, NUM_INODES * inode_size,
+	           BLOCK_OFFSET(first + GROUP_INODE_TABLE));
+	free(table);
+
+	u8 dir_block[MAX_BLOCK_SIZE] = {0};
+	struct ext2_dir_entry *dot = (void *) dir_block;
+	dot->inode = GROUP_DIR_INO(group);
+	dot->rec_len = DIR_REC_LEN(1);
+	dot->name_len = 1;
+	dot->file_type = dir_file_type(EXT2_FT_DIR);
+	memcpy(dot->name, ".", 1);
+	struct ext2_dir_entry *dotdot = (void *) (dir_block + dot->rec_len);
+	dotdot->inode = EXT2_ROOT_INO;
+	dotdot->rec_len = DIR_REC_LEN(2);
+	dotdot->name_len = 2;
+	dotdot->file_type = dir_file_type(EXT2_FT_DIR);
+	memcpy(dotdot->name, "..", 2);
+	struct ext2_dir_entry *data = (void *) (dir_block + dot->rec_len
+	                                        + dotdot->rec_len);
+	data->inode = GROUP_FILE_INO(group);
+	data->rec_len = block_size - dot->rec_len - dotdot->rec_len;
+	data->name_len = 4;
+	data->file_type = dir_file_type(EXT2_FT_REG_FILE);
+	memcpy(data->name, "data", 4);
+	pwrite_all(fd, dir_block, block_size,
+	           BLOCK_OFFSET(first + GROUP_DIR_BLOCK));
+
+	/* Each block of the file repeats a line naming its group and block */
+	const size_t file_size = GROUP_FILE_BLOCKS * block_size;
+	u8 *contents = malloc(file_size);
+	if (contents == NULL) {
+		errno_exit("malloc");
+	}
+	for (u32 i = 0; i < GROUP_FILE_BLOCKS; i++) {
+		char line[32];
+		int len = snprintf(line, sizeof(line), "group %u block %u\n",
+		                   group, i);
+		for (size_t off = 0; off < block_size; off += len) {
+			size_t n = block_size - off < (size_t) len ? block_size - off
+			                                           : (size_t) len;
+			memcpy(contents + i * block_size + off, line, n);
+		}
+	}
+	pwrite_all(fd, contents, file_size,
+	           BLOCK_OFFSET(first + GROUP_FILE_BLOCK));
+	free(contents);
+
+	summary->free_blocks_count = GROUP_BLOCKS - GROUP_USED_BLOCKS + unused;
+	summary->free_inodes_count = NUM_INODES - 2;
+	summary->used_dirs_count = 1;
+}
+
+void write_groups(int fd) {
+	for (u32 group = 1; group < num_groups; group++) {
+		write_group(fd, group, &group_summaries[group]);
+	}
+}
+
 int main(int argc, char *argv[]) {
+	u64 begin = monotonic_ns();
+
+	static const struct option long_options[] = {
+		{ "stats", no_argument, &print_stats, 1 },
+		{ "seed", required_argument, NULL, 's' },
+		{ 0 },
+	};
+	int opt;
+	char *end;
+	while ((opt = getopt_long(argc, argv, "b:iI:g:n:rs:", long_options,
+	                          NULL)) != -1) {
+		switch (opt) {
+		case 0:
+			break;
+		case 'b':
+			block_size = strtoul(optarg, &end, 10);
+			if (*end != '\0' || (block_size != 1024 && block_size != 2048
+			                      && block_size != 4096)) {
+				fprintf(stderr, "%s: block size must be 1024, 2048 "
+				        "or 4096\n", argv[0]);
+				return EXIT_FAILURE;
+			}
+			break;
+		case 'i':
+			dir_index = 1;
+			break;
+		case 'I':
+			inode_size = strtoul(optarg, &end, 10);
+			if (*end != '\0' || inode_size < EXT2_GOOD_OLD_INODE_SIZE
+			    || (inode_size & (inode_size - 1))) {
+				fprintf(stderr, "%s: inode size must be a power of two "
+				        "from %d\n", argv[0], EXT2_GOOD_OLD_INODE_SIZE);
+				return EXIT_FAILURE;
+			}
+			dynamic_rev = 1;
+			break;
+		case 'n':
+			big_entries = strtoul(optarg, &end, 10);
+			if (*end != '\0' || big_entries < 1
+			    || big_entries > EXT2_LINK_MAX) {
+				fprintf(stderr, "%s: entries must be 1 to %d\n", argv[0],
+				        EXT2_LINK_MAX);
+				return EXIT_FAILURE;
+			}
+			/* big is always indexed, and so is the root with it */
+			dir_index = 1;
+			break;
+		case 'r':
+			dynamic_rev = 1;
+			break;
+		case 'g':
+			num_groups = strtoul(optarg, &end, 10);
+			if (*end != '\0' || num_groups < 1) {
+				fprintf(stderr, "%s: bad group count\n", argv[0]);
+				return EXIT_FAILURE;
+			}
+			break;
+		case 's': {
+			errno = 0;
+			u64 seed = strtoull(optarg, &end, 0);
+			if (*optarg == '\0' || *end != '\0' || errno) {
+				fprintf(stderr, "%s: bad seed\n", argv[0]);
+				return EXIT_FAILURE;
+			}
+			set_uuid_from_seed(seed);
+			break;
+		}
+		default:
+			fprintf(stderr, "usage: %s [-b block_size] [-i] [-n entries] "
+			        "[-r] [-I inode_size] [-g groups] [-s seed] "
+			        "[--stats]\n", argv[0]);
+			return EXIT_FAILURE;
+		}
+	}
+	/* Block 0 only lies outside the first group with 1 KiB blocks */
+	first_data_block = block_size == 1024 ? 1 : 0;
+	size_t max_groups = block_size / sizeof(struct ext2_block_group_descriptor);
+	if (num_groups > max_groups) {
+		fprintf(stderr, "%s: groups must be 1 to %zu\n", argv[0],
+		        max_groups);
+		return EXIT_FAILURE;
+	}
+	if (inode_size > block_size) {
+		fprintf(stderr, "%s: inode size must not exceed the block size\n",
+		        argv[0]);
+		return EXIT_FAILURE;
+	}
+	if (big_entries && !prepare_big_dir()) {
+		fprintf(stderr, "%s: %" PRIu32 " entries do not fit the first "
+		        "group\n", argv[0], big_entries);
+		return EXIT_FAILURE;
+	}
+	build_time = get_build_time();
+	for (u32 group = 1; group < num_groups; group++) {
+		snprintf(group_dir_names[group], sizeof(group_dir_names[group]),
+		         "group-%u", group);
+	}
+
 	int fd = open("cs111-base.img", O_CREAT | O_WRONLY, 0666);
 	if (fd == -1) {
 		errno_exit("open");
@@ -488,21 +1497,39 @@ int main(int argc, char *argv[]) {
 	if (ftruncate(fd, 0)) {
 		errno_exit("ftruncate");
 	}
-	if (ftruncate(fd, NUM_BLOCKS * BLOCK_SIZE)) {
+	if (ftruncate(fd, BLOCK_OFFSET(num_blocks()))) {
 		errno_exit("ftruncate");
 	}
 
-	write_superblock(fd);
-	write_block_group_descriptor_table(fd);
-	write_block_bitmap(fd);
-	write_inode_bitmap(fd);
-	write_inode_table(fd);
-	write_root_dir_block(fd);
-	write_lost_and_found_dir_block(fd);
-	write_hello_world_file_block(fd);
+	group_summaries[0].free_blocks_count =
+		num_groups > 1 ? GROUP_BLOCKS - first_group_used_blocks()
+		               : num_free_blocks();
+	group_summaries[0].free_inodes_count = NUM_FREE_INODES;
+	group_summaries[0].used_dirs_count = big_entries ? 3 : 2;
+	timed_phase("write_block_bitmap", write_block_bitmap(fd));
+	timed_phase("write_inode_bitmap", write_inode_bitmap(fd));
+	timed_phase("write_inode_table", write_inode_table(fd));
+	timed_phase("write_root_dir_block", write_root_dir_block(fd));
+	timed_phase("write_lost_and_found_dir_block",
+	            write_lost_and_found_dir_block(fd));
+	timed_phase("write_hello_world_file_block",
+	            write_hello_world_file_block(fd));
+	if (big_entries) {
+		timed_phase("write_big_dir", write_big_dir(fd));
+	}
+	if (num_groups > 1) {
+		timed_phase("write_groups", write_groups(fd));
+	}
+
+	timed_phase("write_superblock", write_superblock(fd));
+	timed_phase("write_block_group_descriptor_table",
+	            write_block_group_descriptor_table(fd));
 
 	if (close(fd)) {
 		errno_exit("close");
 	}
+	if (print_stats) {
+		write_stats(monotonic_ns() - begin);
+	}
 	return 0;
 }
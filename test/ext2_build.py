@@ -0,0 +1,748 @@
+#!/usr/bin/env python3
+"""
+Build an ext2 image from a directory tree on the host
+
+File contents go into the image with copy_file_range, falling back to
+sendfile and then to copying between two mmaps, so they never pass through
+a buffer in this process. Holes in sparse files and blocks that are all
+zeros are left unallocated. Everything is laid out in one pass in name
+order: a directory's blocks, then the data of the files in it, each file in
+as few contiguous runs as its indirect blocks allow.
+
+Times newer than SOURCE_DATE_EPOCH are clamped to it when it is set, and
+with --seed the UUID is the one ext2-create --seed gives, so the same tree
+always builds the same image.
+
+Usage: python3 ext2_build.py [-o image] [-b block size] [--size MiB]
+                             [-s seed] source
+"""
+
+import argparse
+import errno
+import mmap
+import os
+import stat
+import struct
+import sys
+import time
+import uuid
+from array import array
+
+from ext2_image import (EXT2_GOOD_OLD_FIRST_INO, EXT2_GOOD_OLD_INODE_SIZE,
+                        EXT2_GOOD_OLD_REV, EXT2_NDIR_BLOCKS, EXT2_ROOT_INO,
+                        EXT2_S_IFDIR, EXT2_S_IFLNK, EXT2_S_IFREG,
+                        EXT2_SUPER_MAGIC, DIR_ENTRY_FMT, GROUP_DESCRIPTOR_FMT,
+                        INODE_FMT, SUPERBLOCK_FMT, SUPERBLOCK_OFFSET,
+                        count_clear_bits)
+
+# Blocks compared with zeros at once before looking at single blocks
+ZERO_SCAN_BLOCKS = 256
+
+# Free space left in an image sized to fit its contents
+SLACK_RATIO = 0.05
+SLACK_BLOCKS = 64
+SLACK_INODES = 16
+
+# Targets up to this long are kept in the inode instead of a block
+FAST_SYMLINK_MAX = 59
+
+MASK64 = (1 << 64) - 1
+
+COPY_METHODS = ('copy_file_range', 'sendfile', 'mmap')
+
+
+def dir_rec_len(name_len):
+    return 8 + ((name_len + 3) & ~3)
+
+
+def _data_segments(fd, size):
+    """(start, end) byte ranges of a file that are not holes"""
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return
+            if e.errno == errno.EINVAL:
+                # No hole reporting here: treat the rest as data
+                yield pos, size
+                return
+            raise
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        pos = end
+
+
+def _add_run(runs, start, count):
+    if runs and runs[-1][0] + runs[-1][1] == start:
+        runs[-1][1] += count
+    else:
+        runs.append([start, count])
+
+
+def data_runs(fd, size, block_size, scan_zeros=True):
+    """[first block, count] runs of a file's blocks that hold anything but
+    zeros. Holes are found with SEEK_DATA; with scan_zeros, blocks that
+    are stored but all zero are found by looking at a read-only mapping."""
+    runs = []
+    view = None
+    if scan_zeros and size:
+        view = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    try:
+        zero_chunk = bytes(ZERO_SCAN_BLOCKS * block_size)
+        zero_block = zero_chunk[:block_size]
+        for start, end in _data_segments(fd, size):
+            first, last = start // block_size, -(-end // block_size)
+            if view is None:
+                _add_run(runs, first, last - first)
+                continue
+            for block in range(first, last, ZERO_SCAN_BLOCKS):
+                count = min(ZERO_SCAN_BLOCKS, last - block)
+                chunk = view[block * block_size:(block + count) * block_size]
+                if chunk == zero_chunk[:len(chunk)]:
+                    continue
+                for i in range(count):
+                    piece = chunk[i * block_size:(i + 1) * block_size]
+                    if piece != zero_block[:len(piece)]:
+                        _add_run(runs, block + i, 1)
+    finally:
+        if view is not None:
+            view.close()
+    return runs
+
+
+def _mmap_copy(src, dst, src_offset, dst_offset, count):
+    """Copy between two mappings, for when the kernel cannot do it alone"""
+    src_base = src_offset - src_offset % mmap.ALLOCATIONGRANULARITY
+    dst_base = dst_offset - dst_offset % mmap.ALLOCATIONGRANULARITY
+    src_skip = src_offset - src_base
+    dst_skip = dst_offset - dst_base
+    with mmap.mmap(src, src_skip + count, prot=mmap.PROT_READ,
+                   offset=src_base) as s, \
+            mmap.mmap(dst, dst_skip + count, offset=dst_base) as d:
+        d[dst_skip:dst_skip + count] = s[src_skip:src_skip + count]
+    return count
+
+
+def copy_range(src, dst, src_offset, dst_offset, count,
+               method='copy_file_range'):
+    """Copy count bytes between two file descriptors. Returns the method
+    that worked, to be passed back in next time."""
+    while count > 0:
+        try:
+            if method == 'copy_file_range':
+                n = os.copy_file_range(src, dst, count, src_offset,
+                                       dst_offset)
+            elif method == 'sendfile':
+                os.lseek(dst, dst_offset, os.SEEK_SET)
+                n = os.sendfile(dst, src, src_offset, count)
+            else:
+                n = _mmap_copy(src, dst, src_offset, dst_offset, count)
+        except (OSError, AttributeError) as e:
+            if method == COPY_METHODS[-1] or \
+                    getattr(e, 'errno', errno.ENOSYS) not in (
+                        errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF):
+                raise
+            method = COPY_METHODS[COPY_METHODS.index(method) + 1]
+            continue
+        if n == 0:
+            raise OSError(errno.EIO, "source file shrank while copying")
+        src_offset += n
+        dst_offset += n
+        count -= n
+    return method
+
+
+def _set_bits(bitmap, start, count):
+    """Set count bits of a bitmap from bit start"""
+    end = start + count
+    while start < end and start % 8:
+        bitmap[start >> 3] |= 1 << (start & 7)
+        start += 1
+    whole = (end - start) // 8
+    bitmap[start >> 3:(start >> 3) + whole] = b'\xff' * whole
+    start += whole * 8
+    while start < end:
+        bitmap[start >> 3] |= 1 << (start & 7)
+        start += 1
+
+
+def pointer_segments(runs, per_block):
+    """Split runs of logical blocks where the pointer block mapping them
+    changes. Yields (start, count, keys), keys naming the pointer blocks
+    needed from the inode down, as ('i',), ('d', a) or ('t', a, b) paths."""
+    ind = EXT2_NDIR_BLOCKS
+    dind = ind + per_block
+    tind = dind + per_block ** 2
+    for start, count in runs:
+        end = start + count
+        while start < end:
+            if start < ind:
+                stop, keys = ind, ()
+            elif start < dind:
+                stop, keys = dind, (('i',),)
+            elif start < tind:
+                a = (start - dind) // per_block
+                stop = dind + (a + 1) * per_block
+                keys = (('d',), ('d', a))
+            else:
+                j = start - tind
+                a, b = j // per_block ** 2, j // per_block % per_block
+                stop = tind + (j // per_block + 1) * per_block
+                keys = (('t',), ('t', a), ('t', a, b))
+            n = min(end, stop) - start
+            yield start, n, keys
+            start += n
+
+
+class Node:
+    """A file, directory or symlink to be written, and where it went"""
+
+    def __init__(self, kind, st, epoch=None):
+        self.kind = kind
+        self.mode = kind | stat.S_IMODE(st.st_mode)
+        self.uid = st.st_uid & 0xFFFF
+        self.gid = st.st_gid & 0xFFFF
+        times = [int(st.st_atime), int(st.st_ctime), int(st.st_mtime)]
+        if epoch is not None:
+            # Nothing newer than the build, as tar --clamp-mtime does
+            times = [min(t, epoch) for t in times]
+        self.atime, self.ctime, self.mtime = (t & 0xFFFFFFFF for t in times)
+        self.size = 0
+        self.links = 0
+        self.ino = 0
+        self.source = None
+        self.target = b''
+        self.entries = []
+        self.runs = []
+        self.block = [0] * 15
+        self.nblocks = 0
+        self.pieces = []
+
+
+def max_inodes(block_size, size_blocks):
+    """Most inodes Layout gives an image of size_blocks blocks room for"""
+    first_data_block = 1 if block_size == 1024 else 0
+    blocks_per_group = 8 * block_size
+    groups = max(1, -(-(size_blocks - first_data_block) // blocks_per_group))
+    return groups * blocks_per_group - SLACK_INODES
+
+
+class Layout:
+    """Geometry of an image with enough room for a given amount of data"""
+
+    def __init__(self, block_size, data_blocks, inodes, size_blocks=None):
+        if block_size not in (1024, 2048, 4096):
+            raise ValueError(f"unsupported block size {block_size}")
+        self.block_size = block_size
+        self.first_data_block = 1 if block_size == 1024 else 0
+        self.blocks_per_group = 8 * block_size
+        self.inodes_per_block = block_size // EXT2_GOOD_OLD_INODE_SIZE
+        align = max(8, self.inodes_per_block)
+        wanted = data_blocks
+        if size_blocks is None:
+            wanted = int(data_blocks * (1 + SLACK_RATIO)) + SLACK_BLOCKS
+
+        groups = 1
+        if size_blocks is not None:
+            # A fixed size fixes the group count too
+            groups = max(1, -(-(size_blocks - self.first_data_block)
+                              // self.blocks_per_group))
+        while True:
+            per_group = -(-(inodes + SLACK_INODES) // groups)
+            self.inodes_per_group = -(-per_group // align) * align
+            if self.inodes_per_group > self.blocks_per_group:
+                if size_blocks is not None:
+                    raise ValueError(f"{inodes} inodes do not fit in "
+                                     f"{groups} groups")
+                groups += 1
+                continue
+            overhead = self.group_overhead(groups)
+            if size_blocks is not None:
+                total = size_blocks
+            else:
+                total = self.first_data_block + groups * overhead + wanted
+            needed = -(-(total - self.first_data_block)
+                       // self.blocks_per_group)
+            if needed <= groups:
+                break
+            groups = needed
+        last = total - self.first_data_block - \
+            (groups - 1) * self.blocks_per_group
+        if last <= overhead:
+            total += overhead + 1 - last
+        self.groups = groups
+        self.blocks_count = total
+        self.inodes_count = groups * self.inodes_per_group
+        self.table_blocks = self.inodes_per_group // self.inodes_per_block
+        capacity = total - self.first_data_block - groups * overhead
+        if capacity < data_blocks:
+            raise ValueError(f"{data_blocks} blocks of data do not fit in "
+                             f"{capacity} free blocks")
+
+    def gdt_blocks(self, groups):
+        return -(-groups * 32 // self.block_size)
+
+    def group_overhead(self, groups):
+        """Superblock, descriptor table, bitmaps and inode table"""
+        return 1 + self.gdt_blocks(groups) + 2 + self.inodes_per_group // \
+            self.inodes_per_block
+
+    def group_first(self, group):
+        return self.first_data_block + group * self.blocks_per_group
+
+    def group_end(self, group):
+        return min(self.group_first(group + 1), self.blocks_count)
+
+    def block_bitmap(self, group):
+        return self.group_first(group) + 1 + self.gdt_blocks(self.groups)
+
+    def inode_bitmap(self, group):
+        return self.block_bitmap(group) + 1
+
+    def inode_table(self, group):
+        return self.block_bitmap(group) + 2
+
+    def data_start(self, group):
+        return self.inode_table(group) + self.table_blocks
+
+
+class Allocator:
+    """Hands out blocks in increasing order, skipping group metadata"""
+
+    def __init__(self, layout):
+        self.layout = layout
+        self.group = 0
+        self.next = layout.data_start(0)
+        # Bit n is block first_data_block + n, as in the on-disk bitmaps
+        self.bitmap = bytearray(layout.groups * layout.block_size)
+        for group in range(layout.groups):
+            self.mark(layout.group_first(group),
+                      layout.data_start(group) - layout.group_first(group))
+        # Past the end of the last group
+        end = layout.blocks_count
+        self.mark(end, layout.group_first(layout.groups) - end)
+
+    def mark(self, start, count):
+        _set_bits(self.bitmap, start - self.layout.first_data_block, count)
+
+    def allocate(self, count):
+        """(start, count) runs totalling count blocks"""
+        pieces = []
+        while count:
+            end = self.layout.group_end(self.group)
+            if self.next >= end:
+                self.group += 1
+                if self.group >= self.layout.groups:
+                    raise ValueError("image is full")
+                self.next = self.layout.data_start(self.group)
+                continue
+            n = min(count, end - self.next)
+            pieces.append((self.next, n))
+            self.mark(self.next, n)
+            self.next += n
+            count -= n
+        return pieces
+
+
+class Builder:
+    """Lays out and writes one image from one source directory"""
+
+    def __init__(self, source, block_size=1024, size_blocks=None,
+                 scan_zeros=True, label=b'', copy_method='copy_file_range',
+                 epoch=None, seed=None, owner=None):
+        self.source = source
+        self.block_size = block_size
+        self.per_block = block_size // 4
+        self.scan_zeros = scan_zeros
+        self.label = label
+        self.epoch = epoch
+        self.seed = seed
+        self.owner = owner
+        self.copy_method = copy_method
+        self.skipped = []
+        self.copied_bytes = 0
+        self.hole_blocks = 0
+        self.nodes = []
+        self.root = self._scan()
+        self.layout = Layout(block_size, self._blocks_needed(),
+                             EXT2_GOOD_OLD_FIRST_INO + len(self.nodes),
+                             size_blocks)
+
+    def _node(self, kind, st):
+        node = Node(kind, st, self.epoch)
+        if self.owner is not None:
+            node.uid, node.gid = self.owner
+        return node
+
+    def _scan(self):
+        root = self._node(EXT2_S_IFDIR, os.stat(self.source))
+        lost_found = self._node(EXT2_S_IFDIR, os.stat(self.source))
+        lost_found.mode = EXT2_S_IFDIR | 0o700
+        root.entries.append((b'lost+found', lost_found))
+        hardlinks = {}
+        pending = [(self.source, root)]
+        while pending:
+            path, parent = pending.pop()
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: os.fsencode(e.name))
+            subdirs = []
+            for entry in entries:
+                name = os.fsencode(entry.name)
+                if len(name) > 255:
+                    self.skipped.append((entry.path, "name too long"))
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                if parent is root and name == b'lost+found':
+                    # What the source keeps there goes into the one the
+                    # image already has
+                    if stat.S_ISDIR(st.st_mode):
+                        subdirs.append((entry.path, lost_found))
+                    else:
+                        self.skipped.append((entry.path, "lost+found is not "
+                                                         "a directory"))
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    node = self._node(EXT2_S_IFDIR, st)
+                    subdirs.append((entry.path, node))
+                elif stat.S_ISLNK(st.st_mode):
+                    node = self._node(EXT2_S_IFLNK, st)
+                    node.target = os.fsencode(os.readlink(entry.path))
+                    node.size = len(node.target)
+                    if node.size >= self.block_size:
+                        self.skipped.append((entry.path, "target too long"))
+                        continue
+                elif stat.S_ISREG(st.st_mode):
+                    key = (st.st_dev, st.st_ino)
+                    if st.st_nlink > 1 and key in hardlinks:
+                        parent.entries.append((name, hardlinks[key]))
+                        continue
+                    node = self._node(EXT2_S_IFREG, st)
+                    node.source = entry.path
+                    node.size = st.st_size
+                    hardlinks[key] = node
+                else:
+                    self.skipped.append((entry.path, "not a regular file, "
+                                                     "directory or symlink"))
+                    continue
+                parent.entries.append((name, node))
+            # Visit subdirectories in name order
+            pending.extend(reversed(subdirs))
+        return root
+
+    def _order(self):
+        """Every node once, in allocation order: a directory, then what it
+        holds, depth first in name order"""
+        seen = set()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if id(node) in seen:
+                continue
+            seen.add(id(node))
+            yield node
+            stack.extend(child for _, child in reversed(node.entries))
+
+    def _dir_blocks(self, node, parent):
+        """Entries of a directory split into blocks"""
+        blocks = [[]]
+        used = 0
+        for name, child in [(b'.', node), (b'..', parent)] + node.entries:
+            rec_len = dir_rec_len(len(name))
+            if used + rec_len > self.block_size:
+                blocks.append([])
+                used = 0
+            blocks[-1].append((name, child))
+            used += rec_len
+        return blocks
+
+    def _blocks_needed(self):
+        """Count nodes and the blocks they need, finding file holes"""
+        total = 0
+        for node in self._order():
+            self.nodes.append(node)
+            if node.kind == EXT2_S_IFDIR:
+                node.size = len(self._dir_blocks(node, node)) * self.block_size
+                node.runs = [[0, node.size // self.block_size]]
+            elif node.kind == EXT2_S_IFLNK:
+                if node.size > FAST_SYMLINK_MAX:
+                    node.runs = [[0, -(-node.size // self.block_size)]]
+            else:
+                fd = os.open(node.source, os.O_RDONLY)
+                try:
+                    node.runs = data_runs(fd, node.size, self.block_size,
+                                          self.scan_zeros)
+                finally:
+                    os.close(fd)
+                stored = sum(count for _, count in node.runs)
+                self.hole_blocks += -(-node.size // self.block_size) - stored
+            keys = set()
+            for _, count, path in pointer_segments(node.runs,
+                                                    self.per_block):
+                keys.update(path)
+                total += count
+            total += len(keys)
+        return total
+
+    def _allocate(self, node, allocator, pointers):
+        """Allocate node's blocks and fill in its pointers"""
+        owned = {}
+        for start, count, keys in pointer_segments(node.runs,
+                                                    self.per_block):
+            for depth, key in enumerate(keys):
+                if key in owned:
+                    continue
+                (physical, _), = allocator.allocate(1)
+                owned[key] = physical
+                pointers[physical] = array('I', bytes(self.block_size))
+                if depth == 0:
+                    index = {'i': EXT2_NDIR_BLOCKS, 'd': EXT2_NDIR_BLOCKS + 1,
+                             't': EXT2_NDIR_BLOCKS + 2}[key[0]]
+                    node.block[index] = physical
+                else:
+                    pointers[owned[keys[depth - 1]]][key[-1]] = physical
+                node.nblocks += 1
+            logical = start
+            for physical, n in allocator.allocate(count):
+                node.pieces.append((logical, physical, n))
+                if not keys:
+                    node.block[logical:logical + n] = range(physical,
+                                                            physical + n)
+                else:
+                    offset = self._pointer_index(logical)
+                    pointers[owned[keys[-1]]][offset:offset + n] = \
+                        array('I', range(physical, physical + n))
+                logical += n
+            node.nblocks += count
+
+    def _pointer_index(self, logical):
+        """Slot of logical in the pointer block that maps it directly"""
+        return (logical - EXT2_NDIR_BLOCKS) % self.per_block
+
+    def write(self, out_path):
+        layout = self.layout
+        bs = self.block_size
+        allocator = Allocator(layout)
+        pointers = {}
+        next_ino = EXT2_GOOD_OLD_FIRST_INO
+        for node in self.nodes:
+            if node is self.root:
+                node.ino = EXT2_ROOT_INO
+            else:
+                node.ino = next_ino
+                next_ino += 1
+            self._allocate(node, allocator, pointers)
+
+        fd = os.open(out_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, layout.blocks_count * bs)
+            self._write_contents(fd, pointers)
+            self._write_metadata(fd, allocator.bitmap)
+        finally:
+            os.close(fd)
+
+    def _write_contents(self, fd, pointers):
+        bs = self.block_size
+        parents = {id(self.root): self.root}
+        for node in self.nodes:
+            for _, child in node.entries:
+                if child.kind == EXT2_S_IFDIR:
+                    parents[id(child)] = node
+        for node in self.nodes:
+            if node.kind == EXT2_S_IFDIR:
+                data = bytearray()
+                for entries in self._dir_blocks(node, parents[id(node)]):
+                    block = bytearray(bs)
+                    offset = 0
+                    for i, (name, child) in enumerate(entries):
+                        rec_len = dir_rec_len(len(name))
+                        if i == len(entries) - 1:
+                            rec_len = bs - offset
+                        DIR_ENTRY_FMT.pack_into(block, offset, child.ino,
+                                                rec_len, len(name))
+                        block[offset + 8:offset + 8 + len(name)] = name
+                        offset += rec_len
+                    data += block
+                self._write_pieces(fd, node, data)
+            elif node.kind == EXT2_S_IFLNK:
+                if node.pieces:
+                    self._write_pieces(fd, node, node.target)
+            elif node.pieces:
+                src = os.open(node.source, os.O_RDONLY)
+                try:
+                    for logical, physical, count in node.pieces:
+                        length = min(count * bs, node.size - logical * bs)
+                        self.copy_method = copy_range(
+                            src, fd, logical * bs, physical * bs, length,
+                            self.copy_method)
+                        self.copied_bytes += length
+                finally:
+                    os.close(src)
+        for physical, table in sorted(pointers.items()):
+            os.pwrite(fd, table.tobytes(), physical * bs)
+
+    def _write_pieces(self, fd, node, data):
+        bs = self.block_size
+        for logical, physical, count in node.pieces:
+            os.pwrite(fd, data[logical * bs:(logical + count) * bs],
+                      physical * bs)
+
+    def _links(self):
+        links = {id(node): 0 for node in self.nodes}
+        links[id(self.root)] = 1
+        for node in self.nodes:
+            if node.kind == EXT2_S_IFDIR:
+                links[id(node)] += 1
+            for _, child in node.entries:
+                links[id(child)] += 1
+                if child.kind == EXT2_S_IFDIR:
+                    links[id(node)] += 1
+        return links
+
+    def _write_metadata(self, fd, block_bitmap):
+        layout = self.layout
+        bs = self.block_size
+        ipg = layout.inodes_per_group
+        links = self._links()
+
+        tables = [bytearray(layout.table_blocks * bs)
+                  for _ in range(layout.groups)]
+        inode_bitmap = bytearray(layout.groups * bs)
+        for group in range(layout.groups):
+            # Bits past the last inode of each group are set
+            _set_bits(inode_bitmap, group * bs * 8 + ipg, bs * 8 - ipg)
+        # The reserved inodes may spill out of a small first group
+        for ino in range(1, EXT2_GOOD_OLD_FIRST_INO):
+            group, index = divmod(ino - 1, ipg)
+            _set_bits(inode_bitmap, group * bs * 8 + index, 1)
+        used_dirs = [0] * layout.groups
+        for node in self.nodes:
+            group, index = divmod(node.ino - 1, ipg)
+            _set_bits(inode_bitmap, group * bs * 8 + index, 1)
+            if node.kind == EXT2_S_IFDIR:
+                used_dirs[group] += 1
+            block = node.block
+            if node.kind == EXT2_S_IFLNK and not node.pieces:
+                block = struct.unpack('<15I', node.target.ljust(60, b'\0'))
+            INODE_FMT.pack_into(
+                tables[group], index * EXT2_GOOD_OLD_INODE_SIZE, node.mode,
+                node.uid, node.size, node.atime, node.ctime, node.mtime, 0,
+                node.gid, links[id(node)], node.nblocks * (bs // 512), 0,
+                *block)
+
+        descriptors = bytearray(layout.gdt_blocks(layout.groups) * bs)
+        free_blocks = free_inodes = 0
+        for group in range(layout.groups):
+            first = layout.group_first(group)
+            bits = block_bitmap[group * bs:(group + 1) * bs]
+            ibits = inode_bitmap[group * bs:(group + 1) * bs]
+            group_free_blocks = count_clear_bits(
+                bits, layout.group_end(group) - first)
+            group_free_inodes = count_clear_bits(ibits, ipg)
+            free_blocks += group_free_blocks
+            free_inodes += group_free_inodes
+            GROUP_DESCRIPTOR_FMT.pack_into(
+                descriptors, group * 32, layout.block_bitmap(group),
+                layout.inode_bitmap(group), layout.inode_table(group),
+                group_free_blocks, group_free_inodes, used_dirs[group])
+            os.pwrite(fd, bits, layout.block_bitmap(group) * bs)
+            os.pwrite(fd, ibits, layout.inode_bitmap(group) * bs)
+            os.pwrite(fd, tables[group], layout.inode_table(group) * bs)
+
+        now = int(time.time()) if self.epoch is None else self.epoch
+        fs_uuid = uuid.uuid4() if self.seed is None else \
+            uuid_from_seed(self.seed)
+        superblock = bytearray(1024)
+        SUPERBLOCK_FMT.pack_into(
+            superblock, 0, layout.inodes_count, layout.blocks_count, 0,
+            free_blocks, free_inodes, layout.first_data_block,
+            bs.bit_length() - 11, bs.bit_length() - 11,
+            layout.blocks_per_group, layout.blocks_per_group, ipg, 0, now, 0,
+            -1, EXT2_SUPER_MAGIC, 1, 1, 0, now, 0, 0, EXT2_GOOD_OLD_REV, 0,
+            0, 0, 0, 0, 0, 0, 0, fs_uuid.bytes, self.label[:16])
+        for group in range(layout.groups):
+            first = layout.group_first(group)
+            if group == 0:
+                os.pwrite(fd, superblock, SUPERBLOCK_OFFSET)
+            else:
+                os.pwrite(fd, superblock, first * bs)
+            os.pwrite(fd, descriptors, (first + 1) * bs)
+
+
+def _splitmix64(state):
+    state = (state + 0x9E3779B97F4A7C15) & MASK64
+    z = state
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return state, z ^ (z >> 31)
+
+
+def uuid_from_seed(seed):
+    """The version 4 UUID ext2-create --seed derives from seed"""
+    state, first = _splitmix64(seed & MASK64)
+    _, second = _splitmix64(state)
+    raw = bytearray(first.to_bytes(8, 'little') + second.to_bytes(8, 'little'))
+    raw[6] = (raw[6] & 0x0F) | 0x40
+    raw[8] = (raw[8] & 0x3F) | 0x80
+    return uuid.UUID(bytes=bytes(raw))
+
+
+def source_date_epoch():
+    """SOURCE_DATE_EPOCH from the environment, or None"""
+    value = os.environ.get('SOURCE_DATE_EPOCH')
+    if value is None:
+        return None
+    if not value.isdigit() or int(value) > 0xFFFFFFFF:
+        raise ValueError("SOURCE_DATE_EPOCH must be a time between 0 and "
+                         f"{0xFFFFFFFF}")
+    return int(value)
+
+
+def build(source, out_path, **options):
+    """Build an image of source at out_path and return the Builder"""
+    builder = Builder(source, **options)
+    builder.write(out_path)
+    return builder
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source')
+    parser.add_argument('-o', '--output', default='cs111-base.img')
+    parser.add_argument('-b', '--block-size', type=int, default=1024,
+                        choices=(1024, 2048, 4096))
+    parser.add_argument('--size', type=int, metavar='MiB',
+                        help="image size (default: just enough)")
+    parser.add_argument('-L', '--label', default='')
+    parser.add_argument('--no-zero-scan', action='store_true',
+                        help="only treat real holes as holes")
+    parser.add_argument('-s', '--seed', type=lambda s: int(s, 0),
+                        help="derive the UUID from this instead of at random")
+    parser.add_argument('--owner', metavar='UID:GID',
+                        type=lambda s: tuple(int(n) for n in s.split(':')),
+                        help="own every file by this instead of the host's")
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    size_blocks = None
+    if args.size is not None:
+        size_blocks = args.size * (1 << 20) // args.block_size
+    builder = build(args.source, args.output, block_size=args.block_size,
+                    size_blocks=size_blocks,
+                    scan_zeros=not args.no_zero_scan,
+                    label=os.fsencode(args.label),
+                    epoch=source_date_epoch(), seed=args.seed,
+                    owner=args.owner)
+    elapsed = time.monotonic() - start
+    for path, reason in builder.skipped:
+        print(f"skipped {path}: {reason}", file=sys.stderr)
+    print(f"{len(builder.nodes)} inodes, {builder.copied_bytes} bytes copied "
+          f"with {builder.copy_method}, {builder.hole_blocks} blocks left as "
+          f"holes, {elapsed:.2f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Structure-aware mutation fuzzer for the image checkers
+
+The checkers are the per-group scan and tree walk run in process, the
+checks of check_common_mistakes.py run on the mutant's bytes, and the tests
+of test_edge_cases.py run against the mutant through a memfd. A failed
+assertion in those tests is a problem found, like an Ext2Error elsewhere.
+Each mutant is the base image with one structure corrupted in place: a
+directory rec_len, a bitmap bit, an inode's link count or block pointer, the
+free block count or the magic number. The checkers run straight against the
+in-memory buffer, which is restored before the next mutant, so nothing is
+written to disk. A checker that raises anything but Ext2Error has crashed,
+one that runs past the time limit has hung. When e2fsck is installed, a
+sample of mutants is also given to it through a memfd and any disagreement
+about whether the image changed is reported.
+
+Usage: python3 ext2_fuzz.py [-n mutants] [-s seed] [--e2fsck-every N] [image]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import time
+import traceback
+import unittest
+from collections import Counter, namedtuple
+
+from check_common_mistakes import check_image
+
+from ext2_image import (EXT2_S_IFDIR, EXT2_S_IFMT, SUPERBLOCK_OFFSET,
+                        BufferImage, Ext2Error, tree_problems)
+from ext2_scan import image_layout, merge, scan_group
+from test_edge_cases import TestExt2EdgeCases
+
+Mutation = namedtuple('Mutation', ['kind', 'offset', 'data', 'description'])
+
+Finding = namedtuple('Finding', ['index', 'kind', 'checker', 'description',
+                                 'detail'])
+
+
+class CheckerTimeout(Exception):
+    """Raised inside a checker that has run past its time limit"""
+
+
+def check_groups(buffer):
+    """Per-group consistency of the bitmaps, inode tables and descriptors"""
+    img = BufferImage(buffer)
+    try:
+        layout = image_layout(img)
+        scans = [scan_group(buffer, layout, g) for g in range(img.group_count)]
+        return merge(img.superblock, scans).anomalies
+    finally:
+        img.close()
+
+
+def check_tree(buffer):
+    """Walk the tree, checking every block a file uses and every link count"""
+    img = BufferImage(buffer)
+    try:
+        return tree_problems(img)
+    finally:
+        img.close()
+
+
+def check_mistakes(buffer):
+    """The errors and warnings check_common_mistakes.py prints"""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        check_image(bytes(buffer))
+    return [line.strip() for line in out.getvalue().splitlines()
+            if 'ERROR' in line or 'WARNING' in line]
+
+
+def check_edge_cases(buffer):
+    """The failed assertions of test_edge_cases.py, run against the image
+    through a memfd"""
+    fd = os.memfd_create('ext2-edge-cases')
+    problems = []
+    with os.fdopen(fd, 'w+b') as f:
+        f.write(buffer)
+        f.flush()
+        for name in unittest.TestLoader().getTestCaseNames(
+                TestExt2EdgeCases):
+            case = TestExt2EdgeCases(name)
+            case.img_fd = f
+            try:
+                getattr(case, name)()
+            except AssertionError as e:
+                problems.append(f"{name}: {str(e).splitlines()[0]}")
+    return problems
+
+
+CHECKERS = {'groups': check_groups, 'tree': check_tree,
+            'mistakes': check_mistakes, 'edge_cases': check_edge_cases}
+
+
+class Targets:
+    """Offsets in the base image worth mutating"""
+
+    def __init__(self, buffer):
+        img = BufferImage(buffer)
+        try:
+            self.block_size = img.block_size
+            self.blocks_count = img.superblock.blocks_count
+            self.bitmaps = []
+            for desc in img.group_descriptors:
+                self.bitmaps.append(desc.block_bitmap)
+                self.bitmaps.append(desc.inode_bitmap)
+            self.inodes = []
+            self.rec_lens = []
+            for _, inode in img.walk():
+                self.inodes.append(img.inode_offset(inode.ino))
+                if (inode.mode & EXT2_S_IFMT) != EXT2_S_IFDIR:
+                    continue
+                for block in img.data_blocks(inode):
+                    if block == 0:
+                        continue
+                    start = block * img.block_size
+                    offset = 0
+                    for entry in img.dir_block_entries(img.read_block(block)):
+                        self.rec_lens.append(start + offset + 4)
+                        offset += entry.rec_len
+        finally:
+            img.close()
+
+
+def mutate_rec_len(rng, buffer, targets):
+    offset = rng.choice(targets.rec_lens)
+    old = struct.unpack_from('<H', buffer, offset)[0]
+    new = rng.choice([0, 1, 4, 8, old + 1, old - 4, old + 4, old * 2,
+                      targets.block_size, 0xFFFF, rng.randrange(0x10000)])
+    return Mutation('rec_len', offset, struct.pack('<H', new & 0xFFFF),
+                    f"rec_len at {offset} {old} -> {new & 0xFFFF}")
+
+
+def mutate_bitmap_bit(rng, buffer, targets):
+    block = rng.choice(targets.bitmaps)
+    # Most allocations are near the start of a bitmap
+    byte = min(int(rng.expovariate(1 / 8)), targets.block_size - 1)
+    offset = block * targets.block_size + byte
+    bit = rng.randrange(8)
+    return Mutation('bitmap', offset, bytes([buffer[offset] ^ (1 << bit)]),
+                    f"flip bit {bit} of byte {byte} in bitmap block {block}")
+
+
+def mutate_links_count(rng, buffer, targets):
+    offset = rng.choice(targets.inodes) + 26
+    old = struct.unpack_from('<H', buffer, offset)[0]
+    new = rng.choice([0, 1, old - 1, old + 1, 0xFFFF])
+    return Mutation('links_count', offset, struct.pack('<H', new & 0xFFFF),
+                    f"i_links_count at {offset} {old} -> {new & 0xFFFF}")
+
+
+def mutate_free_blocks(rng, buffer, targets):
+    offset = SUPERBLOCK_OFFSET + 12
+    old = struct.unpack_from('<I', buffer, offset)[0]
+    new = rng.choice([0, old - 1, old + 1, targets.blocks_count,
+                      0xFFFFFFFF, rng.randrange(1 << 32)]) & 0xFFFFFFFF
+    return Mutation('free_blocks', offset, struct.pack('<I', new),
+                    f"s_free_blocks_count {old} -> {new}")
+
+
+def mutate_block_pointer(rng, buffer, targets):
+    index = rng.randrange(15)
+    offset = rng.choice(targets.inodes) + 40 + index * 4
+    old = struct.unpack_from('<I', buffer, offset)[0]
+    new = rng.choice([0, 1, 2, old + 1, targets.blocks_count - 1,
+                      targets.blocks_count, 0xFFFFFFFF,
+                      rng.randrange(targets.blocks_count)])
+    return Mutation('block_pointer', offset, struct.pack('<I', new),
+                    f"i_block[{index}] at {offset} {old} -> {new}")
+
+
+def mutate_magic(rng, buffer, targets):
+    offset = SUPERBLOCK_OFFSET + 56
+    old = struct.unpack_from('<H', buffer, offset)[0]
+    new = rng.choice([old ^ (1 << rng.randrange(16)), 0, 0x53EF,
+                      rng.randrange(0x10000)])
+    return Mutation('magic', offset, struct.pack('<H', new),
+                    f"s_magic 0x{old:04x} -> 0x{new:04x}")
+
+
+MUTATORS = [mutate_rec_len, mutate_bitmap_bit, mutate_links_count,
+            mutate_free_blocks, mutate_block_pointer, mutate_magic]
+
+
+def _alarm(signum, frame):
+    raise CheckerTimeout()
+
+
+def run_checker(checker, buffer, timeout):
+    """('ok', problems), ('rejected', message), ('crash', traceback) or
+    ('hang', None)"""
+    previous = signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return 'ok', checker(buffer)
+    except CheckerTimeout:
+        return 'hang', None
+    except Ext2Error as e:
+        return 'rejected', str(e)
+    except Exception:
+        return 'crash', traceback.format_exc(limit=-3)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+class E2fsck:
+    """Runs e2fsck on in-memory images passed through a memfd"""
+
+    def __init__(self):
+        self.fd = os.memfd_create('ext2-fuzz')
+        self.path = f'/proc/{os.getpid()}/fd/{self.fd}'
+
+    def close(self):
+        os.close(self.fd)
+
+    def problems(self, buffer):
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, buffer, 0)
+        result = subprocess.run(['e2fsck', '-f', '-n', self.path],
+                                capture_output=True, text=True, timeout=30)
+        # The problems, without the pass headers and the usage summary
+        return [line for line in (result.stdout + result.stderr).splitlines()
+                if line and not line.startswith(('Pass ', 'e2fsck '))
+                and '/proc/' not in line]
+
+
+def mutant_rng(seed, index):
+    return random.Random(f'{seed}:{index}')
+
+
+def make_mutation(seed, index, buffer, targets):
+    """The mutation for mutant index, reproducible from the seed"""
+    rng = mutant_rng(seed, index)
+    return rng.choice(MUTATORS)(rng, buffer, targets)
+
+
+def fuzz(base, count, seed=0, timeout=1.0, checkers=CHECKERS,
+         e2fsck_every=0):
+    """Fuzz the checkers with count mutants of base, an image in memory.
+    Returns (outcome counts per checker, findings)."""
+    buffer = bytearray(base)
+    targets = Targets(buffer)
+    baseline = {}
+    for name, checker in checkers.items():
+        status, result = run_checker(checker, buffer, timeout)
+        if status not in ('ok', 'rejected'):
+            raise RuntimeError(f"checker {name} fails on the base image")
+        baseline[name] = (status, result)
+
+    e2fsck = None
+    if e2fsck_every and shutil.which('e2fsck'):
+        e2fsck = E2fsck()
+        e2fsck_baseline = e2fsck.problems(buffer)
+
+    outcomes = {name: Counter() for name in checkers}
+    findings = []
+    try:
+        for index in range(count):
+            mutation = make_mutation(seed, index, buffer, targets)
+            end = mutation.offset + len(mutation.data)
+            original = bytes(buffer[mutation.offset:end])
+            buffer[mutation.offset:end] = mutation.data
+            try:
+                changed = False
+                for name, checker in checkers.items():
+                    status, result = run_checker(checker, buffer, timeout)
+                    outcomes[name][status] += 1
+                    if status in ('crash', 'hang'):
+                        findings.append(Finding(index, status, name,
+                                                mutation.description, result))
+                    elif (status, result) != baseline[name]:
+                        changed = True
+                if e2fsck is not None and index % e2fsck_every == 0:
+                    fsck_changed = e2fsck.problems(buffer) != e2fsck_baseline
+                    if fsck_changed != changed:
+                        detail = ("only e2fsck" if fsck_changed
+                                  else "only the checkers")
+                        findings.append(Finding(index, 'disagreement', 'e2fsck',
+                                                mutation.description,
+                                                f"{detail} saw a problem"))
+            finally:
+                buffer[mutation.offset:end] = original
+    finally:
+        if e2fsck is not None:
+            e2fsck.close()
+    return outcomes, findings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('-n', '--mutants', type=int, default=10000)
+    parser.add_argument('-s', '--seed', default='0')
+    parser.add_argument('-t', '--timeout', type=float, default=1.0,
+                        help="seconds before a checker counts as hung")
+    parser.add_argument('--e2fsck-every', type=int, default=0, metavar='N',
+                        help="also compare every Nth mutant with e2fsck")
+    parser.add_argument('--replay', type=int, metavar='INDEX',
+                        help="only print the mutation of one mutant")
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as f:
+        base = f.read()
+    if args.replay is not None:
+        buffer = bytearray(base)
+        print(make_mutation(args.seed, args.replay, buffer,
+                            Targets(buffer)).description)
+        return 0
+
+    start = time.monotonic()
+    outcomes, findings = fuzz(base, args.mutants, args.seed, args.timeout,
+                              e2fsck_every=args.e2fsck_every)
+    elapsed = time.monotonic() - start
+    print(f"{args.mutants} mutants in {elapsed:.2f}s "
+          f"({args.mutants / elapsed:.0f}/s)")
+    for name, counts in outcomes.items():
+        print(f"  {name}: " + ', '.join(f"{status} {n}" for status, n
+                                        in sorted(counts.items())))
+    for finding in findings:
+        print(f"[{finding.kind.upper()}] mutant {finding.index} "
+              f"({finding.checker}): {finding.description}")
+        if finding.detail:
+            print('    ' + finding.detail.rstrip().replace('\n', '\n    '))
+    failed = any(f.kind in ('crash', 'hang') for f in findings)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,936 @@
+#!/usr/bin/env python3
+"""
+Read-only access to ext2 images without mounting them
+
+Usage: python3 ext2_image.py [-t f|d|l|...] [image] [path]
+"""
+
+import argparse
+import io
+import os
+import stat
+import struct
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+
+BLOCK_SIZE = 1024
+SUPERBLOCK_OFFSET = 1024
+
+EXT2_SUPER_MAGIC = 0xEF53
+EXT2_ROOT_INO = 2
+EXT2_GOOD_OLD_REV = 0
+EXT2_GOOD_OLD_INODE_SIZE = 128
+EXT2_GOOD_OLD_FIRST_INO = 11
+
+EXT2_NDIR_BLOCKS = 12
+EXT2_IND_BLOCK = 12
+EXT2_DIND_BLOCK = 13
+EXT2_TIND_BLOCK = 14
+
+EXT2_S_IFMT = 0xF000
+EXT2_S_IFLNK = 0xA000
+EXT2_S_IFREG = 0x8000
+EXT2_S_IFDIR = 0x4000
+
+# File types kept in directory entries with the filetype feature
+EXT2_FT_UNKNOWN = 0
+EXT2_FT_REG_FILE = 1
+EXT2_FT_DIR = 2
+EXT2_FT_CHRDEV = 3
+EXT2_FT_BLKDEV = 4
+EXT2_FT_FIFO = 5
+EXT2_FT_SOCK = 6
+EXT2_FT_SYMLINK = 7
+
+# The file type of each EXT2_S_IFMT value
+MODE_FILE_TYPES = {
+    EXT2_S_IFREG: EXT2_FT_REG_FILE, EXT2_S_IFDIR: EXT2_FT_DIR,
+    0x2000: EXT2_FT_CHRDEV, 0x6000: EXT2_FT_BLKDEV, 0x1000: EXT2_FT_FIFO,
+    0xC000: EXT2_FT_SOCK, EXT2_S_IFLNK: EXT2_FT_SYMLINK,
+}
+
+# find -type letters for each file type
+TYPE_LETTERS = {
+    'f': EXT2_FT_REG_FILE, 'd': EXT2_FT_DIR, 'c': EXT2_FT_CHRDEV,
+    'b': EXT2_FT_BLKDEV, 'p': EXT2_FT_FIFO, 's': EXT2_FT_SOCK,
+    'l': EXT2_FT_SYMLINK,
+}
+
+EXT2_INDEX_FL = 0x1000
+
+EXT2_FEATURE_COMPAT_DIR_INDEX = 0x0020
+EXT2_FEATURE_INCOMPAT_FILETYPE = 0x0002
+EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER = 0x0001
+
+# Incompatible features this reader understands
+SUPPORTED_INCOMPAT = EXT2_FEATURE_INCOMPAT_FILETYPE
+
+EXT2_FLAGS_UNSIGNED_HASH = 0x0002
+
+EXT2_HASH_LEGACY = 0
+EXT2_HASH_HALF_MD4 = 1
+EXT2_HASH_TEA = 2
+
+Superblock = namedtuple('Superblock', [
+    'inodes_count', 'blocks_count', 'r_blocks_count', 'free_blocks_count',
+    'free_inodes_count', 'first_data_block', 'log_block_size',
+    'log_frag_size', 'blocks_per_group', 'frags_per_group',
+    'inodes_per_group', 'mtime', 'wtime', 'mnt_count', 'max_mnt_count',
+    'magic', 'state', 'errors', 'minor_rev_level', 'lastcheck',
+    'checkinterval', 'creator_os', 'rev_level', 'def_resuid', 'def_resgid',
+    'first_ino', 'inode_size', 'block_group_nr', 'feature_compat',
+    'feature_incompat', 'feature_ro_compat', 'uuid', 'volume_name',
+    'hash_seed', 'def_hash_version', 'flags',
+])
+
+GroupDescriptor = namedtuple('GroupDescriptor', [
+    'block_bitmap', 'inode_bitmap', 'inode_table', 'free_blocks_count',
+    'free_inodes_count', 'used_dirs_count',
+])
+
+Inode = namedtuple('Inode', [
+    'ino', 'mode', 'uid', 'size', 'atime', 'ctime', 'mtime', 'dtime', 'gid',
+    'links_count', 'blocks', 'flags', 'block',
+])
+
+DirEntry = namedtuple('DirEntry', ['inode', 'rec_len', 'name_len', 'name',
+                                   'file_type'])
+
+StatResult = namedtuple('StatResult', [
+    'name', 'ino', 'mode', 'uid', 'gid', 'size', 'atime', 'ctime', 'mtime',
+    'links_count', 'blocks',
+])
+
+SUPERBLOCK_FMT = struct.Struct('<IIIIIIIiIIIIIHhHHHHIIIIHHIHHIII16s16s')
+HASH_SEED_FMT = struct.Struct('<4IB')
+GROUP_DESCRIPTOR_FMT = struct.Struct('<IIIHHH')
+INODE_FMT = struct.Struct('<HHIIIIIHHII4x15I')
+DIR_ENTRY_FMT = struct.Struct('<IHH')
+DX_ROOT_INFO_FMT = struct.Struct('<4xBBBB')
+DX_COUNTLIMIT_FMT = struct.Struct('<HH')
+DX_ENTRY_FMT = struct.Struct('<II')
+
+# dx_nodes between the dx_root and the leaves, without large_dir
+DX_MAX_LEVELS = 1
+
+MASK32 = 0xFFFFFFFF
+
+# Decoded blocks and inodes kept per open image
+CACHE_BLOCKS = 4096
+CACHE_INODES = 4096
+CACHE_STRIPES = 16
+
+# Unwanted blocks worth reading to join two runs into one, and the most
+# blocks fetched by a single read
+READAHEAD_GAP = 8
+READAHEAD_MAX = 256
+
+
+class Ext2Error(Exception):
+    """Raised when an image is not a structurally valid ext2 filesystem"""
+
+
+# Directory hashing, as in e2fsprogs lib/ext2fs/dirhash.c
+
+def _signed_chars(name, unsigned):
+    if unsigned:
+        return list(name)
+    return [c - 256 if c >= 128 else c for c in name]
+
+
+def _dx_hack_hash(name, unsigned):
+    hash0, hash1 = 0x12a3fe2d, 0x37abe8f9
+    for c in _signed_chars(name, unsigned):
+        h = (hash1 + (hash0 ^ (c * 7152373))) & MASK32
+        if h & 0x80000000:
+            h = (h - 0x7fffffff) & MASK32
+        hash1, hash0 = hash0, h
+    return (hash0 << 1) & MASK32
+
+
+def _str2hashbuf(msg, num, unsigned):
+    length = len(msg)
+    pad = length | (length << 8)
+    pad = (pad | (pad << 16)) & MASK32
+    val = pad
+    buf = []
+    for i, c in enumerate(_signed_chars(msg[:num * 4], unsigned)):
+        val = (c + (val << 8)) & MASK32
+        if i % 4 == 3:
+            buf.append(val)
+            val = pad
+    if len(buf) < num:
+        buf.append(val)
+    while len(buf) < num:
+        buf.append(pad)
+    return buf
+
+
+def _rotl(x, s):
+    return ((x << s) | (x >> (32 - s))) & MASK32
+
+
+def _half_md4_transform(buf, data):
+    a, b, c, d = buf
+    k2, k3 = 0o13240474631, 0o15666365641
+
+    def f(x, y, z):
+        return z ^ (x & (y ^ z))
+
+    def g(x, y, z):
+        return ((x & y) + ((x ^ y) & z)) & MASK32
+
+    def h(x, y, z):
+        return x ^ y ^ z
+
+    for fn, k, order, shifts in (
+            (f, 0, (0, 1, 2, 3, 4, 5, 6, 7), (3, 7, 11, 19)),
+            (g, k2, (1, 3, 5, 7, 0, 2, 4, 6), (3, 5, 9, 13)),
+            (h, k3, (3, 7, 2, 6, 1, 5, 0, 4), (3, 9, 11, 15))):
+        for i, idx in enumerate(order):
+            x = (data[idx] + k) & MASK32
+            s = shifts[i % 4]
+            if i % 4 == 0:
+                a = _rotl((a + fn(b, c, d) + x) & MASK32, s)
+            elif i % 4 == 1:
+                d = _rotl((d + fn(a, b, c) + x) & MASK32, s)
+            elif i % 4 == 2:
+                c = _rotl((c + fn(d, a, b) + x) & MASK32, s)
+            else:
+                b = _rotl((b + fn(c, d, a) + x) & MASK32, s)
+    return [(buf[0] + a) & MASK32, (buf[1] + b) & MASK32,
+            (buf[2] + c) & MASK32, (buf[3] + d) & MASK32]
+
+
+def _tea_transform(buf, data):
+    total = 0
+    b0, b1 = buf[0], buf[1]
+    a, b, c, d = data
+    for _ in range(16):
+        total = (total + 0x9E3779B9) & MASK32
+        b0 = (b0 + ((((b1 << 4) + a) & MASK32) ^ ((b1 + total) & MASK32)
+                    ^ (((b1 >> 5) + b) & MASK32))) & MASK32
+        b1 = (b1 + ((((b0 << 4) + c) & MASK32) ^ ((b0 + total) & MASK32)
+                    ^ (((b0 >> 5) + d) & MASK32))) & MASK32
+    return [(buf[0] + b0) & MASK32, (buf[1] + b1) & MASK32, buf[2], buf[3]]
+
+
+def dir_hash(name, version, seed=(0, 0, 0, 0), unsigned=False):
+    """Return the (hash, minor_hash) a dir_index directory files name under"""
+    buf = list(seed) if any(seed) else [
+        0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    minor = 0
+    if version == EXT2_HASH_LEGACY:
+        major = _dx_hack_hash(name, unsigned)
+    elif version == EXT2_HASH_HALF_MD4:
+        for i in range(0, max(len(name), 1), 32):
+            buf = _half_md4_transform(buf, _str2hashbuf(name[i:], 8, unsigned))
+        major, minor = buf[1], buf[2]
+    elif version == EXT2_HASH_TEA:
+        for i in range(0, max(len(name), 1), 16):
+            buf = _tea_transform(buf, _str2hashbuf(name[i:], 4, unsigned))
+        major, minor = buf[0], buf[1]
+    else:
+        raise Ext2Error(f"unknown directory hash version {version}")
+    return major & ~1 & MASK32, minor
+
+
+class StripedCache:
+    """Bounded LRU cache split into independently locked stripes, so threads
+    working on different keys rarely wait on each other. Values are loaded
+    outside the lock; two threads missing on one key may both load it."""
+
+    def __init__(self, capacity, stripes=CACHE_STRIPES):
+        self.stripe_capacity = max(1, capacity // stripes)
+        self.stripes = [(threading.Lock(), OrderedDict())
+                        for _ in range(stripes)]
+
+    def get(self, key, load):
+        lock, entries = self.stripes[hash(key) % len(self.stripes)]
+        with lock:
+            if key in entries:
+                entries.move_to_end(key)
+                return entries[key]
+        value = load(key)
+        with lock:
+            entries[key] = value
+            if len(entries) > self.stripe_capacity:
+                entries.popitem(last=False)
+        return value
+
+    def __contains__(self, key):
+        lock, entries = self.stripes[hash(key) % len(self.stripes)]
+        with lock:
+            return key in entries
+
+    def put(self, key, value):
+        lock, entries = self.stripes[hash(key) % len(self.stripes)]
+        with lock:
+            entries[key] = value
+            entries.move_to_end(key)
+            if len(entries) > self.stripe_capacity:
+                entries.popitem(last=False)
+
+    @property
+    def capacity(self):
+        return self.stripe_capacity * len(self.stripes)
+
+    def clear(self):
+        for lock, entries in self.stripes:
+            with lock:
+                entries.clear()
+
+
+def coalesce(blocks, gap=READAHEAD_GAP, limit=READAHEAD_MAX):
+    """Sort block numbers into (start, count) runs, reading through gaps of
+    up to gap blocks rather than starting a new run"""
+    runs = []
+    for block in sorted(set(blocks)):
+        if runs:
+            start, count = runs[-1]
+            if block - (start + count) <= gap and block - start < limit:
+                runs[-1] = (start, block - start + 1)
+                continue
+        runs.append((block, 1))
+    return runs
+
+
+def count_clear_bits(bitmap, nbits):
+    """Number of zero bits among the first nbits of a bitmap"""
+    used = int.from_bytes(bitmap[:(nbits + 7) // 8], 'little')
+    used &= (1 << nbits) - 1
+    return nbits - bin(used).count('1')
+
+
+def parse_superblock(data):
+    """Decode the 1024 bytes of a superblock"""
+    if len(data) < 1024:
+        raise Ext2Error("image too small to hold a superblock")
+    fields = SUPERBLOCK_FMT.unpack_from(data)
+    seed = HASH_SEED_FMT.unpack_from(data, 236)
+    flags = struct.unpack_from('<I', data, 352)[0]
+    sb = Superblock(*fields, hash_seed=seed[:4], def_hash_version=seed[4],
+                    flags=flags)
+    if sb.magic != EXT2_SUPER_MAGIC:
+        raise Ext2Error(f"bad magic number 0x{sb.magic:04x}")
+    if sb.rev_level != EXT2_GOOD_OLD_REV and \
+            sb.feature_incompat & ~SUPPORTED_INCOMPAT:
+        raise Ext2Error(f"unsupported incompatible features "
+                        f"0x{sb.feature_incompat & ~SUPPORTED_INCOMPAT:x}")
+    return sb
+
+
+class Ext2Image:
+    """An ext2 image opened for reading
+
+    Reads are positional (pread), so there is no shared file offset and one
+    instance can serve many threads at once. With readahead, decoding an
+    inode also prefetches the directory and indirect blocks it points to."""
+
+    def __init__(self, path, cache_blocks=CACHE_BLOCKS,
+                 cache_inodes=CACHE_INODES, readahead=False):
+        self.path = path
+        self.img_fd = open(path, 'rb')
+        try:
+            self._load(cache_blocks, cache_inodes)
+        except BaseException:
+            self.img_fd.close()
+            raise
+        self.readahead = readahead
+
+    def _load(self, cache_blocks, cache_inodes):
+        self.block_cache = StripedCache(cache_blocks)
+        self.inode_cache = StripedCache(cache_inodes)
+        self.readahead = False
+        self.block_size = BLOCK_SIZE
+        self.superblock = self._read_superblock()
+        sb = self.superblock
+        if sb.log_block_size > 6 or sb.blocks_per_group == 0 or \
+                sb.inodes_per_group == 0:
+            raise Ext2Error("superblock geometry is corrupt")
+        self.block_size = BLOCK_SIZE << sb.log_block_size
+        if sb.rev_level == EXT2_GOOD_OLD_REV:
+            self.inode_size = EXT2_GOOD_OLD_INODE_SIZE
+            self.has_filetype = False
+        else:
+            self.inode_size = sb.inode_size
+            self.has_filetype = bool(sb.feature_incompat
+                                     & EXT2_FEATURE_INCOMPAT_FILETYPE)
+        if self.inode_size < EXT2_GOOD_OLD_INODE_SIZE or \
+                self.inode_size > self.block_size or \
+                self.inode_size & (self.inode_size - 1):
+            raise Ext2Error(f"bad inode size {self.inode_size}")
+        self.group_count = -(-(sb.blocks_count - sb.first_data_block)
+                             // sb.blocks_per_group)
+        self.group_descriptors = self._read_group_descriptors()
+
+    def close(self):
+        self.img_fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, offset, size):
+        """Read raw bytes from the image at offset"""
+        return os.pread(self.img_fd.fileno(), size, offset)
+
+    def _load_block(self, block_num):
+        data = self.read(block_num * self.block_size, self.block_size)
+        if len(data) != self.block_size:
+            raise Ext2Error(f"block {block_num} is past the end of the image")
+        return data
+
+    def read_block(self, block_num):
+        """Read a block from the image, through the block cache"""
+        return self.block_cache.get(block_num, self._load_block)
+
+    def advise(self, runs):
+        """Tell the kernel the (start, count) runs will be read soon"""
+        if self.img_fd is None or not hasattr(os, 'posix_fadvise'):
+            return
+        bs = self.block_size
+        for start, count in runs:
+            os.posix_fadvise(self.img_fd.fileno(), start * bs, count * bs,
+                             os.POSIX_FADV_WILLNEED)
+
+    def prefetch(self, blocks):
+        """Load blocks into the block cache with as few reads as possible,
+        keeping to the order given if they do not all fit. Returns the
+        number of reads issued."""
+        wanted = []
+        seen = set()
+        for block in blocks:
+            if block in seen or block in self.block_cache or \
+                    not 0 <= block < self.superblock.blocks_count:
+                continue
+            seen.add(block)
+            wanted.append(block)
+        # Leave room for what the caller is already using
+        runs = coalesce(wanted[:self.block_cache.capacity // 2])
+        self.advise(runs)
+        bs = self.block_size
+        for start, count in runs:
+            data = self.read(start * bs, count * bs)
+            for i in range(len(data) // bs):
+                if start + i in seen:
+                    self.block_cache.put(start + i, data[i * bs:(i + 1) * bs])
+        return len(runs)
+
+    def referenced_blocks(self, inode):
+        """Blocks that reading inode will need first: the directory blocks
+        named directly in it and its indirect blocks"""
+        if self.is_fast_symlink(inode):
+            return []
+        refs = list(inode.block[EXT2_IND_BLOCK:])
+        if (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+            refs.extend(inode.block[:EXT2_NDIR_BLOCKS])
+        return [b for b in refs if b]
+
+    def _read_superblock(self):
+        return parse_superblock(self.read(SUPERBLOCK_OFFSET, 1024))
+
+    def _read_group_descriptors(self):
+        start = self.superblock.first_data_block + 1
+        data = self.read(start * self.block_size, self.group_count * 32)
+        if len(data) != self.group_count * 32:
+            raise Ext2Error("group descriptor table is past the end")
+        return [GroupDescriptor(*GROUP_DESCRIPTOR_FMT.unpack_from(data, i * 32))
+                for i in range(self.group_count)]
+
+    def group_blocks(self, group):
+        """(first block, number of blocks) covered by a block group"""
+        sb = self.superblock
+        first = sb.first_data_block + group * sb.blocks_per_group
+        return first, min(sb.blocks_per_group, sb.blocks_count - first)
+
+    def group_has_super(self, group):
+        """Whether a group starts with a superblock and descriptor table
+        copy: every group, or with sparse_super only groups 0, 1 and powers
+        of 3, 5 and 7"""
+        if group <= 1 or not (self.superblock.feature_ro_compat
+                              & EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER):
+            return True
+        for base in (3, 5, 7):
+            n = base
+            while n < group:
+                n *= base
+            if n == group:
+                return True
+        return False
+
+    def bitmap_free_counts(self, group):
+        """(free blocks, free inodes) of a group according to its bitmaps"""
+        desc = self.group_descriptors[group]
+        _, nblocks = self.group_blocks(group)
+        return (count_clear_bits(self.read_block(desc.block_bitmap), nblocks),
+                count_clear_bits(self.read_block(desc.inode_bitmap),
+                                 self.superblock.inodes_per_group))
+
+    def inode_offset(self, ino):
+        """Byte offset of inode ino in the image"""
+        if not 1 <= ino <= self.superblock.inodes_count:
+            raise Ext2Error(f"inode {ino} out of range")
+        group, index = divmod(ino - 1, self.superblock.inodes_per_group)
+        table = self.group_descriptors[group].inode_table
+        return table * self.block_size + index * self.inode_size
+
+    def _load_inode(self, ino):
+        block, offset = divmod(self.inode_offset(ino), self.block_size)
+        fields = INODE_FMT.unpack_from(self.read_block(block), offset)
+        inode = Inode(ino, *fields[:11], fields[11:])
+        if self.readahead and inode.mode:
+            self.prefetch(self.referenced_blocks(inode))
+        return inode
+
+    def inode(self, ino):
+        """Read and decode inode ino, through the inode cache"""
+        return self.inode_cache.get(ino, self._load_inode)
+
+    def _map_blocks(self, ptr, depth, logical, end):
+        """Runs for the blocks below ptr, a pointer at the given depth of
+        indirection covering logical blocks from logical up to end"""
+        per_block = self.block_size // 4
+        stop = min(end, logical + per_block ** depth)
+        if ptr == 0:
+            yield logical, 0, stop - logical
+        elif depth == 0:
+            yield logical, ptr, 1
+        else:
+            span = per_block ** (depth - 1)
+            pointers = struct.unpack(f'<{per_block}I', self.read_block(ptr))
+            if self.readahead and depth > 1:
+                needed = -(-(stop - logical) // span)
+                self.prefetch(p for p in pointers[:needed] if p)
+            for i, child in enumerate(pointers):
+                start = logical + i * span
+                if start >= stop:
+                    break
+                yield from self._map_blocks(child, depth - 1, start, stop)
+
+    def iter_extents(self, inode):
+        """Yield (logical, physical, count) runs of contiguous blocks holding
+        inode's data in file order; a physical block of 0 marks a hole"""
+        if self.is_fast_symlink(inode):
+            return
+        end = -(-inode.size // self.block_size)
+        per_block = self.block_size // 4
+        roots = [(ptr, 0, i) for i, ptr in
+                 enumerate(inode.block[:EXT2_NDIR_BLOCKS])]
+        logical = EXT2_NDIR_BLOCKS
+        for depth, index in ((1, EXT2_IND_BLOCK), (2, EXT2_DIND_BLOCK),
+                             (3, EXT2_TIND_BLOCK)):
+            roots.append((inode.block[index], depth, logical))
+            logical += per_block ** depth
+
+        run = None
+        for ptr, depth, logical in roots:
+            if logical >= end:
+                break
+            for start, physical, count in self._map_blocks(ptr, depth,
+                                                           logical, end):
+                if run is not None and (
+                        (physical == 0 and run[1] == 0)
+                        or (physical != 0 and run[1] != 0
+                            and physical == run[1] + run[2])):
+                    run[2] += count
+                    continue
+                if run is not None:
+                    yield tuple(run)
+                run = [start, physical, count]
+        if run is not None:
+            yield tuple(run)
+
+    def logical_block(self, inode, logical):
+        """Block number holding logical block n of inode's data (0 for a
+        hole), reading only the indirect blocks on the way to it"""
+        if not 0 <= logical < -(-inode.size // self.block_size):
+            raise Ext2Error(f"block {logical} is past the end of inode "
+                            f"{inode.ino}")
+        if logical < EXT2_NDIR_BLOCKS:
+            return inode.block[logical]
+        per_block = self.block_size // 4
+        logical -= EXT2_NDIR_BLOCKS
+        for depth, index in ((1, EXT2_IND_BLOCK), (2, EXT2_DIND_BLOCK),
+                             (3, EXT2_TIND_BLOCK)):
+            if logical >= per_block ** depth:
+                logical -= per_block ** depth
+                continue
+            ptr = inode.block[index]
+            while depth and ptr:
+                depth -= 1
+                i, logical = divmod(logical, per_block ** depth)
+                ptr = struct.unpack_from('<I', self.read_block(ptr), i * 4)[0]
+            return ptr
+        raise Ext2Error(f"block {logical} is past the triple indirect "
+                        f"blocks of inode {inode.ino}")
+
+    def data_blocks(self, inode):
+        """Block numbers holding inode's data in file order (0 for holes)"""
+        out = []
+        for _, physical, count in self.iter_extents(inode):
+            if physical == 0:
+                out.extend([0] * count)
+            else:
+                out.extend(range(physical, physical + count))
+        return out
+
+    def open_file(self, inode):
+        """A binary file object over inode's data that reads whole extents"""
+        return io.BufferedReader(InodeReader(self, inode), 1 << 20)
+
+    def read_symlink(self, inode):
+        """The target of a symlink, stored inline or in a data block"""
+        if self.is_fast_symlink(inode):
+            return struct.pack('<15I', *inode.block)[:inode.size]
+        with self.open_file(inode) as f:
+            return f.read()
+
+    def walk(self, ino=EXT2_ROOT_INO, path=''):
+        """Yield (path, inode) for ino and everything below it, depth first.
+        Only the directories on the current path are kept in memory."""
+        inode = self.inode(ino)
+        yield path or '/', inode
+        stack = []
+        if (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+            stack.append((path, ino, self.iter_dir(ino)))
+        while stack:
+            parent, _, entries = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                continue
+            if entry.name in (b'.', b'..'):
+                continue
+            child = f"{parent}/{entry.name.decode(errors='surrogateescape')}"
+            inode = self.inode(entry.inode)
+            yield child, inode
+            if (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+                if any(entry.inode == ancestor for _, ancestor, _ in stack):
+                    raise Ext2Error(f"directory loop at {child}")
+                stack.append((child, entry.inode, self.iter_dir(entry.inode)))
+
+    @staticmethod
+    def is_fast_symlink(inode):
+        return (inode.mode & EXT2_S_IFMT) == EXT2_S_IFLNK and inode.blocks == 0
+
+    def dir_block_entries(self, data):
+        """Decode the directory entries in one directory block"""
+        offset = 0
+        while offset < len(data):
+            if offset + DIR_ENTRY_FMT.size > len(data):
+                raise Ext2Error(f"truncated directory entry at {offset}")
+            ino, rec_len, name_len = DIR_ENTRY_FMT.unpack_from(data, offset)
+            if rec_len < 8 or rec_len % 4 or offset + rec_len > len(data):
+                raise Ext2Error(f"bad rec_len {rec_len} at offset {offset}")
+            # From revision 1 on the high byte is the file type, or unused
+            # without the filetype feature
+            file_type = EXT2_FT_UNKNOWN
+            if self.superblock.rev_level != EXT2_GOOD_OLD_REV:
+                if self.has_filetype:
+                    file_type = name_len >> 8
+                name_len &= 0xFF
+            if ino != 0 and 8 + name_len > rec_len:
+                raise Ext2Error(f"name overruns rec_len at offset {offset}")
+            name = data[offset + 8:offset + 8 + name_len]
+            yield DirEntry(ino, rec_len, name_len, name, file_type)
+            offset += rec_len
+
+    def iter_dir(self, ino):
+        """Yield the live entries of directory ino by scanning every block"""
+        inode = self.inode(ino)
+        if (inode.mode & EXT2_S_IFMT) != EXT2_S_IFDIR:
+            raise Ext2Error(f"inode {ino} is not a directory")
+        for block_num in self.data_blocks(inode):
+            if block_num == 0:
+                continue
+            for entry in self.dir_block_entries(self.read_block(block_num)):
+                if entry.inode != 0:
+                    yield entry
+
+    def entry_type(self, entry):
+        """EXT2_FT_* type of a directory entry, taken from the entry with
+        the filetype feature and from its inode without it"""
+        if entry.file_type != EXT2_FT_UNKNOWN:
+            return entry.file_type
+        mode = self.inode(entry.inode).mode
+        return MODE_FILE_TYPES.get(mode & EXT2_S_IFMT, EXT2_FT_UNKNOWN)
+
+    def walk_entries(self, ino=EXT2_ROOT_INO, path='', types=None):
+        """Yield (path, entry) for everything below directory ino, depth
+        first, or only entries of the EXT2_FT_* types given. With the
+        filetype feature the entries say which ones are directories, so
+        only the directories' own inodes are read."""
+        stack = [(path, ino, self.iter_dir(ino))]
+        while stack:
+            parent, _, entries = stack[-1]
+            entry = next(entries, None)
+            if entry is None:
+                stack.pop()
+                continue
+            if entry.name in (b'.', b'..'):
+                continue
+            child = f"{parent}/{entry.name.decode(errors='surrogateescape')}"
+            file_type = self.entry_type(entry)
+            if types is None or file_type in types:
+                yield child, entry
+            if file_type == EXT2_FT_DIR:
+                if any(entry.inode == ancestor for _, ancestor, _ in stack):
+                    raise Ext2Error(f"directory loop at {child}")
+                stack.append((child, entry.inode, self.iter_dir(entry.inode)))
+
+    def scandir(self, ino):
+        """Yield a StatResult for each entry of directory ino but . and ..,
+        in inode table order. The entries are collected and sorted by the
+        table block holding their inodes first, so each table block is read
+        and decoded once for all of its entries."""
+        by_block = defaultdict(list)
+        for entry in self.iter_dir(ino):
+            if entry.name in (b'.', b'..'):
+                continue
+            block, offset = divmod(self.inode_offset(entry.inode),
+                                   self.block_size)
+            by_block[block].append((offset, entry))
+        blocks = sorted(by_block)
+        # Fetch as many table blocks at once as the cache can spare
+        window = max(1, self.block_cache.capacity // 2)
+        for i in range(0, len(blocks), window):
+            batch = blocks[i:i + window]
+            self.prefetch(batch)
+            for block in batch:
+                data = self.read_block(block)
+                for offset, entry in sorted(by_block.pop(block),
+                                            key=lambda item: item[0]):
+                    (mode, uid, size, atime, ctime, mtime, _, gid, links,
+                     nblocks) = INODE_FMT.unpack_from(data, offset)[:10]
+                    yield StatResult(entry.name, entry.inode, mode, uid, gid,
+                                     size, atime, ctime, mtime, links,
+                                     nblocks)
+
+    def is_indexed(self, inode):
+        return (bool(inode.flags & EXT2_INDEX_FL)
+                and bool(self.superblock.feature_compat
+                         & EXT2_FEATURE_COMPAT_DIR_INDEX))
+
+    def _dx_block(self, inode, logical):
+        """Logical block of an indexed directory that a dx entry names"""
+        if not 0 <= logical < -(-inode.size // self.block_size):
+            raise Ext2Error(f"dx entry names block {logical}, past the end "
+                            f"of directory {inode.ino}")
+        block = self.logical_block(inode, logical)
+        if block == 0:
+            raise Ext2Error(f"dx entry names hole {logical} of directory "
+                            f"{inode.ino}")
+        return self.read_block(block)
+
+    def _dx_lookup_leaves(self, inode, name):
+        """Logical leaf blocks that may hold name, following the dx index"""
+        root = self._dx_block(inode, 0)
+        # dx_root_info sits after the fake '.' and '..' entries
+        hash_version, info_length, levels, _ = DX_ROOT_INFO_FMT.unpack_from(
+            root, 24)
+        if info_length != DX_ROOT_INFO_FMT.size:
+            raise Ext2Error(f"bad dx_root info length {info_length}")
+        if levels > DX_MAX_LEVELS:
+            raise Ext2Error(f"dx index has {levels} levels of nodes")
+        if self.superblock.flags & EXT2_FLAGS_UNSIGNED_HASH:
+            unsigned = True
+        else:
+            unsigned = False
+        target, _ = dir_hash(name, hash_version,
+                             self.superblock.hash_seed, unsigned)
+
+        node, offset = root, 24 + info_length
+        for level in range(levels + 1):
+            limit, count = DX_COUNTLIMIT_FMT.unpack_from(node, offset)
+            if count == 0 or count > limit or \
+                    offset + limit * DX_ENTRY_FMT.size > len(node):
+                raise Ext2Error("corrupt dx node count")
+            entries = [DX_ENTRY_FMT.unpack_from(node, offset + i * 8)
+                       for i in range(count)]
+            # Entry 0 covers every hash below entry 1's; its hash slot is
+            # the count/limit header
+            pick = 0
+            for i in range(1, count):
+                if entries[i][0] > target:
+                    break
+                pick = i
+            if level == levels:
+                leaves = [entries[pick][1]]
+                # A hash collision may spill into the following leaves
+                for hash_value, block in entries[pick + 1:]:
+                    if hash_value & 1 and hash_value & ~1 == target:
+                        leaves.append(block)
+                    else:
+                        break
+                return leaves
+            node, offset = self._dx_block(inode, entries[pick][1]), 8
+
+    def lookup(self, dir_ino, name):
+        """Inode number of name in directory dir_ino, or None"""
+        if isinstance(name, str):
+            name = name.encode()
+        inode = self.inode(dir_ino)
+        if (inode.mode & EXT2_S_IFMT) != EXT2_S_IFDIR:
+            raise Ext2Error(f"inode {dir_ino} is not a directory")
+        if self.is_indexed(inode) and name not in (b'.', b'..'):
+            # Only the blocks the index leads to are mapped and read
+            for leaf in self._dx_lookup_leaves(inode, name):
+                for entry in self.dir_block_entries(
+                        self._dx_block(inode, leaf)):
+                    if entry.inode != 0 and entry.name == name:
+                        return entry.inode
+            return None
+        for entry in self.iter_dir(dir_ino):
+            if entry.name == name:
+                return entry.inode
+        return None
+
+    def resolve(self, path):
+        """Inode number for an absolute path (symlinks are not followed)"""
+        ino = EXT2_ROOT_INO
+        for part in path.split('/'):
+            if not part:
+                continue
+            found = self.lookup(ino, part)
+            if found is None:
+                raise FileNotFoundError(path)
+            ino = found
+        return ino
+
+
+class BufferImage(Ext2Image):
+    """An ext2 image held in memory, such as a bytearray or an mmap"""
+
+    def __init__(self, buffer, cache_blocks=CACHE_BLOCKS,
+                 cache_inodes=CACHE_INODES):
+        self.path = None
+        self.img_fd = None
+        self.buffer = memoryview(buffer)
+        self._load(cache_blocks, cache_inodes)
+
+    def close(self):
+        self.buffer.release()
+
+    def read(self, offset, size):
+        return bytes(self.buffer[offset:offset + size])
+
+
+class InodeReader(io.RawIOBase):
+    """Raw reader over an inode's data; holes read back as zeros"""
+
+    def __init__(self, img, inode):
+        super().__init__()
+        self.img = img
+        self.size = inode.size
+        self.extents = img.iter_extents(inode)
+        self.extent = None
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        view = memoryview(b).cast('B')
+        remaining = self.size - self.pos
+        if remaining <= 0 or len(view) == 0:
+            return 0
+        bs = self.img.block_size
+        while self.extent is None or \
+                self.pos >= (self.extent[0] + self.extent[2]) * bs:
+            self.extent = next(self.extents)
+        logical, physical, count = self.extent
+        skip = self.pos - logical * bs
+        n = min(len(view), remaining, count * bs - skip)
+        if physical == 0:
+            view[:n] = bytes(n)
+        else:
+            view[:n] = self.img.read(physical * bs + skip, n)
+        self.pos += n
+        return n
+
+
+def tree_problems(img):
+    """Blocks a file uses out of range, past its end or twice, and link
+    counts that disagree with the tree, for an open image"""
+    sb = img.superblock
+    problems = []
+    links = Counter()
+    inodes = {}
+    owners = {}
+    for path, inode in img.walk():
+        seen = inode.ino in inodes
+        inodes[inode.ino] = inode
+        links[inode.ino] += 1
+        if (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+            # Its own '.', and the '..' of each subdirectory
+            links[inode.ino] += 1
+            for entry in img.iter_dir(inode.ino):
+                if entry.name == b'..':
+                    links[entry.inode] += 1
+                    break
+        if seen:
+            continue
+        if not img.is_fast_symlink(inode):
+            end = -(-inode.size // img.block_size)
+            for i in range(end, 12):
+                if inode.block[i]:
+                    problems.append(f"{path}: i_block[{i}] is set past "
+                                    f"the end of the file")
+        for _, physical, count in img.iter_extents(inode):
+            if physical and not (sb.first_data_block <= physical
+                                 and physical + count <= sb.blocks_count):
+                problems.append(f"{path}: blocks {physical}-"
+                                f"{physical + count - 1} out of range")
+                continue
+            for block in range(physical, physical + count if physical
+                               else 0):
+                if block in owners:
+                    problems.append(f"{path}: block {block} is also used "
+                                    f"by inode {owners[block]}")
+                owners[block] = inode.ino
+    # The root's '..' points at itself
+    links[EXT2_ROOT_INO] -= 1
+    for ino, inode in inodes.items():
+        if inode.links_count != links[ino]:
+            problems.append(f"inode {ino}: i_links_count is "
+                            f"{inode.links_count}, counted {links[ino]}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('path', nargs='?', default='/')
+    parser.add_argument('-t', '--type', choices=sorted(TYPE_LETTERS),
+                        help="list every path below path of this type, "
+                             "like find -type")
+    args = parser.parse_args()
+
+    with Ext2Image(args.image) as img:
+        ino = img.resolve(args.path)
+        inode = img.inode(ino)
+        if args.type:
+            for path, _ in img.walk_entries(
+                    ino, args.path.rstrip('/'), {TYPE_LETTERS[args.type]}):
+                print(path)
+        elif (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+            # Like ls -la, from one pass over the inode table
+            for st in sorted(img.scandir(ino), key=lambda st: st.name):
+                mtime = time.strftime('%Y-%m-%d %H:%M',
+                                      time.localtime(st.mtime))
+                print(f"{st.ino:8d} {stat.filemode(st.mode)} "
+                      f"{st.links_count:3d} {st.uid:5d} {st.gid:5d} "
+                      f"{st.size:10d} {mtime} "
+                      f"{st.name.decode(errors='replace')}")
+        else:
+            print(f"{ino:8d} mode=0o{inode.mode:o} size={inode.size}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
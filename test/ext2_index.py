@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Persistent metadata index kept next to an ext2 image
+
+The first query against an image walks it once and writes <image>.idx, a
+flat little-endian file holding the superblock, per-group free summaries,
+inode records, block extents and a sorted path table. Later queries mmap the
+sidecar and binary search it instead of reparsing the image. The sidecar is
+keyed by the image's size, mtime and a hash of its superblock, and is
+rebuilt whenever any of them change.
+
+Usage: python3 ext2_index.py [-i image] stat PATH
+       python3 ext2_index.py [-i image] ls PATH
+       python3 ext2_index.py [-i image] check
+"""
+
+import argparse
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from collections import namedtuple
+
+from ext2_image import (EXT2_ROOT_INO, EXT2_S_IFDIR, EXT2_S_IFMT,
+                        SUPERBLOCK_OFFSET, Ext2Error, Ext2Image,
+                        parse_superblock)
+
+INDEX_MAGIC = b'E2IX'
+INDEX_VERSION = 1
+
+# magic, version, image size, image mtime (ns), superblock sha256, then the
+# number of groups, inodes, extents, names and the size of the name pool
+HEADER_FMT = struct.Struct('<4sIQq32sIIIII')
+GROUP_FMT = struct.Struct('<IIIIII')
+INODE_FMT = struct.Struct('<IHHHHQIIIIIII')
+EXTENT_FMT = struct.Struct('<III')
+NAME_FMT = struct.Struct('<IHxxI')
+
+GroupSummary = namedtuple('GroupSummary', [
+    'free_blocks_count', 'free_inodes_count', 'used_dirs_count',
+    'bitmap_free_blocks', 'bitmap_free_inodes', 'dirs_found',
+])
+
+InodeRecord = namedtuple('InodeRecord', [
+    'ino', 'mode', 'uid', 'gid', 'links_count', 'size', 'atime', 'ctime',
+    'mtime', 'flags', 'blocks', 'first_extent', 'extent_count',
+])
+
+
+def sidecar_path(image):
+    return image + '.idx'
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def image_key(image):
+    """(size, mtime_ns, superblock sha256) that a sidecar must match"""
+    st = os.stat(image)
+    with open(image, 'rb') as f:
+        f.seek(SUPERBLOCK_OFFSET)
+        digest = hashlib.sha256(f.read(1024)).digest()
+    return st.st_size, st.st_mtime_ns, digest
+
+
+def _name_key(path):
+    """Sort key placing a directory's children next to each other"""
+    parent, _, name = path.rpartition('/')
+    return (parent or '/').encode(errors='surrogateescape') + b'\0' + \
+        name.encode(errors='surrogateescape')
+
+
+def build(image, out_path):
+    """Walk the image once and write its sidecar index to out_path"""
+    # Taken first, so an image rebuilt during the walk leaves a sidecar
+    # that no longer matches it
+    size, mtime_ns, digest = image_key(image)
+    with Ext2Image(image) as img:
+        sb = img.superblock
+        inodes = {}
+        extents = []
+        names = []
+        dirs_found = [0] * img.group_count
+        for path, inode in img.walk():
+            if path != '/':
+                names.append((_name_key(path), inode.ino))
+            if inode.ino in inodes:
+                continue
+            first = len(extents)
+            extents.extend(img.iter_extents(inode))
+            inodes[inode.ino] = (inode, first, len(extents) - first)
+            if (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+                dirs_found[(inode.ino - 1) // sb.inodes_per_group] += 1
+
+        groups = []
+        for g, desc in enumerate(img.group_descriptors):
+            groups.append(GroupSummary(
+                desc.free_blocks_count, desc.free_inodes_count,
+                desc.used_dirs_count, *img.bitmap_free_counts(g),
+                dirs_found[g]))
+        raw_superblock = img.read(SUPERBLOCK_OFFSET, 1024)
+
+    names.sort()
+    pool = bytearray()
+    name_records = []
+    for key, ino in names:
+        name_records.append(NAME_FMT.pack(len(pool), len(key), ino))
+        pool += key
+
+    header = HEADER_FMT.pack(INDEX_MAGIC, INDEX_VERSION, size, mtime_ns,
+                             digest, len(groups), len(inodes), len(extents),
+                             len(names), len(pool))
+    tmp_path = f'{out_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(_align(len(header)), b'\0'))
+        f.write(raw_superblock)
+        for summary in groups:
+            f.write(GROUP_FMT.pack(*summary))
+        for ino in sorted(inodes):
+            inode, first, count = inodes[ino]
+            f.write(INODE_FMT.pack(ino, inode.mode, inode.uid, inode.gid,
+                                   inode.links_count, inode.size, inode.atime,
+                                   inode.ctime, inode.mtime, inode.flags,
+                                   inode.blocks, first, count))
+        for extent in extents:
+            f.write(EXTENT_FMT.pack(*extent))
+        f.write(b''.join(name_records))
+        f.write(pool)
+    # Readers never see a half-written sidecar
+    os.replace(tmp_path, out_path)
+
+
+class MetadataIndex:
+    """Read-only view of a sidecar index, mapped into memory"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.image_size, self.image_mtime_ns,
+         self.superblock_sha256, self.group_count, self.inode_count,
+         self.extent_count, self.name_count,
+         pool_size) = HEADER_FMT.unpack_from(self.map)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            self.map.close()
+            raise ValueError(f"{path} is not a version {INDEX_VERSION} index")
+
+        offset = _align(HEADER_FMT.size)
+        self.superblock = parse_superblock(self.map[offset:offset + 1024])
+        self.groups_offset = offset + 1024
+        self.inodes_offset = self.groups_offset + \
+            self.group_count * GROUP_FMT.size
+        self.extents_offset = self.inodes_offset + \
+            self.inode_count * INODE_FMT.size
+        self.names_offset = self.extents_offset + \
+            self.extent_count * EXTENT_FMT.size
+        self.pool_offset = self.names_offset + self.name_count * NAME_FMT.size
+        if self.pool_offset + pool_size != len(self.map):
+            self.map.close()
+            raise ValueError(f"{path} is truncated")
+
+    @classmethod
+    def open(cls, image, rebuild=True):
+        """The index for image, (re)building the sidecar if it is stale"""
+        path = sidecar_path(image)
+        key = image_key(image)
+        try:
+            index = cls(path)
+            if (index.image_size, index.image_mtime_ns,
+                    index.superblock_sha256) == key:
+                return index
+            index.close()
+        except (OSError, ValueError, struct.error, Ext2Error):
+            pass
+        if not rebuild:
+            return None
+        build(image, path)
+        return cls(path)
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def group(self, group):
+        return GroupSummary(*GROUP_FMT.unpack_from(
+            self.map, self.groups_offset + group * GROUP_FMT.size))
+
+    def groups(self):
+        return [self.group(g) for g in range(self.group_count)]
+
+    def inode(self, ino):
+        """The InodeRecord for ino, or None if it is not reachable"""
+        lo, hi = 0, self.inode_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            record = InodeRecord(*INODE_FMT.unpack_from(
+                self.map, self.inodes_offset + mid * INODE_FMT.size))
+            if record.ino == ino:
+                return record
+            if record.ino < ino:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def extents(self, record):
+        """(logical, physical, count) runs of an inode's data"""
+        start = self.extents_offset + record.first_extent * EXTENT_FMT.size
+        return [EXTENT_FMT.unpack_from(self.map, start + i * EXTENT_FMT.size)
+                for i in range(record.extent_count)]
+
+    def _name(self, i):
+        offset, length, ino = NAME_FMT.unpack_from(
+            self.map, self.names_offset + i * NAME_FMT.size)
+        start = self.pool_offset + offset
+        return self.map[start:start + length], ino
+
+    def _bisect(self, key):
+        lo, hi = 0, self.name_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def resolve(self, path):
+        """Inode number of an absolute path"""
+        path = '/' + path.strip('/')
+        if path == '/':
+            return EXT2_ROOT_INO
+        key = _name_key(path)
+        i = self._bisect(key)
+        if i < self.name_count:
+            found, ino = self._name(i)
+            if found == key:
+                return ino
+        raise FileNotFoundError(path)
+
+    def stat(self, path):
+        return self.inode(self.resolve(path))
+
+    def listdir(self, path):
+        """(name, inode number) of each entry in a directory"""
+        path = '/' + path.strip('/')
+        record = self.stat(path)
+        if (record.mode & EXT2_S_IFMT) != EXT2_S_IFDIR:
+            raise NotADirectoryError(path)
+        prefix = path.encode(errors='surrogateescape') + b'\0'
+        entries = []
+        i = self._bisect(prefix)
+        while i < self.name_count:
+            key, ino = self._name(i)
+            if not key.startswith(prefix):
+                break
+            entries.append((key[len(prefix):].decode(
+                errors='surrogateescape'), ino))
+            i += 1
+        return entries
+
+    def check(self):
+        """Problems with the summary counters, as printable strings"""
+        sb = self.superblock
+        problems = []
+        groups = self.groups()
+        for g, summary in enumerate(groups):
+            if summary.free_blocks_count != summary.bitmap_free_blocks:
+                problems.append(
+                    f"group {g}: bg_free_blocks_count "
+                    f"{summary.free_blocks_count}, bitmap has "
+                    f"{summary.bitmap_free_blocks}")
+            if summary.free_inodes_count != summary.bitmap_free_inodes:
+                problems.append(
+                    f"group {g}: bg_free_inodes_count "
+                    f"{summary.free_inodes_count}, bitmap has "
+                    f"{summary.bitmap_free_inodes}")
+            if summary.used_dirs_count != summary.dirs_found:
+                problems.append(
+                    f"group {g}: bg_used_dirs_count {summary.used_dirs_count},"
+                    f" found {summary.dirs_found} directories")
+        free_blocks = sum(g.free_blocks_count for g in groups)
+        if sb.free_blocks_count != free_blocks:
+            problems.append(f"s_free_blocks_count {sb.free_blocks_count}, "
+                            f"groups have {free_blocks}")
+        free_inodes = sum(g.free_inodes_count for g in groups)
+        if sb.free_inodes_count != free_inodes:
+            problems.append(f"s_free_inodes_count {sb.free_inodes_count}, "
+                            f"groups have {free_inodes}")
+        return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-i', '--image', default='cs111-base.img')
+    parser.add_argument('command', choices=['stat', 'ls', 'check'])
+    parser.add_argument('path', nargs='?', default='/')
+    args = parser.parse_args()
+
+    with MetadataIndex.open(args.image) as index:
+        if args.command == 'stat':
+            record = index.stat(args.path)
+            print(f"{args.path}: inode {record.ino} mode 0o{record.mode:o} "
+                  f"uid {record.uid} gid {record.gid} size {record.size} "
+                  f"links {record.links_count}")
+            for logical, physical, count in index.extents(record):
+                print(f"  blocks {logical}-{logical + count - 1} at "
+                      f"{physical if physical else 'hole'}")
+        elif args.command == 'ls':
+            for name, ino in index.listdir(args.path):
+                print(f"{ino:8d} {name}")
+        else:
+            problems = index.check()
+            for problem in problems:
+                print(problem)
+            return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Report how an ext2 image is laid out for reading, as JSON
+
+One pass over the inode tables, each table block read once, maps every
+file through its indirect blocks and reports:
+
+- extents per file, and a fragmentation score: the share of a file's block
+  boundaries that are breaks, not counting breaks where the file's own
+  indirect blocks sit between two runs (0 is perfect)
+- how far each directory's first block is from its children's inodes and
+  data, in blocks
+- how full each group is
+- a histogram of free extent sizes from the block bitmaps
+
+Only totals and histograms are kept, plus the worst files, so memory does
+not grow with the number of files.
+
+Usage: python3 ext2_layout.py [--top N] [image]
+"""
+
+import argparse
+import heapq
+import json
+import struct
+import sys
+from collections import Counter
+
+from ext2_image import (EXT2_DIND_BLOCK, EXT2_GOOD_OLD_FIRST_INO,
+                        EXT2_GOOD_OLD_REV, EXT2_IND_BLOCK, EXT2_ROOT_INO,
+                        EXT2_S_IFDIR, EXT2_S_IFMT, EXT2_S_IFREG,
+                        EXT2_TIND_BLOCK, INODE_FMT, Ext2Image, Inode)
+
+WORST_FILES = 10
+
+
+def bucket(n):
+    """Power of two histogram label for n"""
+    if n <= 0:
+        return '0'
+    low = 1 << (n.bit_length() - 1)
+    return str(low) if low == 1 else f'{low}-{2 * low - 1}'
+
+
+def histogram(counter):
+    """A Counter of bucket labels in increasing order"""
+    return {label: counter[label]
+            for label in sorted(counter, key=lambda l: int(l.split('-')[0]))}
+
+
+def pointer_blocks(img, inode):
+    """The indirect blocks of inode"""
+    per_block = img.block_size // 4
+    pending = [(inode.block[index], depth) for index, depth in
+               ((EXT2_IND_BLOCK, 1), (EXT2_DIND_BLOCK, 2),
+                (EXT2_TIND_BLOCK, 3)) if inode.block[index]]
+    blocks = set()
+    while pending:
+        ptr, depth = pending.pop()
+        blocks.add(ptr)
+        if depth > 1:
+            pending.extend((child, depth - 1) for child in struct.unpack(
+                f'<{per_block}I', img.read_block(ptr)) if child)
+    return blocks
+
+
+def file_extents(img, inode):
+    """(data blocks, extents, extents counting the file's own indirect
+    blocks and holes as no break)"""
+    pointers = pointer_blocks(img, inode)
+    blocks = extents = joined = 0
+    end = None
+    for _, physical, count in img.iter_extents(inode):
+        if physical == 0:
+            continue
+        blocks += count
+        extents += 1
+        if end is None or not (physical >= end and all(
+                b in pointers for b in range(end, physical))):
+            joined += 1
+        end = physical + count
+    return blocks, extents, joined
+
+
+class Stats:
+    """Running totals, histograms and the worst files"""
+
+    def __init__(self, top):
+        self.top = top
+        self.files = 0
+        self.blocks = 0
+        self.extents = Counter()
+        self.max_extents = 0
+        self.total_extents = 0
+        self.breaks = 0
+        self.boundaries = 0
+        self.fragmented = 0
+        self.worst = []
+        self.dirs = 0
+        self.entries = 0
+        self.same_group = 0
+        self.inode_distance = Counter()
+        self.data_distance = Counter()
+        self.inode_distance_sum = 0
+        self.data_distance_sum = 0
+        self.data_distances = 0
+
+    def add_file(self, ino, blocks, extents, joined):
+        self.files += 1
+        self.blocks += blocks
+        self.extents[bucket(extents)] += 1
+        self.total_extents += extents
+        self.max_extents = max(self.max_extents, extents)
+        if blocks > 1:
+            self.breaks += joined - 1
+            self.boundaries += blocks - 1
+        if joined > 1:
+            self.fragmented += 1
+            item = (joined, extents, ino)
+            if len(self.worst) < self.top:
+                heapq.heappush(self.worst, item)
+            elif self.top:
+                heapq.heappushpop(self.worst, item)
+
+    def add_child(self, dir_block, dir_group, inode_block, child_group,
+                  data_block):
+        self.entries += 1
+        self.same_group += dir_group == child_group
+        distance = abs(inode_block - dir_block)
+        self.inode_distance[bucket(distance)] += 1
+        self.inode_distance_sum += distance
+        if data_block:
+            distance = abs(data_block - dir_block)
+            self.data_distance[bucket(distance)] += 1
+            self.data_distance_sum += distance
+            self.data_distances += 1
+
+
+def free_extents(img):
+    """Histogram, count and largest of the runs of free blocks"""
+    sizes = Counter()
+    count = total = largest = 0
+    run = 0
+    for group in range(img.group_count):
+        _, nblocks = img.group_blocks(group)
+        bitmap = img.read_block(img.group_descriptors[group].block_bitmap)
+        bit = 0
+        while bit < nblocks:
+            byte = bitmap[bit >> 3]
+            if bit & 7 == 0 and bit + 8 <= nblocks and byte in (0, 0xFF):
+                if byte == 0:
+                    run += 8
+                    bit += 8
+                    continue
+                used = True
+                bit += 8
+            else:
+                used = byte & (1 << (bit & 7))
+                bit += 1
+                if not used:
+                    run += 1
+                    continue
+            if run:
+                sizes[bucket(run)] += 1
+                count += 1
+                total += run
+                largest = max(largest, run)
+                run = 0
+    if run:
+        sizes[bucket(run)] += 1
+        count += 1
+        total += run
+        largest = max(largest, run)
+    return {'count': count, 'blocks': total, 'largest': largest,
+            'histogram': histogram(sizes)}
+
+
+def analyze(img, top=WORST_FILES):
+    sb = img.superblock
+    bs = img.block_size
+    ipg = sb.inodes_per_group
+    per_table_block = bs // img.inode_size
+    first_ino = EXT2_GOOD_OLD_FIRST_INO
+    if sb.rev_level != EXT2_GOOD_OLD_REV:
+        first_ino = sb.first_ino
+    stats = Stats(top)
+    groups = []
+
+    for group in range(img.group_count):
+        desc = img.group_descriptors[group]
+        free_blocks, free_inodes = img.bitmap_free_counts(group)
+        _, nblocks = img.group_blocks(group)
+        groups.append({
+            'group': group,
+            'blocks_used': nblocks - free_blocks,
+            'block_fill': round((nblocks - free_blocks) / nblocks, 4),
+            'inodes_used': ipg - free_inodes,
+            'inode_fill': round((ipg - free_inodes) / ipg, 4),
+        })
+        inode_bitmap = img.read_block(desc.inode_bitmap)
+        for index in range(0, ipg, per_table_block):
+            table = img.read_block(desc.inode_table
+                                   + index // per_table_block)
+            for slot in range(min(per_table_block, ipg - index)):
+                n = index + slot
+                if not inode_bitmap[n >> 3] & (1 << (n & 7)):
+                    continue
+                ino = group * ipg + n + 1
+                if ino < first_ino and ino != EXT2_ROOT_INO:
+                    # Reserved, like the resize inode
+                    continue
+                fields = INODE_FMT.unpack_from(table, slot * img.inode_size)
+                inode = Inode(ino, *fields[:11], fields[11:])
+                kind = inode.mode & EXT2_S_IFMT
+                if kind == EXT2_S_IFREG:
+                    blocks, extents, joined = file_extents(img, inode)
+                    stats.add_file(ino, blocks, extents, joined)
+                elif kind == EXT2_S_IFDIR:
+                    _visit_dir(img, inode, stats)
+
+    def distance(counter, total, n):
+        return {'mean': round(total / n, 2) if n else 0,
+                'histogram': histogram(counter)}
+
+    return {
+        'image': img.path,
+        'block_size': bs,
+        'groups': groups,
+        'files': {
+            'count': stats.files,
+            'blocks': stats.blocks,
+            'extents': {
+                'mean': round(stats.total_extents / stats.files, 3)
+                if stats.files else 0,
+                'max': stats.max_extents,
+                'histogram': histogram(stats.extents),
+            },
+            'fragmented': stats.fragmented,
+            'fragmentation_score': round(stats.breaks / stats.boundaries, 6)
+            if stats.boundaries else 0,
+            'worst': [{'ino': ino, 'extents': extents, 'breaks': joined - 1}
+                      for joined, extents, ino in
+                      sorted(stats.worst, reverse=True)],
+        },
+        'directories': {
+            'count': stats.dirs,
+            'entries': stats.entries,
+            'same_group': round(stats.same_group / stats.entries, 4)
+            if stats.entries else 0,
+            'inode_distance': distance(stats.inode_distance,
+                                       stats.inode_distance_sum,
+                                       stats.entries),
+            'data_distance': distance(stats.data_distance,
+                                      stats.data_distance_sum,
+                                      stats.data_distances),
+        },
+        'free_extents': free_extents(img),
+    }
+
+
+def _visit_dir(img, inode, stats):
+    """Measure how far the children of a directory are from its first
+    block. The children's inodes come through the reader's caches."""
+    stats.dirs += 1
+    dir_block = inode.block[0]
+    if not dir_block:
+        return
+    sb = img.superblock
+    dir_group = (dir_block - sb.first_data_block) // sb.blocks_per_group
+    for entry in img.iter_dir(inode.ino):
+        if entry.name in (b'.', b'..'):
+            continue
+        offset = img.inode_offset(entry.inode)
+        child = img.inode(entry.inode)
+        data_block = 0 if img.is_fast_symlink(child) else child.block[0]
+        stats.add_child(dir_block, dir_group, offset // img.block_size,
+                        (entry.inode - 1) // sb.inodes_per_group,
+                        data_block)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('--top', type=int, default=WORST_FILES,
+                        help="how many of the most fragmented files to list")
+    args = parser.parse_args()
+
+    with Ext2Image(args.image) as img:
+        print(json.dumps(analyze(img, args.top), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Repair the bitmaps and free counts of an ext2 image in place
+
+One pass over the inode tables finds the live inodes, and the blocks each
+one owns through its block pointers, which together with each group's own
+metadata give the true allocation state. The directories of live inodes
+are read to report entries naming inodes that are not live. Data blocks
+are never read, so the time taken follows the metadata, not the data.
+
+The bitmap blocks, group descriptors and superblock this state implies are
+compared with the image, and only the blocks that differ are written,
+nearby ones joined into one write. Each change is reported, as are the
+problems this does not repair (blocks claimed twice, pointers out of
+range, dangling entries).
+
+Usage: python3 ext2_repair.py [-n] [image]
+"""
+
+import argparse
+import os
+import struct
+import sys
+from collections import namedtuple
+
+from ext2_image import (EXT2_DIND_BLOCK, EXT2_GOOD_OLD_FIRST_INO,
+                        EXT2_GOOD_OLD_REV, EXT2_IND_BLOCK, EXT2_NDIR_BLOCKS,
+                        EXT2_S_IFDIR, EXT2_S_IFLNK, EXT2_S_IFMT, EXT2_S_IFREG,
+                        EXT2_TIND_BLOCK, INODE_FMT, SUPERBLOCK_OFFSET,
+                        Ext2Error, Ext2Image, Inode, coalesce,
+                        count_clear_bits)
+
+Repair = namedtuple('Repair', ['changes', 'unrepaired', 'blocks', 'writes'])
+
+# Offsets of the counts within the superblock and a group descriptor
+SB_FREE_COUNTS = struct.Struct('<II')
+SB_FREE_COUNTS_OFFSET = 12
+GD_COUNTS = struct.Struct('<HHH')
+GD_COUNTS_OFFSET = 12
+
+# Block numbers listed per bitmap change
+LISTED_BITS = 8
+
+
+def _set_bit(bitmap, n):
+    bitmap[n >> 3] |= 1 << (n & 7)
+
+
+def _bit(bitmap, n):
+    return bitmap[n >> 3] & (1 << (n & 7))
+
+
+def group_metadata(img, group):
+    """Blocks a group's own metadata takes"""
+    bs = img.block_size
+    first, _ = img.group_blocks(group)
+    desc = img.group_descriptors[group]
+    blocks = []
+    if img.group_has_super(group):
+        if first == 0:
+            # The superblock sits in block 0 with the boot sector
+            blocks.append(0)
+            first = 1
+        else:
+            blocks.append(first)
+            first += 1
+        gdt_blocks = -(-img.group_count * 32 // bs)
+        blocks.extend(range(first, first + gdt_blocks))
+    blocks.extend((desc.block_bitmap, desc.inode_bitmap))
+    table_blocks = -(-img.superblock.inodes_per_group * img.inode_size // bs)
+    blocks.extend(range(desc.inode_table, desc.inode_table + table_blocks))
+    return blocks
+
+
+def owned_blocks(img, inode, problems):
+    """Every block inode's pointers reach, indirect blocks included, past
+    the end of the file too. Only the indirect blocks are read."""
+    sb = img.superblock
+    per_block = img.block_size // 4
+
+    def valid(block):
+        if sb.first_data_block <= block < sb.blocks_count:
+            return True
+        problems.append(f"inode {inode.ino}: block {block} is out of range")
+        return False
+
+    pending = [(b, 0) for b in inode.block[:EXT2_NDIR_BLOCKS]]
+    pending += [(inode.block[index], depth) for index, depth in
+                ((EXT2_IND_BLOCK, 1), (EXT2_DIND_BLOCK, 2),
+                 (EXT2_TIND_BLOCK, 3))]
+    while pending:
+        block, depth = pending.pop()
+        if not block or not valid(block):
+            continue
+        yield block
+        if depth:
+            pending.extend((child, depth - 1) for child in struct.unpack(
+                f'<{per_block}I', img.read_block(block)))
+
+
+def _has_blocks(img, inode, first_ino):
+    """Whether inode's block pointers are block numbers"""
+    if inode.ino < first_ino:
+        # Reserved, like the bad blocks and resize inodes
+        return True
+    kind = inode.mode & EXT2_S_IFMT
+    if kind == EXT2_S_IFLNK:
+        return not img.is_fast_symlink(inode)
+    return kind in (EXT2_S_IFREG, EXT2_S_IFDIR)
+
+
+def allocation_state(img):
+    """(block bitmaps, inode bitmaps, directories per group, problems) that
+    the inode tables and group metadata call for"""
+    sb = img.superblock
+    bs = img.block_size
+    ipg = sb.inodes_per_group
+    first_ino = EXT2_GOOD_OLD_FIRST_INO
+    if sb.rev_level != EXT2_GOOD_OLD_REV:
+        first_ino = sb.first_ino
+    table_blocks = -(-ipg * img.inode_size // bs)
+    problems = []
+    block_bitmaps = [bytearray(bs) for _ in range(img.group_count)]
+    inode_bitmaps = [bytearray(bs) for _ in range(img.group_count)]
+    used_dirs = [0] * img.group_count
+
+    def mark(block, owner):
+        group, bit = divmod(block - sb.first_data_block, sb.blocks_per_group)
+        if _bit(block_bitmaps[group], bit):
+            problems.append(f"block {block} of {owner} is claimed twice")
+        _set_bit(block_bitmaps[group], bit)
+
+    for group in range(img.group_count):
+        _, nblocks = img.group_blocks(group)
+        # Padding past the last block and inode is set, as e2fsck expects
+        for bit in range(nblocks, bs * 8):
+            _set_bit(block_bitmaps[group], bit)
+        for bit in range(ipg, bs * 8):
+            _set_bit(inode_bitmaps[group], bit)
+        for block in group_metadata(img, group):
+            mark(block, f"group {group} metadata")
+
+    directories = []
+    for group in range(img.group_count):
+        desc = img.group_descriptors[group]
+        # One read for the group's whole table
+        table = img.read(desc.inode_table * bs, table_blocks * bs)
+        for index in range(ipg):
+            ino = group * ipg + index + 1
+            fields = INODE_FMT.unpack_from(table, index * img.inode_size)
+            inode = Inode(ino, *fields[:11], fields[11:])
+            live = inode.mode != 0 and inode.links_count != 0 and \
+                inode.dtime == 0
+            if not live and ino >= first_ino:
+                continue
+            _set_bit(inode_bitmaps[group], index)
+            if live and (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+                used_dirs[group] += 1
+                directories.append(ino)
+            if _has_blocks(img, inode, first_ino):
+                for block in owned_blocks(img, inode, problems):
+                    mark(block, f"inode {ino}")
+
+    for ino in directories:
+        try:
+            for entry in img.iter_dir(ino):
+                if entry.inode > sb.inodes_count:
+                    live = False
+                else:
+                    group, index = divmod(entry.inode - 1, ipg)
+                    live = _bit(inode_bitmaps[group], index)
+                if not live:
+                    problems.append(
+                        f"directory {ino}: entry "
+                        f"{entry.name.decode(errors='replace')!r} names "
+                        f"inode {entry.inode}, which is not in use")
+        except Ext2Error as e:
+            problems.append(f"directory {ino}: {e}")
+    return block_bitmaps, inode_bitmaps, used_dirs, problems
+
+
+def _describe_bits(what, old, new, nused, base):
+    """Say which bits of a bitmap change, the first nused of which stand
+    for blocks or inodes numbered from base and the rest for padding"""
+    set_bits = [n for n in range(nused) if _bit(new, n) and not _bit(old, n)]
+    cleared = [n for n in range(nused) if _bit(old, n) and not _bit(new, n)]
+    parts = []
+    for verb, bits in (('set', set_bits), ('cleared', cleared)):
+        if bits:
+            listed = ', '.join(str(base + n) for n in bits[:LISTED_BITS])
+            more = ', ...' if len(bits) > LISTED_BITS else ''
+            parts.append(f"{len(bits)} {verb} ({listed}{more})")
+    padding = sum(_bit(new, n) and not _bit(old, n)
+                  for n in range(nused, len(new) * 8))
+    if padding:
+        parts.append(f"{padding} padding bits set")
+    return f"{what}: " + ', '.join(parts)
+
+
+def plan(img):
+    """(blocks to write as {block: data}, changes, unrepaired problems)"""
+    sb = img.superblock
+    bs = img.block_size
+    ipg = sb.inodes_per_group
+    block_bitmaps, inode_bitmaps, used_dirs, problems = allocation_state(img)
+    updates = {}
+    changes = []
+
+    def bitmap(block, new, nused, what, base):
+        old = img.read_block(block)
+        if new != old:
+            updates[block] = bytes(new)
+            changes.append(_describe_bits(what, old, new, nused, base))
+
+    gdt_start = sb.first_data_block + 1
+    gdt = bytearray(img.read(gdt_start * bs, -(-img.group_count * 32 // bs)
+                             * bs))
+    free_blocks = free_inodes = 0
+    for group, desc in enumerate(img.group_descriptors):
+        first, nblocks = img.group_blocks(group)
+        bitmap(desc.block_bitmap, block_bitmaps[group], nblocks,
+               f"group {group} block bitmap, blocks", first)
+        bitmap(desc.inode_bitmap, inode_bitmaps[group], ipg,
+               f"group {group} inode bitmap, inodes", group * ipg + 1)
+        counts = (count_clear_bits(block_bitmaps[group], sb.blocks_per_group),
+                  count_clear_bits(inode_bitmaps[group], ipg),
+                  used_dirs[group])
+        free_blocks += counts[0]
+        free_inodes += counts[1]
+        recorded = (desc.free_blocks_count, desc.free_inodes_count,
+                    desc.used_dirs_count)
+        for field, old, new in zip(('bg_free_blocks_count',
+                                    'bg_free_inodes_count',
+                                    'bg_used_dirs_count'), recorded, counts):
+            if old != new:
+                changes.append(f"group {group} {field}: {old} -> {new}")
+        GD_COUNTS.pack_into(gdt, group * 32 + GD_COUNTS_OFFSET, *counts)
+    for i in range(len(gdt) // bs):
+        data = bytes(gdt[i * bs:(i + 1) * bs])
+        if data != img.read_block(gdt_start + i):
+            updates[gdt_start + i] = data
+
+    sb_block, sb_offset = divmod(SUPERBLOCK_OFFSET, bs)
+    data = bytearray(img.read_block(sb_block))
+    for field, old, new in (('s_free_blocks_count', sb.free_blocks_count,
+                             free_blocks),
+                            ('s_free_inodes_count', sb.free_inodes_count,
+                             free_inodes)):
+        if old != new:
+            changes.append(f"{field}: {old} -> {new}")
+    SB_FREE_COUNTS.pack_into(data, sb_offset + SB_FREE_COUNTS_OFFSET,
+                             free_blocks, free_inodes)
+    if data != img.read_block(sb_block):
+        updates[sb_block] = bytes(data)
+    return updates, changes, problems
+
+
+def repair(path, dry_run=False):
+    """Bring the bitmaps and counts of the image at path in line with its
+    inodes, writing only the blocks that change"""
+    with Ext2Image(path) as img:
+        updates, changes, problems = plan(img)
+        bs = img.block_size
+        runs = coalesce(updates)
+        # Blocks between changed ones are rewritten as they are
+        buffers = [b''.join(updates.get(block) or img.read_block(block)
+                            for block in range(start, start + count))
+                   for start, count in runs]
+    if dry_run or not runs:
+        return Repair(changes, problems, 0, 0)
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        for (start, _), data in zip(runs, buffers):
+            os.pwrite(fd, data, start * bs)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return Repair(changes, problems, len(updates), len(runs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="report what would change without writing")
+    args = parser.parse_args()
+
+    try:
+        result = repair(args.image, args.dry_run)
+    except Ext2Error as e:
+        print(f"{args.image}: {e}", file=sys.stderr)
+        return 1
+    for change in result.changes:
+        print(change)
+    for problem in result.unrepaired:
+        print(f"not repaired: {problem}")
+    if args.dry_run:
+        print(f"{len(result.changes)} changes, nothing written")
+    else:
+        print(f"{len(result.changes)} changes, {result.blocks} blocks "
+              f"in {result.writes} writes")
+    return 1 if result.unrepaired else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
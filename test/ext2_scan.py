@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Check every block group of an ext2 image, spreading the groups over worker
+processes that each map the same image file
+
+Usage: python3 ext2_scan.py [-j jobs] [image]
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from ext2_image import (EXT2_S_IFDIR, EXT2_S_IFMT, Ext2Image, coalesce,
+                        count_clear_bits)
+
+Layout = namedtuple('Layout', [
+    'block_size', 'blocks_count', 'first_data_block', 'blocks_per_group',
+    'inodes_per_group', 'inode_size', 'descriptors',
+])
+
+GroupScan = namedtuple('GroupScan', [
+    'group', 'free_blocks', 'free_inodes', 'used_dirs', 'anomalies',
+])
+
+ScanResult = namedtuple('ScanResult', [
+    'groups', 'free_blocks', 'free_inodes', 'used_dirs', 'anomalies',
+])
+
+# i_mode, i_dtime and i_links_count of an inode
+INODE_STATE_FMT = struct.Struct('<H18xI2xH')
+
+_worker_map = None
+_worker_layout = None
+
+
+def _bit(bitmap, n):
+    return bitmap[n >> 3] & (1 << (n & 7))
+
+
+def scan_group(image_map, layout, group):
+    """Summarize one group and list what is inconsistent about it. A bitmap
+    or inode table past the end of the image is reported, and what depends
+    on it is taken from the descriptor."""
+    desc = layout.descriptors[group]
+    bs = layout.block_size
+    first = layout.first_data_block + group * layout.blocks_per_group
+    nblocks = min(layout.blocks_per_group, layout.blocks_count - first)
+    anomalies = []
+
+    def region(name, block, count):
+        if (block + count) * bs > len(image_map):
+            anomalies.append(f"{name} at block {block} lies past the end of "
+                             f"the image")
+            return None
+        return image_map[block * bs:(block + count) * bs]
+
+    table_blocks = -(-layout.inodes_per_group * layout.inode_size // bs)
+    block_bitmap = region('block bitmap', desc.block_bitmap, 1)
+    inode_bitmap = region('inode bitmap', desc.inode_bitmap, 1)
+    table = region('inode table', desc.inode_table, table_blocks)
+    free_blocks = desc.free_blocks_count
+    if block_bitmap is not None:
+        free_blocks = count_clear_bits(block_bitmap, nblocks)
+    free_inodes = desc.free_inodes_count
+    if inode_bitmap is not None:
+        free_inodes = count_clear_bits(inode_bitmap, layout.inodes_per_group)
+
+    metadata = [desc.block_bitmap, desc.inode_bitmap]
+    metadata.extend(range(desc.inode_table, desc.inode_table + table_blocks))
+    for block in metadata:
+        if not first <= block < first + nblocks:
+            anomalies.append(f"metadata block {block} lies outside the group")
+        elif block_bitmap is not None and \
+                not _bit(block_bitmap, block - first):
+            anomalies.append(f"metadata block {block} is marked free")
+
+    used_dirs = desc.used_dirs_count
+    if table is not None:
+        used_dirs = 0
+        unmarked = 0
+        for index in range(layout.inodes_per_group):
+            mode, dtime, links = INODE_STATE_FMT.unpack_from(
+                table, index * layout.inode_size)
+            if mode == 0 or links == 0 or dtime != 0:
+                continue
+            if inode_bitmap is not None and not _bit(inode_bitmap, index):
+                unmarked += 1
+            elif (mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+                used_dirs += 1
+        if unmarked:
+            anomalies.append(f"{unmarked} live inodes are marked free")
+
+    for field, recorded, counted in (
+            ('bg_free_blocks_count', desc.free_blocks_count, free_blocks),
+            ('bg_free_inodes_count', desc.free_inodes_count, free_inodes),
+            ('bg_used_dirs_count', desc.used_dirs_count, used_dirs)):
+        if recorded != counted:
+            anomalies.append(f"{field} is {recorded}, counted {counted}")
+    return GroupScan(group, free_blocks, free_inodes, used_dirs,
+                     tuple(anomalies))
+
+
+def _init_worker(path, layout):
+    global _worker_map, _worker_layout
+    with open(path, 'rb') as f:
+        _worker_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker_layout = layout
+
+
+def _advise(image_map, layout, groups):
+    """Ask for the bitmaps and inode tables of groups before scanning them"""
+    if not hasattr(mmap, 'MADV_WILLNEED'):
+        return
+    bs = layout.block_size
+    table_blocks = -(-layout.inodes_per_group * layout.inode_size // bs)
+    blocks = []
+    for group in groups:
+        desc = layout.descriptors[group]
+        blocks.extend((desc.block_bitmap, desc.inode_bitmap))
+        blocks.extend(range(desc.inode_table, desc.inode_table + table_blocks))
+    for start, count in coalesce(blocks):
+        offset = start * bs - start * bs % mmap.PAGESIZE
+        if offset < len(image_map):
+            image_map.madvise(mmap.MADV_WILLNEED, offset,
+                              min((start + count) * bs, len(image_map)) - offset)
+
+
+def _scan_groups(groups):
+    _advise(_worker_map, _worker_layout, groups)
+    return [scan_group(_worker_map, _worker_layout, g) for g in groups]
+
+
+def merge(superblock, scans):
+    """Fold per-group summaries into totals and check them against the
+    superblock"""
+    free_blocks = sum(s.free_blocks for s in scans)
+    free_inodes = sum(s.free_inodes for s in scans)
+    used_dirs = sum(s.used_dirs for s in scans)
+    anomalies = [f"group {s.group}: {a}" for s in scans for a in s.anomalies]
+    if superblock.free_blocks_count != free_blocks:
+        anomalies.append(f"s_free_blocks_count is "
+                         f"{superblock.free_blocks_count}, counted {free_blocks}")
+    if superblock.free_inodes_count != free_inodes:
+        anomalies.append(f"s_free_inodes_count is "
+                         f"{superblock.free_inodes_count}, counted {free_inodes}")
+    return ScanResult(scans, free_blocks, free_inodes, used_dirs, anomalies)
+
+
+def image_layout(img):
+    sb = img.superblock
+    return Layout(img.block_size, sb.blocks_count, sb.first_data_block,
+                  sb.blocks_per_group, sb.inodes_per_group, img.inode_size,
+                  tuple(img.group_descriptors))
+
+
+def scan(path, jobs=None):
+    """Scan every group of the image at path and merge the summaries"""
+    with Ext2Image(path) as img:
+        sb = img.superblock
+        layout = image_layout(img)
+    groups = range(len(layout.descriptors))
+    jobs = min(jobs or os.cpu_count() or 1, len(groups))
+
+    if jobs <= 1:
+        # A mapping of its own, so nothing outlives the call
+        with open(path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image_map:
+            _advise(image_map, layout, groups)
+            scans = [scan_group(image_map, layout, g) for g in groups]
+    else:
+        # A few chunks per worker keeps them busy without a task per group
+        size = max(1, -(-len(groups) // (jobs * 4)))
+        chunks = [groups[i:i + size] for i in range(0, len(groups), size)]
+        with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                                 initargs=(path, layout)) as pool:
+            scans = [s for chunk in pool.map(_scan_groups, chunks)
+                     for s in chunk]
+
+    return merge(sb, scans)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    result = scan(args.image, args.jobs)
+    print(f"{len(result.groups)} groups, {result.free_blocks} free blocks, "
+          f"{result.free_inodes} free inodes, {result.used_dirs} directories")
+    for anomaly in result.anomalies:
+        print(anomaly)
+    return 1 if result.anomalies else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
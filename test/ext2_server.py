@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Serve an ext2 image to many local processes over a Unix socket
+
+One asyncio server opens the image once and answers requests for byte
+ranges, blocks, decoded inodes and path lookups from it. The inodes and
+paths it decodes are cached for every client, so processes of a parallel
+test run share one warm cache instead of each decoding the image again.
+No root and no network are needed. The image is reopened, and the caches
+dropped, whenever its size, mtime or inode changes. It is read with pread
+rather than mapped, so an image rebuilt in place while it is served gives
+short reads, answered as errors, where a mapping would fault.
+
+Each request and reply is a frame: a FRAME_FMT header, then that many
+bytes of payload. A request may carry many items (a batch), and a client
+may send any number of requests before reading the replies (pipelining).
+Replies on a connection come back in request order, tagged with the
+request id.
+
+Usage: python3 ext2_server.py [-s socket] [image]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+from ext2_image import (CACHE_BLOCKS, CACHE_INODES, Ext2Error, Ext2Image,
+                        Inode, StripedCache, coalesce)
+
+# Length of the payload, request id, then the op of a request or the
+# status of a reply
+FRAME_FMT = struct.Struct('<IIB')
+MAX_PAYLOAD = 64 << 20
+
+# (offset, size) ranges -> their bytes, concatenated
+OP_READ = 1
+# u32 block numbers -> the blocks, concatenated
+OP_BLOCKS = 2
+# u32 inode numbers -> an INODE_RECORD each
+OP_INODES = 3
+# NUL separated absolute paths -> a u32 inode number each, 0 if missing
+OP_PATHS = 4
+# Nothing -> the server's counters as JSON, after noticing a changed image
+OP_STATS = 5
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+RANGE_FMT = struct.Struct('<QI')
+INODE_RECORD = struct.Struct('<IHHIIIIIHHII15I')
+
+CACHE_PATHS = 4096
+
+
+def socket_path(image):
+    return image + '.sock'
+
+
+def _image_key(image):
+    st = os.stat(image)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class SharedImage(Ext2Image):
+    """The server's view of the image, counting the inodes it decodes"""
+
+    def __init__(self, path, cache_blocks, cache_inodes):
+        self.inodes_decoded = 0
+        super().__init__(path, cache_blocks, cache_inodes)
+
+    def _load_inode(self, ino):
+        self.inodes_decoded += 1
+        return super()._load_inode(ino)
+
+
+class BlockServer:
+    """Answers the requests of every connected client from one open file of
+    image. Requests are handled one at a time on the event loop, so the
+    caches need no more locking than they already have."""
+
+    def __init__(self, image, cache_blocks=CACHE_BLOCKS,
+                 cache_inodes=CACHE_INODES):
+        self.image = image
+        self.cache_blocks = cache_blocks
+        self.cache_inodes = cache_inodes
+        self.key = None
+        self.img = None
+        self.paths = StripedCache(CACHE_PATHS)
+        self.counters = {'connections': 0, 'requests': 0, 'items': 0,
+                         'inodes_decoded': 0, 'reloads': 0}
+
+    def close(self):
+        if self.img is not None:
+            self.counters['inodes_decoded'] += self.img.inodes_decoded
+            self.img.close()
+            self.img = None
+
+    def _current(self):
+        """The image as it is now, opened again if it has changed"""
+        key = _image_key(self.image)
+        if key == self.key and self.img is not None:
+            return self.img
+        self.close()
+        self.paths.clear()
+        if self.key is not None:
+            self.counters['reloads'] += 1
+        self.key = key
+        if key[2] == 0:
+            raise Ext2Error("image is empty")
+        self.img = SharedImage(self.image, self.cache_blocks,
+                               self.cache_inodes)
+        return self.img
+
+    def _read(self, img, offset, size):
+        data = img.read(offset, size)
+        if len(data) != size:
+            raise Ext2Error(f"read of {size} bytes at {offset} is past the "
+                            f"end of the image")
+        return data
+
+    def _blocks(self, img, nums):
+        """The blocks, with each run of consecutive blocks in one copy"""
+        bs = img.block_size
+        for num in nums:
+            if num >= img.superblock.blocks_count:
+                raise Ext2Error(f"block {num} out of range")
+        parts = []
+        for start, count in coalesce(nums, gap=0, limit=len(nums) or 1):
+            parts.append((start, self._read(img, start * bs, count * bs)))
+        found = {}
+        for start, data in parts:
+            for i in range(len(data) // bs):
+                found[start + i] = data[i * bs:(i + 1) * bs]
+        return b''.join(found[num] for num in nums)
+
+    def _resolve(self, img, path):
+        try:
+            return img.resolve(path)
+        except FileNotFoundError:
+            return 0
+
+    def handle(self, op, payload):
+        """(status, reply payload) for one request"""
+        try:
+            if op == OP_STATS:
+                try:
+                    self._current()
+                except (Ext2Error, OSError):
+                    pass
+                counters = dict(self.counters)
+                if self.img is not None:
+                    counters['inodes_decoded'] += self.img.inodes_decoded
+                return STATUS_OK, json.dumps(counters).encode()
+            img = self._current()
+            if op == OP_READ:
+                ranges = list(RANGE_FMT.iter_unpack(payload))
+                self.counters['items'] += len(ranges)
+                return STATUS_OK, b''.join(self._read(img, offset, size)
+                                           for offset, size in ranges)
+            if op == OP_BLOCKS:
+                nums = struct.unpack(f'<{len(payload) // 4}I', payload)
+                self.counters['items'] += len(nums)
+                return STATUS_OK, self._blocks(img, nums)
+            if op == OP_INODES:
+                inos = struct.unpack(f'<{len(payload) // 4}I', payload)
+                self.counters['items'] += len(inos)
+                return STATUS_OK, b''.join(
+                    INODE_RECORD.pack(*inode[:-1], *inode.block)
+                    for inode in map(img.inode, inos))
+            if op == OP_PATHS:
+                paths = payload.decode(errors='surrogateescape').split('\0')
+                self.counters['items'] += len(paths)
+                inos = [self.paths.get(path, lambda p: self._resolve(img, p))
+                        for path in paths]
+                return STATUS_OK, struct.pack(f'<{len(inos)}I', *inos)
+            return STATUS_ERROR, f"unknown op {op}".encode()
+        except (Ext2Error, OSError, ValueError, struct.error) as e:
+            return STATUS_ERROR, str(e).encode()
+
+    async def serve_client(self, reader, writer):
+        self.counters['connections'] += 1
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_FMT.size)
+                except asyncio.IncompleteReadError:
+                    break
+                length, request_id, op = FRAME_FMT.unpack(header)
+                if length > MAX_PAYLOAD:
+                    break
+                payload = await reader.readexactly(length)
+                self.counters['requests'] += 1
+                status, reply = self.handle(op, payload)
+                writer.write(FRAME_FMT.pack(len(reply), request_id, status))
+                writer.write(reply)
+                # Returns at once until the client falls behind, so the
+                # replies to pipelined requests go out back to back
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def _claim_socket(path):
+    """Remove a socket left behind by a server that is gone"""
+    if not os.path.exists(path):
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise Ext2Error(f"{path} is already being served")
+
+
+async def serve(image, path, ready=None):
+    """Serve image on the Unix socket at path until cancelled. ready, if
+    given, is called once the socket accepts connections."""
+    _claim_socket(path)
+    server = BlockServer(image)
+    unix = await asyncio.start_unix_server(server.serve_client, path=path)
+    try:
+        if ready is not None:
+            ready()
+        async with unix:
+            await unix.serve_forever()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class BlockClient:
+    """A connection to a BlockServer. send() may be called many times
+    before the replies are collected with reply()."""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+        self.file = self.sock.makefile('rb')
+        self.next_id = 1
+        self.early = {}
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, op, payload=b''):
+        """Send a request without waiting for its reply, returning its id"""
+        request_id = self.next_id
+        self.next_id += 1
+        self.sock.sendall(FRAME_FMT.pack(len(payload), request_id, op)
+                          + payload)
+        return request_id
+
+    def _read_exactly(self, n):
+        data = self.file.read(n)
+        if len(data) != n:
+            raise Ext2Error("server closed the connection")
+        return data
+
+    def reply(self, request_id):
+        """The reply to a request, reading past those of earlier ones"""
+        while request_id not in self.early:
+            length, reply_id, status = FRAME_FMT.unpack(
+                self._read_exactly(FRAME_FMT.size))
+            self.early[reply_id] = status, self._read_exactly(length)
+        status, payload = self.early.pop(request_id)
+        if status != STATUS_OK:
+            raise Ext2Error(payload.decode(errors='replace'))
+        return payload
+
+    def call(self, op, payload=b''):
+        return self.reply(self.send(op, payload))
+
+    def read(self, ranges):
+        """The bytes of each (offset, size) range"""
+        ranges = list(ranges)
+        data = self.call(OP_READ, b''.join(RANGE_FMT.pack(*r)
+                                           for r in ranges))
+        parts = []
+        pos = 0
+        for _, size in ranges:
+            parts.append(data[pos:pos + size])
+            pos += size
+        return parts
+
+    def blocks(self, nums, block_size):
+        nums = list(nums)
+        data = self.call(OP_BLOCKS, struct.pack(f'<{len(nums)}I', *nums))
+        return [data[i * block_size:(i + 1) * block_size]
+                for i in range(len(nums))]
+
+    def inodes(self, inos):
+        inos = list(inos)
+        data = self.call(OP_INODES, struct.pack(f'<{len(inos)}I', *inos))
+        return [Inode(*fields[:12], fields[12:])
+                for fields in INODE_RECORD.iter_unpack(data)]
+
+    def resolve(self, paths):
+        """The inode number of each path, or None where it is missing"""
+        data = self.call(OP_PATHS, '\0'.join(paths).encode(
+            errors='surrogateescape'))
+        return [ino or None for ino in
+                struct.unpack(f'<{len(data) // 4}I', data)]
+
+    def stats(self):
+        return json.loads(self.call(OP_STATS))
+
+
+class ServerImage(Ext2Image):
+    """An image read through a BlockServer. Inodes and path lookups are
+    decoded by the server, once for all of its clients. Every request
+    also asks for the server's reload count, and the superblock, group
+    descriptors and cached blocks and inodes are loaded again when the
+    server has reloaded the image since they were read."""
+
+    def __init__(self, path, cache_blocks=CACHE_BLOCKS,
+                 cache_inodes=CACHE_INODES):
+        self.path = None
+        self.img_fd = None
+        self.client = BlockClient(path)
+        try:
+            self._load(cache_blocks, cache_inodes)
+        except BaseException:
+            self.client.close()
+            raise
+        self.readahead = False
+
+    def _load(self, cache_blocks, cache_inodes):
+        self.cache_sizes = (cache_blocks, cache_inodes)
+        self.reloads = self.client.stats()['reloads']
+        super()._load(cache_blocks, cache_inodes)
+
+    def _request(self, fetch, *args):
+        """fetch(*args) from the server, with the reload count sent for
+        ahead of it so that both describe the same image"""
+        stats = self.client.send(OP_STATS)
+        try:
+            return fetch(*args)
+        finally:
+            reloads = json.loads(self.client.reply(stats))['reloads']
+            if reloads != self.reloads:
+                self._load(*self.cache_sizes)
+
+    def close(self):
+        self.client.close()
+
+    def read(self, offset, size):
+        return self._request(self.client.read, [(offset, size)])[0]
+
+    def prefetch(self, blocks):
+        """Load blocks into the block cache with one request"""
+        wanted = sorted({block for block in blocks
+                         if block not in self.block_cache
+                         and 0 <= block < self.superblock.blocks_count})
+        wanted = wanted[:self.block_cache.capacity // 2]
+        reloads = self.reloads
+        blocks = self._request(self.client.blocks, wanted, self.block_size)
+        # Split at the old block size: leave the new cache to fill itself
+        if self.reloads == reloads:
+            for block, data in zip(wanted, blocks):
+                self.block_cache.put(block, data)
+        return 1 if wanted else 0
+
+    def _load_inode(self, ino):
+        if not 1 <= ino <= self.superblock.inodes_count:
+            raise Ext2Error(f"inode {ino} out of range")
+        return self._request(self.client.inodes, [ino])[0]
+
+    def resolve(self, path):
+        ino = self._request(self.client.resolve, [path])[0]
+        if ino is None:
+            raise FileNotFoundError(path)
+        return ino
+
+
+def open_image(image):
+    """A ServerImage when image is being served, or the image itself"""
+    try:
+        return ServerImage(socket_path(image))
+    except (FileNotFoundError, ConnectionRefusedError):
+        return Ext2Image(image)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('-s', '--socket',
+                        help="socket to listen on (default: IMAGE.sock)")
+    args = parser.parse_args()
+    path = args.socket or socket_path(args.image)
+
+    async def run():
+        task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, task.cancel)
+        await serve(args.image, path,
+                    lambda: print(f"serving {args.image} on {path}",
+                                  flush=True))
+
+    try:
+        asyncio.run(run())
+    except asyncio.CancelledError:
+        pass
+    except Ext2Error as e:
+        print(f"{args.image}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
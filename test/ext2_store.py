@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+"""
+Archive many similar images in one content-addressed block store
+
+Images are split into fixed-size chunks and each distinct chunk is stored
+once, however many images hold it. Chunks of zeros are not stored at all.
+An image is kept as a manifest of runs of chunk ids, from which it can be
+restored as a sparse file or read in place with StoreImage, an Ext2Image
+that reads from the store.
+
+A store is a directory holding:
+
+- pack: the distinct chunks, chunk id n at offset (n - 1) * chunk size
+- index: the digest of each chunk in pack, in the same order
+- manifests/NAME: the image size and sha256, then (first id, count) runs,
+  id 0 standing for chunks of zeros
+
+Chunks are appended to pack before their digests go into index, and a
+manifest is renamed into place last, so an interrupted put leaves at most
+some unreferenced chunks behind.
+
+Usage: python3 ext2_store.py STORE put NAME IMAGE
+       python3 ext2_store.py STORE restore NAME OUT
+       python3 ext2_store.py STORE ls NAME [PATH]
+       python3 ext2_store.py STORE list | stats
+"""
+
+import argparse
+import bisect
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+from ext2_build import copy_range
+from ext2_image import CACHE_BLOCKS, CACHE_INODES, Ext2Error, Ext2Image
+
+CHUNK_SIZE = 1024
+ZERO_ID = 0
+
+# New chunks gathered before one write to the pack
+WRITE_BATCH = 256
+
+DIGEST_SIZE = 20
+MANIFEST_MAGIC = b'E2MF'
+MANIFEST_HEADER = struct.Struct('<4sIQ32s')
+
+Manifest = namedtuple('Manifest', ['size', 'sha256', 'runs'])
+PutResult = namedtuple('PutResult', ['chunks', 'zero', 'new'])
+
+
+def _digest(chunk):
+    return hashlib.sha1(chunk, usedforsecurity=False).digest()
+
+
+def _add_run(runs, chunk_id):
+    """Extend the last (first id, count) run with chunk_id if it follows"""
+    if runs:
+        first, count = runs[-1]
+        if (first == chunk_id == ZERO_ID) or \
+                (first != ZERO_ID and first + count == chunk_id):
+            runs[-1][1] += 1
+            return
+    runs.append([chunk_id, 1])
+
+
+class BlockStore:
+    """A store directory opened for reading and adding images"""
+
+    def __init__(self, root, chunk_size=CHUNK_SIZE):
+        self.root = root
+        os.makedirs(os.path.join(root, 'manifests'), exist_ok=True)
+        config_path = os.path.join(root, 'config.json')
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                chunk_size = json.load(f)['chunk_size']
+        else:
+            with open(config_path + '.tmp', 'w') as f:
+                json.dump({'chunk_size': chunk_size}, f)
+            os.replace(config_path + '.tmp', config_path)
+        self.chunk_size = chunk_size
+        self.lock_fd = os.open(os.path.join(root, 'lock'),
+                               os.O_RDWR | os.O_CREAT, 0o666)
+        self.pack_fd = os.open(os.path.join(root, 'pack'),
+                               os.O_RDWR | os.O_CREAT, 0o666)
+        self.index_fd = os.open(os.path.join(root, 'index'),
+                                os.O_RDWR | os.O_CREAT, 0o666)
+        self.ids = {}
+        self._load_index()
+
+    def _load_index(self):
+        """Read the digests, dropping any whose chunk never reached pack"""
+        stored = os.fstat(self.pack_fd).st_size // self.chunk_size
+        data = os.pread(self.index_fd, os.fstat(self.index_fd).st_size, 0)
+        count = min(len(data) // DIGEST_SIZE, stored)
+        if count * DIGEST_SIZE != len(data):
+            os.ftruncate(self.index_fd, count * DIGEST_SIZE)
+        self.ids = {data[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE]: i + 1
+                    for i in range(count)}
+
+    def close(self):
+        for fd in (self.pack_fd, self.index_fd, self.lock_fd):
+            os.close(fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _manifest_path(self, name):
+        if not name or '/' in name or name.startswith('.'):
+            raise ValueError(f"bad image name {name!r}")
+        return os.path.join(self.root, 'manifests', name)
+
+    def put(self, name, path):
+        """Add the image at path under name. Only chunks the store does not
+        hold yet are written."""
+        cs = self.chunk_size
+        zero = bytes(cs)
+        runs = []
+        result = {'chunks': 0, 'zero': 0, 'new': 0}
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            # Another process may have added chunks since we loaded
+            self._load_index()
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                view = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) \
+                    if size else b''
+                try:
+                    image_sha = hashlib.sha256(view).digest()
+                    pending = []
+                    for offset in range(0, size, cs):
+                        chunk = view[offset:offset + cs]
+                        if len(chunk) < cs:
+                            chunk += zero[len(chunk):]
+                        result['chunks'] += 1
+                        if chunk == zero:
+                            result['zero'] += 1
+                            _add_run(runs, ZERO_ID)
+                            continue
+                        digest = _digest(chunk)
+                        chunk_id = self.ids.get(digest)
+                        if chunk_id is None:
+                            chunk_id = len(self.ids) + 1
+                            self.ids[digest] = chunk_id
+                            pending.append((digest, chunk))
+                            result['new'] += 1
+                            if len(pending) >= WRITE_BATCH:
+                                self._append(pending)
+                        _add_run(runs, chunk_id)
+                    self._append(pending)
+                finally:
+                    if size:
+                        view.close()
+            self._write_manifest(name, Manifest(size, image_sha, runs))
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+        return PutResult(**result)
+
+    def _append(self, pending):
+        """Write new chunks to pack, then their digests to index"""
+        if not pending:
+            return
+        first = len(self.ids) - len(pending) + 1
+        os.pwrite(self.pack_fd, b''.join(chunk for _, chunk in pending),
+                  (first - 1) * self.chunk_size)
+        os.pwrite(self.index_fd, b''.join(digest for digest, _ in pending),
+                  (first - 1) * DIGEST_SIZE)
+        pending.clear()
+
+    def _write_manifest(self, name, manifest):
+        path = self._manifest_path(name)
+        flat = array('I', (n for run in manifest.runs for n in run))
+        if sys.byteorder != 'little':
+            flat.byteswap()
+        with open(path + '.tmp', 'wb') as f:
+            f.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, self.chunk_size,
+                                         manifest.size, manifest.sha256))
+            f.write(flat.tobytes())
+        os.replace(path + '.tmp', path)
+
+    def manifest(self, name):
+        try:
+            with open(self._manifest_path(name), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            raise KeyError(name) from None
+        magic, chunk_size, size, sha = MANIFEST_HEADER.unpack_from(data)
+        if magic != MANIFEST_MAGIC or chunk_size != self.chunk_size:
+            raise ValueError(f"{name} is not a manifest of this store")
+        flat = array('I')
+        flat.frombytes(data[MANIFEST_HEADER.size:])
+        if sys.byteorder != 'little':
+            flat.byteswap()
+        runs = [(flat[i], flat[i + 1]) for i in range(0, len(flat), 2)]
+        return Manifest(size, sha, runs)
+
+    def names(self):
+        return sorted(name for name in
+                      os.listdir(os.path.join(self.root, 'manifests'))
+                      if not name.endswith('.tmp'))
+
+    def restore(self, name, out_path, verify=True):
+        """Write the image as a sparse file: runs of zeros stay holes and
+        stored runs are copied from pack by the kernel"""
+        manifest = self.manifest(name)
+        cs = self.chunk_size
+        fd = os.open(out_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            os.ftruncate(fd, manifest.size)
+            method = 'copy_file_range'
+            offset = 0
+            for first, count in manifest.runs:
+                length = min(count * cs, manifest.size - offset)
+                if first != ZERO_ID:
+                    method = copy_range(self.pack_fd, fd, (first - 1) * cs,
+                                        offset, length, method)
+                offset += count * cs
+        finally:
+            os.close(fd)
+        if verify:
+            with open(out_path, 'rb') as f:
+                if hashlib.file_digest(f, 'sha256').digest() != \
+                        manifest.sha256:
+                    raise ValueError(f"{out_path} does not match {name}")
+
+    def read(self, manifest, starts, offset, size):
+        """size bytes of a stored image from offset, starts being the first
+        chunk of each of manifest's runs"""
+        cs = self.chunk_size
+        size = max(0, min(size, manifest.size - offset))
+        out = []
+        while size > 0:
+            chunk = offset // cs
+            i = bisect.bisect_right(starts, chunk) - 1
+            first, count = manifest.runs[i]
+            skip = offset - starts[i] * cs
+            n = min(size, count * cs - skip)
+            if first == ZERO_ID:
+                out.append(bytes(n))
+            else:
+                out.append(os.pread(self.pack_fd, n,
+                                    (first - 1) * cs + skip))
+            offset += n
+            size -= n
+        return b''.join(out)
+
+    def stats(self):
+        chunks = zero = 0
+        for name in self.names():
+            for first, count in self.manifest(name).runs:
+                chunks += count
+                zero += count if first == ZERO_ID else 0
+        unique = len(self.ids)
+        return {
+            'images': len(self.names()),
+            'chunk_size': self.chunk_size,
+            'chunks': chunks,
+            'zero_chunks': zero,
+            'unique_chunks': unique,
+            'stored_bytes': unique * self.chunk_size,
+            'dedup_ratio': round((chunks - zero) / unique, 2) if unique
+            else 0,
+        }
+
+
+class StoreImage(Ext2Image):
+    """An image read in place from a BlockStore"""
+
+    def __init__(self, store, name, cache_blocks=CACHE_BLOCKS,
+                 cache_inodes=CACHE_INODES):
+        self.path = None
+        self.img_fd = None
+        self.store = store
+        self.manifest = store.manifest(name)
+        self.starts = []
+        chunk = 0
+        for _, count in self.manifest.runs:
+            self.starts.append(chunk)
+            chunk += count
+        self._load(cache_blocks, cache_inodes)
+
+    def close(self):
+        pass
+
+    def read(self, offset, size):
+        return self.store.read(self.manifest, self.starts, offset, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('store')
+    sub = parser.add_subparsers(dest='command', required=True)
+    put = sub.add_parser('put')
+    put.add_argument('name')
+    put.add_argument('image')
+    restore = sub.add_parser('restore')
+    restore.add_argument('name')
+    restore.add_argument('out')
+    ls = sub.add_parser('ls')
+    ls.add_argument('name')
+    ls.add_argument('path', nargs='?', default='/')
+    sub.add_parser('list')
+    sub.add_parser('stats')
+    args = parser.parse_args()
+
+    with BlockStore(args.store) as store:
+        if args.command == 'put':
+            result = store.put(args.name, args.image)
+            print(f"{result.chunks} chunks, {result.zero} zero, "
+                  f"{result.new} new")
+        elif args.command == 'restore':
+            store.restore(args.name, args.out)
+        elif args.command == 'ls':
+            try:
+                with StoreImage(store, args.name) as img:
+                    for st in sorted(img.scandir(img.resolve(args.path)),
+                                     key=lambda st: st.name):
+                        print(f"{st.ino:8d} {stat.filemode(st.mode)} "
+                              f"{st.size:10d} "
+                              f"{st.name.decode(errors='replace')}")
+            except Ext2Error as e:
+                print(f"{args.name}: {e}", file=sys.stderr)
+                return 1
+        elif args.command == 'list':
+            for name in store.names():
+                manifest = store.manifest(name)
+                print(f"{manifest.size:12d} {manifest.sha256.hex()[:16]} "
+                      f"{name}")
+        else:
+            print(json.dumps(store.stats(), indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
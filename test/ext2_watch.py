@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Watch an ext2 image and recheck only what changed since the last check
+
+Every check reads the image a chunk at a time and compares a digest of each
+chunk, and then of each block in a chunk that differs, with the digests
+the previous check kept. Each per-group scan, inode, block map and directory
+listing that a check computes records the blocks it read and the other
+results it used. A changed block invalidates those results, and everything
+built on them, and only the invalidated ones are computed again. A changed
+superblock or descriptor table invalidates everything.
+
+Usage: python3 ext2_watch.py [-i seconds] [--once] [image]
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+from collections import defaultdict, namedtuple
+
+from ext2_image import BLOCK_SIZE, Ext2Error, Ext2Image, tree_problems
+from ext2_scan import image_layout, merge, scan_group
+
+# Bytes read and hashed together before looking at single 1K blocks
+CHUNK_SIZE = 64 * BLOCK_SIZE
+DIGEST_SIZE = hashlib.sha1().digest_size
+
+Report = namedtuple('Report', ['problems', 'changed', 'rerun', 'elapsed'])
+
+
+def _digest(data):
+    return hashlib.sha1(data, usedforsecurity=False).digest()
+
+
+class BlockDigests:
+    """A digest of every chunk and every 1K block of the image as the last
+    check read it. The image is read a chunk at a time into one reused
+    buffer, so memory grows with the number of blocks, not their contents,
+    and an unchanged chunk costs one digest."""
+
+    def __init__(self):
+        self.size = None
+        self.chunks = bytearray()
+        self.blocks = bytearray()
+        self.buffer = bytearray(CHUNK_SIZE)
+
+    def update(self, f):
+        """Read f and return the numbers of the 1K blocks that changed, or
+        None if nothing can be compared with the previous image"""
+        size = os.fstat(f.fileno()).st_size
+        comparable = size == self.size
+        if not comparable:
+            self.size = size
+            self.chunks = bytearray(-(-size // CHUNK_SIZE) * DIGEST_SIZE)
+            self.blocks = bytearray(-(-size // BLOCK_SIZE) * DIGEST_SIZE)
+        view = memoryview(self.buffer)
+        changed = []
+        for start in range(0, size, CHUNK_SIZE):
+            length = min(CHUNK_SIZE, size - start)
+            got = f.readinto(view[:length]) or 0
+            # Shrunk since the stat: the next poll sees the new size
+            view[got:length] = bytes(length - got)
+            chunk = view[:length]
+            at = start // CHUNK_SIZE * DIGEST_SIZE
+            digest = _digest(chunk)
+            if comparable and self.chunks[at:at + DIGEST_SIZE] == digest:
+                continue
+            self.chunks[at:at + DIGEST_SIZE] = digest
+            for offset in range(0, length, BLOCK_SIZE):
+                block = (start + offset) // BLOCK_SIZE
+                at = block * DIGEST_SIZE
+                digest = _digest(chunk[offset:offset + BLOCK_SIZE])
+                if self.blocks[at:at + DIGEST_SIZE] != digest:
+                    self.blocks[at:at + DIGEST_SIZE] = digest
+                    changed.append(block)
+        return changed if comparable else None
+
+
+class ImageView:
+    """Byte slices of an open image, read with pread, for scan_group"""
+
+    def __init__(self, img):
+        self.img = img
+        self.size = os.fstat(img.img_fd.fileno()).st_size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        start, stop, _ = key.indices(self.size)
+        return self.img.read(start, max(0, stop - start))
+
+
+class ResultCache:
+    """Results keyed by what they describe, with the blocks and other
+    results each was computed from. Ext2Errors are cached like results."""
+
+    def __init__(self):
+        self.results = {}
+        self.dependents = defaultdict(set)
+        self.computing = []
+        self.computed = 0
+
+    def get(self, key, compute):
+        if self.computing:
+            self.dependents[key].add(self.computing[-1])
+        if key not in self.results:
+            self.computing.append(key)
+            try:
+                self.results[key] = (True, compute())
+            except Ext2Error as e:
+                self.results[key] = (False, e)
+            finally:
+                self.computing.pop()
+            self.computed += 1
+        ok, value = self.results[key]
+        if not ok:
+            raise value
+        return value
+
+    def depends_on_block(self, block):
+        """Note that the result being computed read block"""
+        if self.computing:
+            self.dependents[('block', block)].add(self.computing[-1])
+
+    def invalidate(self, blocks):
+        pending = [('block', b) for b in blocks]
+        while pending:
+            for key in self.dependents.pop(pending.pop(), ()):
+                if self.results.pop(key, None) is not None:
+                    pending.append(key)
+
+    def clear(self):
+        self.results.clear()
+        self.dependents.clear()
+
+
+class CachedImage(Ext2Image):
+    """An image whose inodes, block maps and directory listings come from a
+    ResultCache"""
+
+    def __init__(self, path, cache):
+        self.cache = cache
+        super().__init__(path)
+
+    def read_block(self, block_num):
+        self.cache.depends_on_block(block_num)
+        return super().read_block(block_num)
+
+    def inode(self, ino):
+        return self.cache.get(('inode', ino), lambda: super(
+            CachedImage, self).inode(ino))
+
+    def iter_extents(self, inode):
+        ino = inode.ino
+        return iter(self.cache.get(('extents', ino), lambda: list(super(
+            CachedImage, self).iter_extents(self.inode(ino)))))
+
+    def iter_dir(self, ino):
+        return iter(self.cache.get(('dir', ino), lambda: list(super(
+            CachedImage, self).iter_dir(ino))))
+
+
+class Watcher:
+    """Checks one image path again and again, reusing unchanged results"""
+
+    def __init__(self, path):
+        self.path = path
+        self.digests = BlockDigests()
+        self.cache = ResultCache()
+        self.stamp = None
+        self.report = None
+
+    def poll(self):
+        """A new Report if the file changed since the last check, else None"""
+        st = os.stat(self.path)
+        stamp = (st.st_size, st.st_mtime_ns, st.st_ino)
+        if stamp == self.stamp:
+            return None
+        self.stamp = stamp
+        return self.check()
+
+    def check(self):
+        start = time.perf_counter()
+        with open(self.path, 'rb', buffering=0) as f:
+            changed = self.digests.update(f)
+        computed = self.cache.computed
+        try:
+            img = CachedImage(self.path, self.cache)
+        except Ext2Error as e:
+            self.cache.clear()
+            return Report([f"image: {e}"], None, 0,
+                          time.perf_counter() - start)
+        try:
+            if changed is not None:
+                changed = sorted({block * BLOCK_SIZE // img.block_size
+                                  for block in changed})
+            layout = image_layout(img)
+            view = ImageView(img)
+            table_end = img.superblock.first_data_block + 1 + \
+                -(-img.group_count * 32 // img.block_size)
+            if changed is None or any(b < table_end for b in changed):
+                self.cache.clear()
+            else:
+                self.cache.invalidate(changed)
+
+            scans = [self.cache.get(('group', g),
+                                    lambda g=g: self._scan_group(view,
+                                                                 layout, g))
+                     for g in range(img.group_count)]
+            problems = list(merge(img.superblock, scans).anomalies)
+            try:
+                problems.extend(tree_problems(img))
+            except Ext2Error as e:
+                problems.append(f"tree: {e}")
+        finally:
+            img.close()
+        self.report = Report(problems, changed,
+                             self.cache.computed - computed,
+                             time.perf_counter() - start)
+        return self.report
+
+    def _scan_group(self, view, layout, group):
+        desc = layout.descriptors[group]
+        bs = layout.block_size
+        table_blocks = -(-layout.inodes_per_group * layout.inode_size // bs)
+        for block in (desc.block_bitmap, desc.inode_bitmap,
+                      *range(desc.inode_table, desc.inode_table + table_blocks)):
+            self.cache.depends_on_block(block)
+        return scan_group(view, layout, group)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('image', nargs='?', default='cs111-base.img')
+    parser.add_argument('-i', '--interval', type=float, default=0.5,
+                        help="seconds between polls")
+    parser.add_argument('--once', action='store_true',
+                        help="check once and exit")
+    args = parser.parse_args()
+
+    watcher = Watcher(args.image)
+    while True:
+        try:
+            report = watcher.poll()
+        except FileNotFoundError:
+            # ext2-create may be replacing it
+            if args.once:
+                raise
+            report = None
+        if report is not None:
+            changed = ('all' if report.changed is None
+                       else len(report.changed))
+            print(f"{time.strftime('%H:%M:%S')} {changed} blocks changed, "
+                  f"{report.rerun} results recomputed, "
+                  f"{len(report.problems)} problems, "
+                  f"{report.elapsed * 1000:.1f} ms", flush=True)
+            for problem in report.problems:
+                print(f"  {problem}", flush=True)
+            if args.once:
+                return 1 if report.problems else 0
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Generate a large fixture image from a seeded workload spec
+
+The spec, a JSON object, sets how deep and wide the directory tree grows,
+how file sizes are distributed, how many entries are symlinks and how full
+the image ends up. The tree is generated on the host from the seed alone
+and built with ext2_build, with fixed times, owner and UUID, so the same
+spec always gives the same image byte for byte.
+
+File sizes are drawn log-uniformly within weighted [weight, min, max]
+buckets. A bound may be a byte count or one of 'ind', 'dind' and 'tind',
+the first byte the inode reaches through its single, double or triple
+indirect block for the spec's block size, optionally with '+bytes'.
+
+Usage: python3 ext2_workload.py [--spec spec.json] [--seed N] [-o image]
+                                [--keep-tree dir]
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+from collections import Counter
+
+from ext2_build import build, max_inodes, pointer_segments
+from ext2_image import EXT2_GOOD_OLD_FIRST_INO, EXT2_NDIR_BLOCKS
+
+DEFAULT_SPEC = {
+    'seed': 0,
+    'size_mib': 128,
+    'block_size': 1024,
+    # Fraction of the image's bytes to fill with file data
+    'fill_ratio': 0.6,
+    # Most levels of directories below the root
+    'depth': 4,
+    # Subdirectories of each directory, drawn uniformly
+    'fanout': [0, 6],
+    'max_dirs': 2000,
+    'file_sizes': [
+        [40, 0, 1024],
+        [35, 1024, 'ind'],
+        [20, 'ind', 'dind'],
+        [4, 'dind', 8 << 20],
+        [1, 'tind', 'tind+1048576'],
+    ],
+    # Fraction of files written as a head and a tail around a hole
+    'sparse_ratio': 0.05,
+    # Fraction of entries that are symlinks, and of those how many have a
+    # target too long to be kept in the inode
+    'symlink_ratio': 0.1,
+    'long_symlink_ratio': 0.3,
+    'epoch': 0,
+}
+
+# Pattern the file contents are cut from
+POOL_SIZE = 1 << 20
+
+SHORT_TARGET_MAX = 59
+
+
+def indirect_offsets(block_size):
+    """First byte reached through each level of indirection"""
+    per_block = block_size // 4
+    ind = EXT2_NDIR_BLOCKS
+    dind = ind + per_block
+    tind = dind + per_block ** 2
+    return {'ind': ind * block_size, 'dind': dind * block_size,
+            'tind': tind * block_size}
+
+
+def blocks_needed(runs, block_size):
+    """Data and indirect blocks that storing runs of blocks takes"""
+    data = 0
+    pointers = set()
+    for _, count, keys in pointer_segments(runs, block_size // 4):
+        data += count
+        pointers.update(keys)
+    return data + len(pointers)
+
+
+def resolve_size(value, block_size):
+    """A bucket bound as bytes"""
+    if isinstance(value, int):
+        return value
+    name, _, extra = value.partition('+')
+    offsets = indirect_offsets(block_size)
+    if name not in offsets:
+        raise ValueError(f"unknown size {value!r}")
+    return offsets[name] + int(extra or 0)
+
+
+def load_spec(path=None, **overrides):
+    spec = dict(DEFAULT_SPEC)
+    if path is not None:
+        with open(path) as f:
+            spec.update(json.load(f))
+    spec.update({k: v for k, v in overrides.items() if v is not None})
+    unknown = set(spec) - set(DEFAULT_SPEC)
+    if unknown:
+        raise ValueError(f"unknown spec keys {sorted(unknown)}")
+    check_sizes(spec['file_sizes'], spec['block_size'])
+    return spec
+
+
+def check_sizes(buckets, block_size):
+    """Raise ValueError unless buckets are [weight, min, max] lists that
+    can draw a file with data"""
+    if not isinstance(buckets, list) or not buckets:
+        raise ValueError("file_sizes must be a list of buckets")
+    nonempty = False
+    for bucket in buckets:
+        if not isinstance(bucket, list) or len(bucket) != 3:
+            raise ValueError(f"bucket {bucket!r} is not [weight, min, max]")
+        weight, low, high = bucket
+        if not isinstance(weight, (int, float)) or weight < 0:
+            raise ValueError(f"bucket {bucket!r} has a bad weight")
+        low = resolve_size(low, block_size)
+        high = resolve_size(high, block_size)
+        if not 0 <= low <= high:
+            raise ValueError(f"bucket {bucket!r} has bad bounds")
+        nonempty |= weight > 0 and high > 0
+    if not nonempty:
+        raise ValueError("file_sizes has no weighted bucket above 0 bytes")
+
+
+class Workload:
+    """The tree a spec describes, drawn from its seed"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = random.Random(spec['seed'])
+        bs = spec['block_size']
+        self.buckets = [(weight, resolve_size(low, bs),
+                         resolve_size(high, bs))
+                        for weight, low, high in spec['file_sizes']]
+        self.dirs = []
+        self.files = []
+        self.symlinks = []
+        self._make_dirs()
+        self._make_files()
+
+    def _make_dirs(self):
+        spec = self.spec
+        low, high = spec['fanout']
+        self.dirs = [('', 0)]
+        queue = [('', 0)]
+        while queue and len(self.dirs) < spec['max_dirs']:
+            path, depth = queue.pop(0)
+            if depth >= spec['depth']:
+                continue
+            for _ in range(self.rng.randint(low, high)):
+                if len(self.dirs) >= spec['max_dirs']:
+                    break
+                child = (f'{path}/d{len(self.dirs):04d}', depth + 1)
+                self.dirs.append(child)
+                queue.append(child)
+
+    def _draw_size(self):
+        weights = [weight for weight, _, _ in self.buckets]
+        _, low, high = self.rng.choices(self.buckets, weights)[0]
+        if high <= low:
+            return low
+        # Log-uniform, so small sizes in a wide bucket are not drowned out
+        size = math.exp(self.rng.uniform(math.log(low + 1),
+                                         math.log(high + 1))) - 1
+        return min(high, max(low, int(size)))
+
+    def _make_files(self):
+        spec = self.spec
+        bs = spec['block_size']
+        budget = int(spec['fill_ratio'] * spec['size_mib'] * (1 << 20)) // bs
+        ratio = spec['symlink_ratio']
+        if not 0 <= ratio < 1:
+            raise ValueError("symlink_ratio must be at least 0 and below 1")
+        # Inodes the image has left for files and symlinks, past the
+        # reserved ones, lost+found and the directories
+        inodes = max_inodes(bs, spec['size_mib'] * (1 << 20) // bs) - \
+            EXT2_GOOD_OLD_FIRST_INO - 1 - len(self.dirs)
+        max_files = int(inodes * (1 - ratio))
+        used = 0
+        misses = 0
+        # Stop once many sizes in a row no longer fit
+        while misses < 100 and len(self.files) < max_files:
+            directory, _ = self.rng.choice(self.dirs)
+            size = self._draw_size()
+            sparse = size > 2 * bs and \
+                self.rng.random() < spec['sparse_ratio']
+            nblocks = -(-size // bs)
+            runs = [[0, 1], [nblocks - 1, 1]] if sparse else [[0, nblocks]]
+            stored = blocks_needed(runs, bs)
+            if used + stored > budget:
+                misses += 1
+                continue
+            # An empty file always fits, so it must not keep the loop going
+            # once nothing else does
+            if stored:
+                misses = 0
+            used += stored
+            name = f'{directory}/f{len(self.files):05d}'
+            self.files.append((name, size, sparse,
+                               self.rng.randrange(POOL_SIZE)))
+        self.data_blocks = used
+
+        if self.files:
+            count = round(len(self.files) * ratio / (1 - ratio))
+            for i in range(min(count, inodes - len(self.files))):
+                directory, _ = self.rng.choice(self.dirs)
+                name = f'{directory}/l{i:05d}'
+                self.symlinks.append((name, self._target(name)))
+
+    def _target(self, name):
+        bs = self.spec['block_size']
+        path, _, _, _ = self.rng.choice(self.files)
+        target = os.path.relpath(path, os.path.dirname(name))
+        if self.rng.random() < self.spec['long_symlink_ratio']:
+            # The same file by way of enough ./ to outgrow the inode
+            length = self.rng.randint(SHORT_TARGET_MAX + 1, min(bs - 1, 400))
+            target = './' * max(0, -(-(length - len(target)) // 2)) + target
+            return target[-(bs - 1):]
+        if len(target) > SHORT_TARGET_MAX:
+            target = os.path.basename(target)
+        return target
+
+    def write_tree(self, root):
+        """Create the tree under root"""
+        epoch = self.spec['epoch']
+        pool = random.Random(self.spec['seed']).randbytes(POOL_SIZE)
+        pool2 = pool * 2
+        for path, _ in self.dirs:
+            os.makedirs(root + path, mode=0o755, exist_ok=True)
+        bs = self.spec['block_size']
+        for path, size, sparse, start in self.files:
+            fd = os.open(root + path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                         0o644)
+            try:
+                if sparse:
+                    os.pwrite(fd, pool2[start:start + bs], 0)
+                    os.pwrite(fd, pool2[start:start + bs], size - bs)
+                else:
+                    offset = 0
+                    while offset < size:
+                        n = min(size - offset, POOL_SIZE)
+                        os.pwrite(fd, pool2[start:start + n], offset)
+                        offset += n
+                os.ftruncate(fd, size)
+                os.fchmod(fd, 0o644)
+            finally:
+                os.close(fd)
+            os.utime(root + path, (epoch, epoch))
+        for path, target in self.symlinks:
+            os.symlink(target, root + path)
+        for path, _ in self.dirs:
+            os.chmod(root + path, 0o755)
+            os.utime(root + path, (epoch, epoch))
+
+    def summary(self):
+        bs = self.spec['block_size']
+        offsets = indirect_offsets(bs)
+        levels = Counter()
+        for _, size, _, _ in self.files:
+            blocks_end = -(-size // bs) * bs
+            if blocks_end > offsets['tind']:
+                levels['triple'] += 1
+            elif blocks_end > offsets['dind']:
+                levels['double'] += 1
+            elif blocks_end > offsets['ind']:
+                levels['single'] += 1
+            else:
+                levels['direct'] += 1
+        long_links = sum(len(t) > SHORT_TARGET_MAX for _, t in self.symlinks)
+        return {
+            'dirs': len(self.dirs),
+            'max_depth': max(depth for _, depth in self.dirs),
+            'files': len(self.files),
+            'files_by_indirection': dict(sorted(levels.items())),
+            'sparse_files': sum(sparse for _, _, sparse, _ in self.files),
+            'symlinks': {'short': len(self.symlinks) - long_links,
+                         'long': long_links},
+            'data_blocks': self.data_blocks,
+        }
+
+
+def generate(spec, out_path, keep_tree=None):
+    """Build the image spec describes at out_path and return a summary"""
+    workload = Workload(spec)
+    tmpdir = None
+    if keep_tree is None:
+        tmpdir = tempfile.mkdtemp()
+        root = os.path.join(tmpdir, 'tree')
+    else:
+        root = keep_tree
+    try:
+        workload.write_tree(root)
+        bs = spec['block_size']
+        build(root, out_path, block_size=bs,
+              size_blocks=spec['size_mib'] * (1 << 20) // bs,
+              epoch=spec['epoch'], seed=spec['seed'], owner=(0, 0))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+    summary = workload.summary()
+    digest = hashlib.sha256()
+    with open(out_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    summary['sha256'] = digest.hexdigest()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--spec', help="JSON spec, over the defaults")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('-o', '--output', default='workload.img')
+    parser.add_argument('--keep-tree', metavar='DIR',
+                        help="generate the tree here and keep it")
+    args = parser.parse_args()
+
+    spec = load_spec(args.spec, seed=args.seed)
+    summary = generate(spec, args.output, args.keep_tree)
+    print(json.dumps(summary, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
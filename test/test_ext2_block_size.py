@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_build import build
+from ext2_image import SUPERBLOCK_OFFSET, Ext2Image
+from ext2_layout import pointer_blocks
+from ext2_scan import scan
+from ext2_server import open_image
+
+BLOCK_SIZES = (1024, 2048, 4096)
+
+
+class TestBlockSize(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build ext2-create"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def create(self, *args):
+        result = subprocess.run(['./ext2-create', *args], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return result.stdout
+
+    def test_superblock(self):
+        """Test that the layout follows from the block size"""
+        for block_size in BLOCK_SIZES:
+            with self.subTest(block_size=block_size):
+                self.create('-b', str(block_size), '-g', '3')
+                with open_image('cs111-base.img') as img:
+                    sb = img.superblock
+                    self.assertEqual(img.block_size, block_size)
+                    first = 1 if block_size == 1024 else 0
+                    self.assertEqual(sb.first_data_block, first)
+                    self.assertEqual(sb.blocks_per_group, 8 * block_size)
+                    self.assertEqual(sb.blocks_count,
+                                     first + 3 * 8 * block_size)
+                    self.assertEqual(img.group_descriptors[0].inode_table,
+                                     first + 4)
+                    self.assertEqual(img.group_descriptors[1].inode_table,
+                                     first + 8 * block_size + 4)
+                    with img.open_file(img.inode(
+                            img.resolve('/group-2/data'))) as f:
+                        data = f.read()
+                self.assertEqual(len(data), 12 * block_size)
+                self.assertTrue(data.startswith(b'group 2 block 0\n'))
+                self.assertEqual(scan('cs111-base.img', jobs=1).anomalies, [])
+
+    def test_contents(self):
+        """Test that the single group image holds the same tree"""
+        for block_size in BLOCK_SIZES[1:]:
+            with self.subTest(block_size=block_size):
+                self.create('-b', str(block_size), '-i')
+                with open_image('cs111-base.img') as img:
+                    self.assertEqual(img.superblock.blocks_count, 1024)
+                    self.assertEqual(os.path.getsize('cs111-base.img'),
+                                     1024 * block_size)
+                    hello = img.inode(img.resolve('/hello-world'))
+                    with img.open_file(hello) as f:
+                        self.assertEqual(f.read(), b'Hello world\n')
+                    self.assertEqual(hello.blocks, block_size // 512)
+                    self.assertEqual(img.read_symlink(
+                        img.inode(img.resolve('/hello'))), b'hello-world')
+
+    def test_fsck_clean(self):
+        """Test that fsck finds nothing to fix for each block size"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        for block_size in BLOCK_SIZES[1:]:
+            for args in ([], ['-i'], ['-g', '4', '-i']):
+                with self.subTest(block_size=block_size, args=args):
+                    self.create('-b', str(block_size), *args)
+                    result = subprocess.run(
+                        ['e2fsck', '-f', '-n', 'cs111-base.img'],
+                        capture_output=True, text=True)
+                    self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_default_unchanged(self):
+        """Test that -b 1024 writes the default image"""
+        env = dict(os.environ, SOURCE_DATE_EPOCH='1700000000')
+        images = []
+        for args in ([], ['-b', '1024']):
+            subprocess.run(['./ext2-create', *args], env=env, check=True)
+            with open('cs111-base.img', 'rb') as f:
+                images.append(f.read())
+        self.assertEqual(images[0], images[1])
+        self.assertEqual(images[0][SUPERBLOCK_OFFSET + 24:
+                                   SUPERBLOCK_OFFSET + 28], bytes(4))
+
+    def test_bad_options(self):
+        """Test that unsupported sizes and too many groups are refused"""
+        for args in (['-b', '512'], ['-b', '8192'], ['-b', '2k'],
+                     ['-g', '33'], ['-b', '2048', '-g', '65']):
+            result = subprocess.run(['./ext2-create', *args],
+                                    capture_output=True)
+            self.assertEqual(result.returncode, 1, args)
+        self.create('-b', '2048', '-g', '33')
+
+    def test_stats(self):
+        """Test that --stats names the block size"""
+        stats = json.loads(self.create('-b', '2048', '--stats'))
+        self.assertEqual(stats['block_size'], 2048)
+
+    def test_fewer_indirect_blocks(self):
+        """Test that larger blocks map the same file with fewer indirect
+        blocks"""
+        src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(src, exist_ok=True)
+        with open(os.path.join(src, 'large'), 'wb') as f:
+            f.write(os.urandom(8 << 20))
+        pointers = {}
+        for block_size in BLOCK_SIZES:
+            path = os.path.join(self.tmpdir, f'large-{block_size}.img')
+            build(src, path, block_size=block_size)
+            with Ext2Image(path) as img:
+                pointers[block_size] = len(pointer_blocks(
+                    img, img.inode(img.resolve('/large'))))
+        # The single and double indirect blocks, then as many of the
+        # double's children as the rest of the 8 MiB needs
+        self.assertEqual(pointers, {1024: 2 + 31, 2048: 2 + 7, 4096: 2 + 1})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_build import Layout, build, copy_range, data_runs
+from ext2_image import EXT2_S_IFLNK, EXT2_S_IFMT, EXT2_S_IFREG, Ext2Image
+from ext2_server import open_image
+
+
+def host_contents(root):
+    """Every path below root with its data or symlink target"""
+    contents = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        prefix = '' if rel == '.' else '/' + rel
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                contents[f'{prefix}/{name}'] = os.readlink(path).encode()
+            elif os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    contents[f'{prefix}/{name}'] = f.read()
+    return contents
+
+
+def image_contents(path):
+    """Every non-directory path in an image with its data or target"""
+    contents = {}
+    with open_image(path) as img:
+        for name, inode in img.walk():
+            kind = inode.mode & EXT2_S_IFMT
+            if kind == EXT2_S_IFLNK:
+                contents[name] = img.read_symlink(inode)
+            elif kind == EXT2_S_IFREG:
+                with img.open_file(inode) as f:
+                    contents[name] = f.read()
+    return contents
+
+
+class TestExt2Build(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make a source tree with holes, zeros, large files and links"""
+        cls.tmpdir = tempfile.mkdtemp()
+        src = cls.src = os.path.join(cls.tmpdir, 'src')
+        os.makedirs(os.path.join(src, 'a', 'b', 'c'))
+        os.makedirs(os.path.join(src, 'empty'))
+        with open(os.path.join(src, 'hello.txt'), 'wb') as f:
+            f.write(b'Hello world\n')
+        with open(os.path.join(src, 'a', 'sparse'), 'wb') as f:
+            f.write(b'head')
+            f.seek(3 << 20)
+            f.write(b'tail')
+        with open(os.path.join(src, 'a', 'zeros'), 'wb') as f:
+            f.write(bytes(300 * 1024))
+        # Past the double indirect block, with data on both sides of
+        # stored zeros
+        with open(os.path.join(src, 'a', 'b', 'large'), 'wb') as f:
+            for i in range(1200):
+                block = bytes(1024) if 400 <= i < 500 else \
+                    (b'%08d' % i) * 128
+                f.write(block)
+        os.link(os.path.join(src, 'hello.txt'),
+                os.path.join(src, 'a', 'b', 'c', 'hardlink'))
+        os.symlink('../hello.txt', os.path.join(src, 'a', 'short'))
+        os.symlink('x' * 200, os.path.join(src, 'a', 'long'))
+        os.mkfifo(os.path.join(src, 'fifo'))
+        cls.image = os.path.join(cls.tmpdir, 'built.img')
+        cls.builder = build(src, cls.image)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_contents(self):
+        """Test that every file and symlink reads back unchanged"""
+        self.assertEqual(image_contents(self.image), host_contents(self.src))
+        self.assertEqual([path for path, _ in self.builder.skipped],
+                         [os.path.join(self.src, 'fifo')])
+
+    def test_holes(self):
+        """Test that holes and zero blocks are left unallocated"""
+        with Ext2Image(self.image) as img:
+            sparse = img.inode(img.resolve('/a/sparse'))
+            self.assertEqual(sparse.size, (3 << 20) + 4)
+            stored = [e for e in img.iter_extents(sparse) if e[1]]
+            self.assertEqual([(e[0], e[2]) for e in stored],
+                             [(0, 1), (3 * 1024, 1)])
+
+            zeros = img.inode(img.resolve('/a/zeros'))
+            self.assertEqual(zeros.blocks, 0)
+            with img.open_file(zeros) as f:
+                self.assertEqual(f.read(), bytes(300 * 1024))
+
+            large = img.inode(img.resolve('/a/b/large'))
+            holes = [e for e in img.iter_extents(large) if not e[1]]
+            self.assertEqual([(e[0], e[2]) for e in holes], [(400, 100)])
+
+    def test_contiguous(self):
+        """Test that data runs break only where indirect blocks go"""
+        with Ext2Image(self.image) as img:
+            large = img.inode(img.resolve('/a/b/large'))
+            extents = [e for e in img.iter_extents(large) if e[1]]
+            # Direct blocks, the single indirect block, then a run for each
+            # double indirect child, split by the hole at 400
+            self.assertEqual([(e[0], e[2]) for e in extents],
+                             [(0, 12), (12, 256), (268, 132), (500, 24),
+                              (524, 256), (780, 256), (1036, 164)])
+            for before, after in zip(extents, extents[1:]):
+                # One indirect block, or two before a new double indirect
+                self.assertLessEqual(after[1] - (before[1] + before[2]), 2)
+
+    def test_links(self):
+        """Test that hard links share an inode and directories count links"""
+        with Ext2Image(self.image) as img:
+            ino = img.resolve('/hello.txt')
+            self.assertEqual(img.resolve('/a/b/c/hardlink'), ino)
+            self.assertEqual(img.inode(ino).links_count, 2)
+            self.assertEqual(img.resolve('/lost+found'), 11)
+            # ., .., lost+found, a and empty
+            self.assertEqual(img.inode(2).links_count, 5)
+            self.assertEqual(img.inode(img.resolve('/a')).links_count, 3)
+            self.assertTrue(img.is_fast_symlink(
+                img.inode(img.resolve('/a/short'))))
+
+    def test_fsck_clean(self):
+        """Test that fsck finds nothing to fix, for each block size"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        for block_size in (1024, 2048, 4096):
+            path = os.path.join(self.tmpdir, f'{block_size}.img')
+            build(self.src, path, block_size=block_size)
+            result = subprocess.run(['e2fsck', '-f', '-n', path],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stdout)
+            self.assertEqual(image_contents(path), host_contents(self.src))
+
+    def test_multiple_groups(self):
+        """Test a fixed size image spanning several groups"""
+        path = os.path.join(self.tmpdir, 'groups.img')
+        build(self.src, path, size_blocks=4 * 8192)
+        with Ext2Image(path) as img:
+            self.assertEqual(img.group_count, 4)
+        self.assertEqual(image_contents(path), host_contents(self.src))
+        if shutil.which('e2fsck') is not None:
+            result = subprocess.run(['e2fsck', '-f', '-n', path],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_data_runs(self):
+        """Test hole detection with and without the zero scan"""
+        path = os.path.join(self.src, 'a', 'b', 'large')
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.assertEqual(data_runs(fd, 1200 * 1024, 1024),
+                             [[0, 400], [500, 700]])
+            self.assertEqual(data_runs(fd, 1200 * 1024, 1024,
+                                       scan_zeros=False), [[0, 1200]])
+        finally:
+            os.close(fd)
+
+    def test_copy_fallbacks(self):
+        """Test that every copy method moves the same bytes"""
+        path = os.path.join(self.src, 'a', 'b', 'large')
+        with open(path, 'rb') as f:
+            expected = f.read()[5000:5000 + 70000]
+        for method in ('copy_file_range', 'sendfile', 'mmap'):
+            out = os.path.join(self.tmpdir, f'{method}.out')
+            with open(path, 'rb') as src, open(out, 'w+b') as dst:
+                dst.truncate(80000)
+                copy_range(src.fileno(), dst.fileno(), 5000, 3000, 70000,
+                           method)
+                dst.seek(3000)
+                self.assertEqual(dst.read(70000), expected, method)
+
+    def fsck(self, path):
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        result = subprocess.run(['e2fsck', '-f', '-n', path],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_inodes_do_not_fit(self):
+        """Test that a fixed size too small for the inodes is refused"""
+        for args in ((1024, 100, 200000, 16 * 8192),
+                     (1024, 16384, 18480, 16384)):
+            with self.assertRaises(ValueError):
+                Layout(*args[:3], size_blocks=args[3])
+
+    def test_small_inode_groups(self):
+        """Test that reserved inodes past a small first group are marked"""
+        path = os.path.join(self.tmpdir, 'small-groups.img')
+        builder = build(os.path.join(self.src, 'a', 'b'), path,
+                        size_blocks=9 * 8192)
+        self.assertEqual(builder.layout.inodes_per_group, 8)
+        self.fsck(path)
+
+    def test_source_lost_found(self):
+        """Test that the source's lost+found fills the image's own"""
+        src = os.path.join(self.tmpdir, 'lost-src')
+        os.makedirs(os.path.join(src, 'lost+found'))
+        with open(os.path.join(src, 'lost+found', '#12'), 'wb') as f:
+            f.write(b'found\n')
+        path = os.path.join(self.tmpdir, 'lost.img')
+        build(src, path)
+        with Ext2Image(path) as img:
+            self.assertEqual([e.name for e in img.iter_dir(2)],
+                             [b'.', b'..', b'lost+found'])
+            self.assertEqual(img.resolve('/lost+found'), 11)
+        self.assertEqual(image_contents(path), host_contents(src))
+        self.fsck(path)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -32,8 +32,7 @@ class TestExt2Comprehensive(unittest.TestCase):
     
     def read_block(self, block_num):
         """Read a block from the image"""
-        self.img_fd.seek(block_num * 1024)
-        return self.img_fd.read(1024)
+        return os.pread(self.img_fd.fileno(), 1024, block_num * 1024)
     
     def test_file_size(self):
         """Test that the image is exactly 1 MiB"""
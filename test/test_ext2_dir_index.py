@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_image import (EXT2_INDEX_FL, EXT2_ROOT_INO, BufferImage,
+                        Ext2Error, Ext2Image)
+from ext2_server import open_image
+
+
+class TestDirIndexImage(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build the image with an indexed root directory"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+        result = subprocess.run(['./ext2-create', '-i'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to create filesystem")
+
+        cls.img = open_image('cs111-base.img')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.img.close()
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def test_feature_flags(self):
+        """Test that dir_index requires and sets the dynamic revision"""
+        sb = self.img.superblock
+        self.assertEqual(sb.rev_level, 1, "dir_index needs s_rev_level 1")
+        self.assertEqual(sb.first_ino, 11)
+        self.assertEqual(sb.inode_size, 128)
+        self.assertTrue(sb.feature_compat & 0x20, "dir_index should be set")
+        self.assertEqual(sb.free_blocks_count, 999, "Leaf block should be used")
+
+    def test_root_inode_indexed(self):
+        """Test that the root inode spans the dx_root and one leaf"""
+        root = self.img.inode(EXT2_ROOT_INO)
+        self.assertTrue(root.flags & EXT2_INDEX_FL, "Root should be indexed")
+        self.assertEqual(root.size, 2048)
+        self.assertEqual(root.blocks, 4)
+        self.assertEqual(root.block[:2], (21, 24))
+
+    def test_lookup_matches_linear_scan(self):
+        """Test that indexed lookups agree with a linear scan"""
+        linear = {e.name: e.inode for e in self.img.iter_dir(EXT2_ROOT_INO)}
+        self.assertEqual(linear, {b'.': 2, b'..': 2, b'lost+found': 11,
+                                  b'hello-world': 12, b'hello': 13})
+        for name, ino in linear.items():
+            self.assertEqual(self.img.lookup(EXT2_ROOT_INO, name), ino)
+        self.assertIsNone(self.img.lookup(EXT2_ROOT_INO, 'missing'))
+        self.assertEqual(self.img.resolve('/hello-world'), 12)
+
+    def test_fsck_accepts_index(self):
+        """Test that fsck finds no problem with the htree"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        result = subprocess.run(['e2fsck', '-f', '-n', 'cs111-base.img'],
+                                capture_output=True, text=True)
+        output = result.stdout + result.stderr
+        self.assertNotIn('HTREE', output.upper())
+        self.assertEqual(result.returncode, 0, output)
+
+
+class TestDirIndexLarge(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build an image whose big directory needs a level of dx_nodes"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+        subprocess.run(['./ext2-create', '-n', '8000', '-g', '2'],
+                       check=True, capture_output=True)
+        cls.img = open_image('cs111-base.img')
+        cls.ino = cls.img.resolve('/big')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.img.close()
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def test_layout(self):
+        """Test that big spans many leaves under dx_nodes and an indirect
+        block"""
+        inode = self.img.inode(self.ino)
+        self.assertTrue(self.img.is_indexed(inode))
+        self.assertEqual(inode.links_count, 2)
+        blocks = self.img.data_blocks(inode)
+        self.assertGreater(len(blocks), 12)
+        self.assertNotEqual(inode.block[12], 0)
+        root = self.img.read_block(blocks[0])
+        self.assertEqual(root[30], 1, "Expected one level of dx_nodes")
+        self.assertEqual(self.img.inode(15).links_count, 8000)
+        self.assertEqual(self.img.superblock.free_inodes_count, 256 - 17)
+
+    def test_lookup_every_name(self):
+        """Test that every entry is found through the index"""
+        linear = {e.name for e in self.img.iter_dir(self.ino)}
+        self.assertEqual(len(linear), 8002)
+        for i in range(8000):
+            self.assertEqual(self.img.lookup(self.ino, f'file-{i}'), 15)
+        self.assertIsNone(self.img.lookup(self.ino, 'file-8000'))
+        self.assertEqual(self.img.resolve('/big/file-4321'), 15)
+
+    def test_fsck_accepts_index(self):
+        """Test that fsck finds no problem with the large htree"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        for args in (['-n', '8000', '-g', '2'], ['-n', '300'],
+                     ['-b', '4096', '-n', '32000', '-g', '2', '-r']):
+            with self.subTest(args=args):
+                subprocess.run(['./ext2-create', *args], check=True)
+                result = subprocess.run(
+                    ['e2fsck', '-f', '-n', 'cs111-base.img'],
+                    capture_output=True, text=True)
+                self.assertEqual(result.returncode, 0, result.stdout)
+        subprocess.run(['./ext2-create', '-n', '8000', '-g', '2'],
+                       check=True)
+
+    def test_bad_entry_counts(self):
+        """Test that no entries, more links than ext2 allows and more
+        blocks than fit are refused"""
+        for args in (['-n', '0'], ['-n', '32001'], ['-n', '20000', '-g', '2']):
+            result = subprocess.run(['./ext2-create', *args],
+                                    capture_output=True)
+            self.assertEqual(result.returncode, 1, args)
+
+
+class TestDirIndexReader(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Index a large directory with e2fsprogs"""
+        for tool in ('mke2fs', 'debugfs', 'e2fsck'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'big.img')
+        subprocess.run(['mke2fs', '-q', '-t', 'ext2', '-b', '1024', '-N',
+                        '4096', '-O', 'dir_index', cls.path, '8M'],
+                       check=True, capture_output=True)
+        # Long names spread the entries over more leaves than one dx_root
+        # can reference, which forces a second index level
+        cls.names = [f"{'x' * 90}-{i}" for i in range(1500)]
+        commands = ['mkdir big'] + [f'write /dev/null big/{name}'
+                                    for name in cls.names]
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.path],
+                       input='\n'.join(commands), text=True,
+                       check=True, capture_output=True)
+        subprocess.run(['e2fsck', '-f', '-y', '-D', cls.path],
+                       capture_output=True)
+        cls.img = Ext2Image(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.img.close()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_directory_indexed(self):
+        """Test that the fixture directory uses a two-level index"""
+        ino = self.img.resolve('/big')
+        inode = self.img.inode(ino)
+        self.assertTrue(self.img.is_indexed(inode))
+        root = self.img.read_block(self.img.data_blocks(inode)[0])
+        self.assertEqual(root[30], 1, "Expected one level of dx_nodes")
+
+    def test_lookup_every_name(self):
+        """Test that every name is found through the index"""
+        ino = self.img.resolve('/big')
+        linear = {e.name: e.inode for e in self.img.iter_dir(ino)}
+        for name in self.names:
+            self.assertEqual(self.img.lookup(ino, name), linear[name.encode()])
+        self.assertIsNone(self.img.lookup(ino, 'x' * 90))
+
+    def test_lookup_maps_only_its_blocks(self):
+        """Test that a lookup follows the pointers to the blocks it reads
+        instead of mapping the whole directory"""
+        ino = self.img.resolve('/big')
+        inode = self.img.inode(ino)
+        blocks = self.img.data_blocks(inode)
+        self.assertGreater(len(blocks), 12, "Expected indirect blocks")
+        self.assertEqual([self.img.logical_block(inode, n)
+                          for n in range(len(blocks))], blocks)
+        with Ext2Image(self.path) as img:
+            def unexpected(inode):
+                raise AssertionError("lookup mapped every block")
+            img.data_blocks = unexpected
+            self.assertEqual(img.lookup(ino, self.names[-1]),
+                             self.img.lookup(ino, self.names[-1]))
+
+    def test_corrupt_index(self):
+        """Test that a damaged dx_root is reported as an Ext2Error"""
+        ino = self.img.resolve('/big')
+        root = self.img.data_blocks(self.img.inode(ino))[0] * 1024
+        with open(self.path, 'rb') as f:
+            image = f.read()
+        # info_length, levels, the count/limit header and the first
+        # entry's block
+        for offset, value in ((29, b'\x40'), (30, b'\x05'),
+                              (32, b'\xff\x7f'), (34, b'\xff\x7f'),
+                              (36, b'\xff\xff\x00\x00')):
+            with self.subTest(offset=offset):
+                data = bytearray(image)
+                data[root + offset:root + offset + len(value)] = value
+                with BufferImage(data) as img:
+                    with self.assertRaises(Ext2Error):
+                        for name in self.names:
+                            img.lookup(ino, name)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
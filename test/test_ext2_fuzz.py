@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import subprocess
+import unittest
+
+from ext2_fuzz import (CHECKERS, Targets, check_edge_cases, check_mistakes,
+                       fuzz, make_mutation)
+
+
+class TestExt2Fuzz(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build the base image and load it into memory"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+        result = subprocess.run(['./ext2-create'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to create filesystem")
+
+        with open('cs111-base.img', 'rb') as f:
+            cls.base = f.read()
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def test_checkers_survive_mutants(self):
+        """Test that no mutant crashes or hangs the checkers"""
+        outcomes, findings = fuzz(self.base, 1000, seed='test')
+        self.assertEqual([f for f in findings if f.kind != 'disagreement'], [])
+        for name in CHECKERS:
+            self.assertEqual(sum(outcomes[name].values()), 1000)
+        for name in ('groups', 'tree'):
+            self.assertGreater(outcomes[name]['rejected'], 0,
+                               f"{name} should reject some mutants")
+
+    def test_existing_checkers(self):
+        """Test that the checks of check_common_mistakes.py and
+        test_edge_cases.py run on a mutant and report what it breaks"""
+        buffer = bytearray(self.base)
+        self.assertEqual(check_mistakes(buffer), [])
+        self.assertEqual(check_edge_cases(buffer), [])
+        # s_free_blocks_count, and the rec_len of hello-world's root entry
+        buffer[1036:1040] = (7).to_bytes(4, 'little')
+        buffer[21 * 1024 + 48:21 * 1024 + 50] = (900).to_bytes(2, 'little')
+        self.assertEqual(check_mistakes(buffer), [
+            "[ERROR] Free blocks should be 1000 (NUM_FREE_BLOCKS), got 7"])
+        problems = check_edge_cases(buffer)
+        self.assertEqual(len(problems), 1, problems)
+        self.assertTrue(problems[0].startswith(
+            'test_directory_entry_boundaries: '))
+
+    def test_mutations_reproducible(self):
+        """Test that a seed and index always give the same mutation"""
+        buffer = bytearray(self.base)
+        targets = Targets(buffer)
+        first = [make_mutation('s', i, buffer, targets) for i in range(50)]
+        again = [make_mutation('s', i, buffer, targets) for i in range(50)]
+        self.assertEqual(first, again)
+        self.assertEqual(len({m.kind for m in first}), 6)
+
+    def test_detects_crash(self):
+        """Test that an unexpected exception is reported with its mutation"""
+        def fragile(buffer):
+            if buffer[1080:1082] != b'\x53\xef':
+                raise IndexError("magic")
+            return []
+
+        _, findings = fuzz(self.base, 200, seed='crash',
+                           checkers={'fragile': fragile})
+        self.assertTrue(findings)
+        for finding in findings:
+            self.assertEqual(finding.kind, 'crash')
+            self.assertIn('s_magic', finding.description)
+            self.assertIn('IndexError', finding.detail)
+
+    def test_detects_hang(self):
+        """Test that a checker stuck in a loop is interrupted"""
+        def stuck(buffer):
+            while buffer[1036:1040] != (1000).to_bytes(4, 'little'):
+                pass
+            return []
+
+        _, findings = fuzz(self.base, 100, seed='hang', timeout=0.05,
+                           checkers={'stuck': stuck})
+        self.assertTrue(findings)
+        for finding in findings:
+            self.assertEqual(finding.kind, 'hang')
+            self.assertIn('s_free_blocks_count', finding.description)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import shutil
+import subprocess
+import unittest
+
+from ext2_image import EXT2_S_IFDIR, EXT2_S_IFLNK, EXT2_S_IFMT
+from ext2_scan import scan
+from ext2_server import open_image
+
+
+def image_contents(path):
+    """Every path with its inode number and, except for directories, data"""
+    contents = {}
+    with open_image(path) as img:
+        for name, inode in img.walk():
+            if (inode.mode & EXT2_S_IFMT) == EXT2_S_IFDIR:
+                contents[name] = (inode.ino, inode.links_count)
+            elif (inode.mode & EXT2_S_IFMT) == EXT2_S_IFLNK:
+                contents[name] = (inode.ino, img.read_symlink(inode))
+            else:
+                with img.open_file(inode) as f:
+                    contents[name] = (inode.ino, f.read())
+    return contents
+
+
+class TestExt2Groups(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build ext2-create"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def create(self, *args):
+        result = subprocess.run(['./ext2-create', *args], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_layout(self):
+        """Test the superblock and the groups after the first"""
+        self.create('-g', '16')
+        with open_image('cs111-base.img') as img:
+            sb = img.superblock
+            self.assertEqual(img.group_count, 16)
+            self.assertEqual(sb.blocks_count, 1 + 16 * 8192)
+            self.assertEqual(sb.inodes_count, 16 * 128)
+            self.assertEqual(img.inode(2).links_count, 3 + 15)
+            for group in range(1, 16):
+                first = 1 + group * 8192
+                desc = img.group_descriptors[group]
+                self.assertEqual((desc.block_bitmap, desc.inode_bitmap,
+                                  desc.inode_table),
+                                 (first + 2, first + 3, first + 4))
+                ino = img.resolve(f'/group-{group}/data')
+                self.assertEqual(ino, group * 128 + 2)
+                with img.open_file(img.inode(ino)) as f:
+                    data = f.read()
+                self.assertEqual(len(data), 12 * 1024)
+                self.assertTrue(data[11 * 1024:].startswith(
+                    f'group {group} block 11\n'.encode()))
+
+        result = scan('cs111-base.img', jobs=1)
+        self.assertEqual(result.anomalies, [])
+        self.assertEqual(result.used_dirs, 2 + 15)
+
+    def test_index_keeps_contents(self):
+        """Test that indexing the root does not change what the image
+        holds"""
+        self.create('-g', '8')
+        plain = image_contents('cs111-base.img')
+        self.create('-g', '8', '-i')
+        self.assertEqual(image_contents('cs111-base.img'), plain)
+
+    def test_fsck_clean(self):
+        """Test that fsck finds nothing to fix in a multi-group image"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        for args in (['-g', '32'], ['-g', '3', '-i']):
+            self.create(*args)
+            result = subprocess.run(['e2fsck', '-f', '-n', 'cs111-base.img'],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_bad_group_count(self):
+        """Test that group counts the descriptor block cannot hold fail"""
+        for count in ('0', '33', 'x'):
+            result = subprocess.run(['./ext2-create', '-g', count],
+                                    capture_output=True)
+            self.assertNotEqual(result.returncode, 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
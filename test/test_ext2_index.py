@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import ext2_index
+from ext2_index import HEADER_FMT, MetadataIndex, sidecar_path
+
+
+class TestExt2Index(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build the image and copy it somewhere the sidecar can live"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+        result = subprocess.run(['./ext2-create'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to create filesystem")
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.image = os.path.join(cls.tmpdir, 'cs111-base.img')
+        shutil.copy('cs111-base.img', cls.image)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def setUp(self):
+        if os.path.exists(sidecar_path(self.image)):
+            os.unlink(sidecar_path(self.image))
+
+    def test_builds_sidecar(self):
+        """Test that the first query writes the sidecar"""
+        self.assertIsNone(MetadataIndex.open(self.image, rebuild=False))
+        with MetadataIndex.open(self.image):
+            pass
+        self.assertTrue(os.path.exists(sidecar_path(self.image)))
+
+    def test_queries_without_image(self):
+        """Test stat and ls against the sidecar alone"""
+        MetadataIndex.open(self.image).close()
+        moved = self.image + '.moved'
+        os.rename(self.image, moved)
+        try:
+            with MetadataIndex(sidecar_path(self.image)) as index:
+                self.assertEqual(index.superblock.inodes_count, 128)
+                self.assertEqual(sorted(index.listdir('/')),
+                                 [('hello', 13), ('hello-world', 12),
+                                  ('lost+found', 11)])
+                self.assertEqual(index.listdir('/lost+found'), [])
+                record = index.stat('/hello-world')
+                self.assertEqual((record.ino, record.size, record.uid),
+                                 (12, 12, 1000))
+                self.assertEqual(index.extents(record), [(0, 23, 1)])
+                self.assertEqual(index.extents(index.stat('/hello')), [])
+                self.assertEqual(index.stat('/').ino, 2)
+                with self.assertRaises(FileNotFoundError):
+                    index.stat('/missing')
+                with self.assertRaises(NotADirectoryError):
+                    index.listdir('/hello-world')
+        finally:
+            os.rename(moved, self.image)
+
+    def test_group_summary(self):
+        """Test the per-group counters recorded from the descriptors and bitmaps"""
+        with MetadataIndex.open(self.image) as index:
+            group = index.group(0)
+            self.assertEqual(group.free_blocks_count, 1000)
+            self.assertEqual(group.free_inodes_count, 115)
+            self.assertEqual(group.used_dirs_count, 2)
+            self.assertEqual(group.dirs_found, 2)
+            self.assertEqual(group.bitmap_free_inodes, 115)
+            # The base image marks blocks 1-24 used but only uses 1-23
+            self.assertEqual(group.bitmap_free_blocks, 999)
+            self.assertEqual(len(index.check()), 1)
+
+    def test_rebuilds_when_image_changes(self):
+        """Test that a stale sidecar is replaced"""
+        with MetadataIndex.open(self.image) as index:
+            built = index.image_mtime_ns
+        with open(self.image, 'r+b') as f:
+            f.seek(1024 + 16)
+            f.write((114).to_bytes(4, 'little'))
+        os.utime(self.image, ns=(built + 10**9, built + 10**9))
+        try:
+            with MetadataIndex.open(self.image) as index:
+                self.assertEqual(index.image_mtime_ns, built + 10**9)
+                self.assertEqual(index.superblock.free_inodes_count, 114)
+        finally:
+            with open(self.image, 'r+b') as f:
+                f.seek(1024 + 16)
+                f.write((115).to_bytes(4, 'little'))
+
+    def test_rebuilt_during_walk(self):
+        """Test that a sidecar built while the image changed is stale"""
+        opened = ext2_index.Ext2Image
+        image = self.image
+        st = os.stat(image)
+
+        def rebuilt(path):
+            img = opened(path)
+            os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+            return img
+
+        ext2_index.Ext2Image = rebuilt
+        try:
+            ext2_index.build(image, sidecar_path(image))
+            self.assertIsNone(MetadataIndex.open(image, rebuild=False))
+        finally:
+            ext2_index.Ext2Image = opened
+            os.utime(image, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    def test_corrupt_sidecar_superblock(self):
+        """Test that a sidecar whose superblock does not parse is rebuilt"""
+        MetadataIndex.open(self.image).close()
+        offset = (HEADER_FMT.size + 7) & ~7
+        with open(sidecar_path(self.image), 'r+b') as f:
+            f.seek(offset + 56)
+            f.write(b'\0\0')
+        self.assertIsNone(MetadataIndex.open(self.image, rebuild=False))
+        with MetadataIndex.open(self.image) as index:
+            self.assertEqual(index.resolve('/hello'), 13)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_build import build
+from ext2_image import Ext2Image
+from ext2_layout import analyze, bucket
+
+
+class TestLayout(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make a fragmented image and a tree to build a contiguous one"""
+        for tool in ('mke2fs', 'debugfs'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        small = os.path.join(cls.tmpdir, 'small')
+        with open(small, 'wb') as f:
+            f.write(b's' * 4096)
+        large = os.path.join(cls.tmpdir, 'large')
+        with open(large, 'wb') as f:
+            f.write(b'l' * (300 * 1024))
+
+        # Freeing every other small file leaves holes the large file fills
+        cls.fragmented = os.path.join(cls.tmpdir, 'fragmented.img')
+        subprocess.run(['mke2fs', '-F', '-q', '-b', '1024', '-I', '128',
+                        cls.fragmented, '4M'], check=True,
+                       capture_output=True)
+        commands = ['mkdir dir']
+        commands += [f'write {small} dir/s{i:02d}' for i in range(60)]
+        commands += [f'rm dir/s{i:02d}' for i in range(0, 60, 2)]
+        commands += [f'write {large} dir/large']
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.fragmented],
+                       input='\n'.join(commands) + '\n', text=True,
+                       check=True, capture_output=True)
+
+        src = os.path.join(cls.tmpdir, 'src')
+        os.makedirs(os.path.join(src, 'a', 'b'))
+        shutil.copy(large, os.path.join(src, 'a', 'large'))
+        for i in range(20):
+            shutil.copy(small, os.path.join(src, 'a', 'b', f's{i}'))
+        cls.built = os.path.join(cls.tmpdir, 'built.img')
+        build(src, cls.built)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_fragmented(self):
+        """Test that a file filling freed holes is the worst one"""
+        with Ext2Image(self.fragmented) as img:
+            report = analyze(img)
+            large = img.resolve('/dir/large')
+        files = report['files']
+        self.assertEqual(files['count'], 31)
+        self.assertEqual(files['fragmented'], 1)
+        self.assertGreater(files['fragmentation_score'], 0)
+        self.assertEqual(files['worst'][0]['ino'], large)
+        self.assertGreater(files['worst'][0]['breaks'], 10)
+        self.assertEqual(files['extents']['max'],
+                         files['worst'][0]['extents'])
+
+    def test_contiguous(self):
+        """Test that breaks for indirect blocks do not count"""
+        with Ext2Image(self.built) as img:
+            report = analyze(img)
+        files = report['files']
+        self.assertEqual(files['fragmentation_score'], 0)
+        self.assertEqual(files['worst'], [])
+        # The large file is split by its indirect blocks all the same:
+        # before the single one and before the double one and its child
+        self.assertEqual(files['extents']['max'], 3)
+        dirs = report['directories']
+        self.assertEqual((dirs['count'], dirs['entries']), (4, 24))
+        self.assertEqual(dirs['same_group'], 1)
+
+    def test_fill_and_free_extents(self):
+        """Test that group fill and free extents agree with the counters"""
+        with Ext2Image(self.fragmented) as img:
+            report = analyze(img)
+            sb = img.superblock
+        used = sum(g['blocks_used'] for g in report['groups'])
+        self.assertEqual(used, sb.blocks_count - sb.first_data_block
+                         - sb.free_blocks_count)
+        free = report['free_extents']
+        self.assertEqual(free['blocks'], sb.free_blocks_count)
+        self.assertEqual(sum(free['histogram'].values()), free['count'])
+        self.assertLessEqual(free['largest'], free['blocks'])
+
+    def test_bucket(self):
+        """Test the histogram labels"""
+        self.assertEqual([bucket(n) for n in (0, 1, 2, 3, 4, 1000)],
+                         ['0', '1', '2-3', '2-3', '4-7', '512-1023'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_image import Ext2Image, coalesce
+from ext2_readahead import learn, load_plan, metadata_plan, save_plan, validate
+
+
+def count_reads(img):
+    """Make img count its reads in img.reads"""
+    read = img.read
+    img.reads = 0
+
+    def counting(offset, size):
+        img.reads += 1
+        return read(offset, size)
+
+    img.read = counting
+
+
+class TestCoalesce(unittest.TestCase):
+
+    def test_runs(self):
+        """Test sorting, merging across small gaps and the run limit"""
+        self.assertEqual(coalesce([9, 4, 3, 5, 20, 4]), [(3, 7), (20, 1)])
+        self.assertEqual(coalesce([1, 3], gap=0), [(1, 1), (3, 1)])
+        self.assertEqual(coalesce(range(10), limit=4),
+                         [(0, 4), (4, 4), (8, 2)])
+        self.assertEqual(coalesce([]), [])
+
+
+class TestReadAhead(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make a multi-group image with directories and indirect blocks"""
+        for tool in ('mke2fs', 'debugfs'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'readahead.img')
+        subprocess.run(['mke2fs', '-q', '-t', 'ext2', '-b', '1024', '-g',
+                        '2048', '-N', '2048', '-I', '128', '-O',
+                        '^resize_inode', cls.path, '16M'],
+                       check=True, capture_output=True)
+        large = os.path.join(cls.tmpdir, 'large')
+        with open(large, 'wb') as f:
+            f.write(os.urandom(300 * 1024))
+        commands = []
+        for d in range(6):
+            commands.append(f'mkdir d{d}')
+            commands.extend(f'write /dev/null d{d}/f{f}' for f in range(30))
+            commands.append(f'write {large} d{d}/large')
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.path],
+                       input='\n'.join(commands), text=True,
+                       check=True, capture_output=True)
+        with Ext2Image(cls.path) as img:
+            cls.plan = learn(img, validate)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_metadata_plan(self):
+        """Test that the declared plan covers what a pass reads first"""
+        with Ext2Image(self.path) as img:
+            plan = metadata_plan(img)
+            self.assertEqual(plan[:3], [1, 2, 3])
+            self.assertEqual(len(set(plan)), len(plan))
+            # bitmaps and a 32-block inode table per group
+            self.assertEqual(len(plan), 2 + img.group_count * 34)
+            for desc in img.group_descriptors:
+                self.assertIn(desc.inode_table + 31, plan)
+
+    def test_learned_plan_needs_no_more_reads(self):
+        """Test that prefetching a learned plan leaves nothing to read"""
+        with Ext2Image(self.path) as img:
+            count_reads(img)
+            validate(img)
+            demand = img.reads
+
+        with Ext2Image(self.path) as img:
+            count_reads(img)
+            img.prefetch(metadata_plan(img) + self.plan)
+            planned = img.reads
+            validate(img)
+            self.assertEqual(img.reads, planned)
+        self.assertLess(planned * 2, demand)
+
+    def test_prefetch_on_decode(self):
+        """Test that decoding an inode brings in its directory and indirect
+        blocks"""
+        with Ext2Image(self.path, readahead=True) as img:
+            d0 = img.inode(img.resolve('/d0'))
+            for block in img.data_blocks(d0):
+                self.assertIn(block, img.block_cache)
+            large = img.inode(img.lookup(d0.ino, 'large'))
+            self.assertIn(large.block[12], img.block_cache)
+            self.assertIn(large.block[13], img.block_cache)
+            with Ext2Image(self.path) as plain:
+                self.assertEqual(list(img.iter_extents(large)),
+                                 list(plain.iter_extents(large)))
+                self.assertEqual(sorted(p for p, _ in img.walk()),
+                                 sorted(p for p, _ in plain.walk()))
+
+    def test_saved_plan(self):
+        """Test that a plan is only reused for the image it was learned on"""
+        plan_path = os.path.join(self.tmpdir, 'plan.json')
+        save_plan(plan_path, self.path, self.plan)
+        self.assertEqual(load_plan(plan_path, self.path), self.plan)
+        os.utime(self.path)
+        self.assertEqual(load_plan(plan_path, self.path), [])
+        self.assertEqual(load_plan(plan_path + '.missing', self.path), [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
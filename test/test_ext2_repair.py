@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from ext2_image import Ext2Image
+from ext2_repair import repair
+from ext2_scan import scan
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class TestRepair(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make an image of several groups holding files of each size"""
+        for tool in ('mke2fs', 'debugfs'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+        cls.tmpdir = tempfile.mkdtemp()
+        large = os.path.join(cls.tmpdir, 'large')
+        with open(large, 'wb') as f:
+            f.write(b'l' * (400 * 1024))
+        small = os.path.join(cls.tmpdir, 'small')
+        with open(small, 'wb') as f:
+            f.write(b's' * 3000)
+        cls.clean = os.path.join(cls.tmpdir, 'clean.img')
+        subprocess.run(['mke2fs', '-F', '-q', '-b', '1024', '-I', '128',
+                        '-g', '1024', '-N', '512', '-O', '^resize_inode',
+                        cls.clean, '4M'], check=True, capture_output=True)
+        commands = ['mkdir a', 'mkdir a/b', f'write {large} a/large']
+        commands += [f'write {small} a/b/s{i}' for i in range(20)]
+        commands += [f'rm a/b/s{i}' for i in range(0, 20, 3)]
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.clean],
+                       input='\n'.join(commands) + '\n', text=True,
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def copy(self, name):
+        path = os.path.join(self.tmpdir, name)
+        shutil.copy(self.clean, path)
+        return path
+
+    def corrupt(self, path):
+        """Break the counters and bitmap bits the way a generator bug
+        would, returning the block numbers of the large file"""
+        with Ext2Image(path) as img:
+            large = img.data_blocks(img.inode(img.resolve('/a/large')))
+            desc = img.group_descriptors
+            inode_bitmap = desc[0].inode_bitmap
+        with open(path, 'r+b') as f:
+            f.seek(1024 + 12)
+            f.write(struct.pack('<II', 7, 9))
+            # bg_free_blocks_count of group 1, bg_used_dirs_count of group 0
+            f.seek(2 * 1024 + 32 + 12)
+            f.write(struct.pack('<H', 1))
+            f.seek(2 * 1024 + 16)
+            f.write(struct.pack('<H', 40))
+            # A data block marked free and a free inode marked used
+            group, bit = divmod(large[-1] - 1, 1024)
+            offset = desc[group].block_bitmap * 1024 + bit // 8
+            f.seek(offset)
+            byte = f.read(1)[0]
+            f.seek(offset)
+            f.write(bytes([byte & ~(1 << bit % 8)]))
+            f.seek(inode_bitmap * 1024 + 10)
+            f.write(b'\x01')
+        return large
+
+    def test_clean(self):
+        """Test that a consistent image is left alone"""
+        path = self.copy('clean-copy.img')
+        result = repair(path)
+        self.assertEqual(result, ([], [], 0, 0))
+        self.assertEqual(read(path), read(self.clean))
+
+    def test_repairs(self):
+        """Test that repair undoes the damage and nothing else"""
+        path = self.copy('broken.img')
+        large = self.corrupt(path)
+        self.assertNotEqual(scan(path, jobs=1).anomalies, [])
+        result = repair(path)
+        self.assertEqual(result.unrepaired, [])
+        self.assertEqual(read(path), read(self.clean))
+        self.assertEqual(scan(path, jobs=1).anomalies, [])
+        self.assertIn("s_free_blocks_count: 7 -> ", '\n'.join(result.changes))
+        self.assertIn("group 0 bg_used_dirs_count: 40 -> 4", result.changes)
+        self.assertIn(f"1 set ({large[-1]})", '\n'.join(result.changes))
+        self.assertIn("group 0 inode bitmap, inodes: 1 cleared (81)",
+                      result.changes)
+        # The superblock, descriptors and group 0's two bitmaps, which sit
+        # next to each other, in one write
+        self.assertEqual((result.blocks, result.writes), (4, 1))
+
+    def test_dry_run(self):
+        """Test that a dry run reports the same changes and writes nothing"""
+        path = self.copy('dry.img')
+        self.corrupt(path)
+        before = read(path)
+        dry = repair(path, dry_run=True)
+        self.assertEqual(read(path), before)
+        self.assertEqual((dry.blocks, dry.writes), (0, 0))
+        self.assertEqual(dry.changes, repair(path).changes)
+
+    def test_dangling_entry(self):
+        """Test that an entry naming a cleared inode is reported and the
+        inode and its blocks are freed"""
+        path = self.copy('dangling.img')
+        with Ext2Image(path) as img:
+            ino = img.resolve('/a/b/s1')
+            free_blocks = img.superblock.free_blocks_count
+        subprocess.run(['debugfs', '-w', '-R', 'clri a/b/s1', path],
+                       check=True, capture_output=True)
+        result = repair(path)
+        self.assertEqual(len(result.unrepaired), 1)
+        self.assertIn(f"names inode {ino}", result.unrepaired[0])
+        with Ext2Image(path) as img:
+            self.assertEqual(img.superblock.free_blocks_count,
+                             free_blocks + 3)
+
+    def test_base_image(self):
+        """Test that the base image passes e2fsck once repaired"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        result = subprocess.run(['./ext2-create'], capture_output=True)
+        self.assertEqual(result.returncode, 0)
+        path = os.path.join(self.tmpdir, 'base.img')
+        shutil.copy('cs111-base.img', path)
+        result = repair(path)
+        self.assertEqual(result.writes, 1)
+        self.assertEqual(scan(path, jobs=1).anomalies, [])
+        result = subprocess.run(['e2fsck', '-f', '-n', path],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stdout)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_build import build, uuid_from_seed
+from ext2_server import open_image
+
+EPOCH = 1700000000
+
+
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class TestReproducible(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build ext2-create"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def create(self, *args, epoch=EPOCH):
+        env = dict(os.environ)
+        env.pop('SOURCE_DATE_EPOCH', None)
+        if epoch is not None:
+            env['SOURCE_DATE_EPOCH'] = str(epoch)
+        result = subprocess.run(['./ext2-create', *args], env=env,
+                                capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return digest('cs111-base.img')
+
+    def test_byte_identical(self):
+        """Test that builds with the same epoch and options match exactly"""
+        self.assertEqual(self.create(), self.create())
+        self.assertEqual(self.create('-g', '6'), self.create('-g', '6'))
+        self.assertEqual(self.create('-i', '-s', '7'),
+                         self.create('-i', '-s', '7'))
+        self.assertNotEqual(self.create(), self.create(epoch=EPOCH + 1))
+
+    def test_epoch(self):
+        """Test that every timestamp is SOURCE_DATE_EPOCH"""
+        self.create('-g', '2')
+        with open_image('cs111-base.img') as img:
+            self.assertEqual(img.superblock.wtime, EPOCH)
+            self.assertEqual(img.superblock.lastcheck, EPOCH)
+            for _, inode in img.walk():
+                self.assertEqual((inode.atime, inode.ctime, inode.mtime),
+                                 (EPOCH, EPOCH, EPOCH))
+
+    def test_bad_epoch(self):
+        """Test that a SOURCE_DATE_EPOCH that is not a time fails"""
+        for epoch in ('', 'soon', '-1', str(1 << 32)):
+            env = dict(os.environ, SOURCE_DATE_EPOCH=epoch)
+            result = subprocess.run(['./ext2-create'], env=env,
+                                    capture_output=True)
+            self.assertNotEqual(result.returncode, 0, epoch)
+
+    def test_seed(self):
+        """Test that the UUID comes from the seed"""
+        self.create('-s', '42')
+        with open_image('cs111-base.img') as img:
+            self.assertEqual(img.superblock.uuid, uuid_from_seed(42).bytes)
+        self.assertNotEqual(self.create('-s', '1'), self.create('-s', '2'))
+        if shutil.which('e2fsck') is not None:
+            # The directory index is hashed with the UUID as its seed
+            self.create('-g', '3', '-i', '-s', '3')
+            result = subprocess.run(['e2fsck', '-f', '-n', 'cs111-base.img'],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_directory_padding(self):
+        """Test that directory blocks hold nothing past their entries"""
+        self.create(epoch=None)
+        with open_image('cs111-base.img') as img:
+            for path in ('/', '/lost+found'):
+                inode = img.inode(img.resolve(path))
+                data = img.read_block(inode.block[0])
+                offset = 0
+                while offset < len(data):
+                    rec_len = int.from_bytes(data[offset + 4:offset + 6],
+                                             'little')
+                    name_len = int.from_bytes(data[offset + 6:offset + 8],
+                                              'little')
+                    tail = data[offset + 8 + name_len:offset + rec_len]
+                    self.assertEqual(tail, bytes(len(tail)), path)
+                    offset += rec_len
+
+    def test_build_from_tree(self):
+        """Test that ext2_build is reproducible with an epoch and a seed"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmpdir, 'src')
+            os.makedirs(os.path.join(src, 'dir'))
+            with open(os.path.join(src, 'dir', 'file'), 'wb') as f:
+                f.write(b'contents\n' * 1000)
+            images = []
+            for name in ('one.img', 'two.img'):
+                path = os.path.join(tmpdir, name)
+                build(src, path, epoch=EPOCH, seed=5)
+                images.append(digest(path))
+                os.utime(os.path.join(src, 'dir', 'file'))
+            self.assertEqual(images[0], images[1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import shutil
+import subprocess
+import unittest
+
+from ext2_image import (EXT2_FEATURE_INCOMPAT_FILETYPE,
+                        EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER, EXT2_FT_DIR,
+                        EXT2_FT_REG_FILE, EXT2_FT_SYMLINK, EXT2_ROOT_INO,
+                        EXT2_S_IFMT, MODE_FILE_TYPES, SUPERBLOCK_OFFSET)
+from ext2_repair import repair
+from ext2_scan import scan
+from ext2_server import open_image
+
+
+def inode_reads(img):
+    """Count the inodes img decodes from now on"""
+    counts = []
+    load = img.inode
+
+    def counted(ino):
+        counts.append(ino)
+        return load(ino)
+
+    img.inode = counted
+    return counts
+
+
+class TestRevision(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build ext2-create"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def create(self, *args):
+        result = subprocess.run(['./ext2-create', *args], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_superblock(self):
+        """Test that -r writes a revision 1 superblock with its features"""
+        self.create('-r')
+        with open_image('cs111-base.img') as img:
+            sb = img.superblock
+            self.assertEqual(sb.rev_level, 1)
+            self.assertEqual(sb.first_ino, 11)
+            self.assertEqual(sb.inode_size, 128)
+            self.assertEqual(sb.feature_compat, 0)
+            self.assertEqual(sb.feature_incompat,
+                             EXT2_FEATURE_INCOMPAT_FILETYPE)
+            self.assertEqual(sb.feature_ro_compat,
+                             EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER)
+            self.assertEqual(sb.free_blocks_count, 1000)
+        self.assertEqual(scan('cs111-base.img', jobs=1).anomalies, [])
+
+    def test_inode_size(self):
+        """Test that -I spreads the inode table over more blocks"""
+        self.create('-I', '256', '-g', '2')
+        with open_image('cs111-base.img') as img:
+            self.assertEqual(img.superblock.rev_level, 1)
+            self.assertEqual(img.inode_size, 256)
+            desc = img.group_descriptors
+            root = img.inode(EXT2_ROOT_INO)
+            self.assertEqual(root.block[0], desc[0].inode_table + 32)
+            data = img.inode(img.resolve('/group-1/data'))
+            self.assertEqual(data.size, 12 * 1024)
+            self.assertEqual(data.block[0], desc[1].inode_table + 33)
+        self.assertEqual(scan('cs111-base.img', jobs=1).anomalies, [])
+
+    def test_file_types(self):
+        """Test that every entry's file type matches its inode"""
+        for args in ([], ['-i'], ['-g', '3']):
+            with self.subTest(args=args):
+                self.create('-r', *args)
+                with open_image('cs111-base.img') as img:
+                    dirs = [EXT2_ROOT_INO]
+                    while dirs:
+                        for entry in img.iter_dir(dirs.pop()):
+                            mode = img.inode(entry.inode).mode
+                            self.assertEqual(
+                                entry.file_type,
+                                MODE_FILE_TYPES[mode & EXT2_S_IFMT],
+                                entry.name)
+                            if entry.file_type == EXT2_FT_DIR and \
+                                    entry.name not in (b'.', b'..'):
+                                dirs.append(entry.inode)
+
+    def test_default_unchanged(self):
+        """Test that without -r the entries keep a zero file type"""
+        self.create('-g', '3')
+        with open_image('cs111-base.img') as img:
+            self.assertEqual(img.superblock.rev_level, 0)
+            self.assertFalse(img.has_filetype)
+            self.assertEqual(
+                {e.file_type for _, e in img.walk_entries()}, {0})
+
+    def test_sparse_super(self):
+        """Test that only groups 0, 1 and powers of 3, 5 and 7 hold
+        superblock copies, each naming its group"""
+        self.create('-r', '-g', '10')
+        with open_image('cs111-base.img') as img, \
+                open('cs111-base.img', 'rb') as f:
+            has_super = [g for g in range(img.group_count)
+                         if img.group_has_super(g)]
+            self.assertEqual(has_super, [0, 1, 3, 5, 7, 9])
+            for group in range(1, img.group_count):
+                first, _ = img.group_blocks(group)
+                f.seek(first * 1024)
+                backup = f.read(1024)
+                if group in has_super:
+                    f.seek(SUPERBLOCK_OFFSET)
+                    primary = f.read(1024)
+                    self.assertEqual(backup[90:92],
+                                     group.to_bytes(2, 'little'))
+                    self.assertEqual(backup[:90], primary[:90])
+                    self.assertEqual(img.group_descriptors[group]
+                                     .free_blocks_count, 8192 - 33)
+                else:
+                    self.assertEqual(backup, bytes(1024))
+                    self.assertEqual(img.group_descriptors[group]
+                                     .free_blocks_count, 8192 - 31)
+        self.assertEqual(scan('cs111-base.img', jobs=1).anomalies, [])
+        self.assertEqual(repair('cs111-base.img', dry_run=True).changes, [])
+
+    def test_walk_skips_inode_reads(self):
+        """Test that a walk over filetype entries reads only the
+        directories' inodes and finds what a revision 0 walk finds"""
+        found = {}
+        for args in ([], ['-r']):
+            self.create('-g', '5', *args)
+            with open_image('cs111-base.img') as img:
+                reads = inode_reads(img)
+                found[bool(args)] = {
+                    ft: [path for path, _ in img.walk_entries(types={ft})]
+                    for ft in (EXT2_FT_REG_FILE, EXT2_FT_DIR,
+                               EXT2_FT_SYMLINK)}
+                if args:
+                    # The root, lost+found and four group directories
+                    self.assertEqual(sorted(set(reads)),
+                                     [2, 11, 129, 257, 385, 513])
+                else:
+                    self.assertIn(12, reads)
+        self.assertEqual(found[False], found[True])
+        self.assertEqual(found[True][EXT2_FT_SYMLINK], ['/hello'])
+
+    def test_fsck_clean(self):
+        """Test that fsck finds nothing to fix in revision 1 images"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        for args in (['-r'], ['-r', '-i'], ['-I', '512', '-g', '4'],
+                     ['-r', '-g', '28', '-i'],
+                     ['-b', '4096', '-I', '1024', '-g', '9']):
+            with self.subTest(args=args):
+                self.create(*args)
+                result = subprocess.run(
+                    ['e2fsck', '-f', '-n', 'cs111-base.img'],
+                    capture_output=True, text=True)
+                self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_bad_inode_size(self):
+        """Test that inode sizes that are not a power of two from 128 up to
+        the block size are refused"""
+        for args in (['-I', '100'], ['-I', '384'], ['-I', '2048'],
+                     ['-I', 'big']):
+            result = subprocess.run(['./ext2-create', *args],
+                                    capture_output=True)
+            self.assertEqual(result.returncode, 1, args)
+        self.create('-b', '2048', '-I', '2048')
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import ext2_scan
+from ext2_image import Ext2Image
+from ext2_scan import scan
+
+
+class TestExt2ScanBaseImage(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build the base image"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+        result = subprocess.run(['./ext2-create'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to create filesystem")
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def test_single_group(self):
+        """Test the summary of the one group in the base image"""
+        result = scan('cs111-base.img', jobs=1)
+        self.assertEqual(len(result.groups), 1)
+        self.assertEqual(result.free_inodes, 115)
+        self.assertEqual(result.used_dirs, 2)
+        # Block 24 is marked used in the bitmap without being used
+        self.assertEqual(result.free_blocks, 999)
+        self.assertEqual(result.anomalies, [
+            "group 0: bg_free_blocks_count is 1000, counted 999",
+            "s_free_blocks_count is 1000, counted 999",
+        ])
+        # The serial path leaves no worker mapping behind
+        self.assertIsNone(ext2_scan._worker_map)
+
+
+class TestExt2ScanManyGroups(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make an image with many small groups"""
+        if shutil.which('mke2fs') is None:
+            raise unittest.SkipTest("mke2fs not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'groups.img')
+        subprocess.run(['mke2fs', '-q', '-t', 'ext2', '-b', '1024', '-g', '256',
+                        '-N', '8192', '-O', '^resize_inode', cls.path, '32M'],
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_parallel_matches_serial(self):
+        """Test that splitting groups over workers changes nothing"""
+        serial = scan(self.path, jobs=1)
+        parallel = scan(self.path, jobs=4)
+        self.assertEqual(len(serial.groups), 128)
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial.anomalies, [])
+        with Ext2Image(self.path) as img:
+            self.assertEqual(serial.free_blocks, img.superblock.free_blocks_count)
+            self.assertEqual(serial.free_inodes, img.superblock.free_inodes_count)
+
+    def test_reports_bad_group(self):
+        """Test that a wrong descriptor counter is pinned to its group"""
+        path = os.path.join(self.tmpdir, 'bad.img')
+        shutil.copy(self.path, path)
+        with open(path, 'r+b') as f:
+            # bg_free_inodes_count of group 77
+            f.seek(2 * 1024 + 77 * 32 + 14)
+            f.write((1).to_bytes(2, 'little'))
+        result = scan(path, jobs=3)
+        self.assertEqual(result.anomalies,
+                         ["group 77: bg_free_inodes_count is 1, counted 64"])
+
+    def test_descriptor_past_end(self):
+        """Test that bitmaps and tables past the end of the image are
+        reported, not crashed on"""
+        path = os.path.join(self.tmpdir, 'past-end.img')
+        shutil.copy(self.path, path)
+        with open(path, 'r+b') as f:
+            # bg_block_bitmap of group 5 and bg_inode_table of group 9
+            f.seek(2 * 1024 + 5 * 32)
+            f.write((10**6).to_bytes(4, 'little'))
+            f.seek(2 * 1024 + 9 * 32 + 8)
+            f.write((10**6).to_bytes(4, 'little'))
+        for jobs in (1, 3):
+            result = scan(path, jobs=jobs)
+            self.assertIn("group 5: block bitmap at block 1000000 lies past "
+                          "the end of the image", result.anomalies)
+            self.assertIn("group 9: inode table at block 1000000 lies past "
+                          "the end of the image", result.anomalies)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
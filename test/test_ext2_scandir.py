@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_image import Ext2Image
+
+
+class TestScandir(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make a directory whose entries are out of inode order"""
+        for tool in ('mke2fs', 'debugfs'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'scandir.img')
+        subprocess.run(['mke2fs', '-F', '-q', '-b', '1024', '-I', '128',
+                        '-N', '4096', '-O', '^resize_inode', cls.path, '8M'],
+                       check=True, capture_output=True)
+        commands = ['mkdir big', 'mkdir other']
+        for i in range(600):
+            commands.append(f'write /dev/null big/f{i:04d}')
+            commands.append(f'write /dev/null other/f{i:04d}')
+        # New entries fill the freed space in the middle of the directory,
+        # the links with inodes from the start of the table
+        commands += [f'rm big/f{i:04d}' for i in range(100, 200)]
+        commands += [f'ln other/f{i:04d} big/h{i:03d}' for i in range(50)]
+        commands += [f'symlink big/s{i:03d} /target' for i in range(50)]
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.path],
+                       input='\n'.join(commands) + '\n', text=True,
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_matches_inodes(self):
+        """Test that every record agrees with the inode it names"""
+        with Ext2Image(self.path) as img:
+            ino = img.resolve('/big')
+            records = list(img.scandir(ino))
+            self.assertEqual(sorted(r.name for r in records), sorted(
+                e.name for e in img.iter_dir(ino)
+                if e.name not in (b'.', b'..')))
+            self.assertEqual(len(records), 600)
+            for r in records:
+                inode = img.inode(r.ino)
+                self.assertEqual(
+                    (r.mode, r.uid, r.gid, r.size, r.atime, r.ctime, r.mtime,
+                     r.links_count, r.blocks),
+                    (inode.mode, inode.uid, inode.gid, inode.size,
+                     inode.atime, inode.ctime, inode.mtime,
+                     inode.links_count, inode.blocks))
+            inos = [r.ino for r in records]
+            self.assertEqual(inos, sorted(inos))
+            self.assertNotEqual([e.inode for e in img.iter_dir(ino)][2:],
+                                inos, "Directory order is not table order")
+
+    def test_table_blocks_read_once(self):
+        """Test that a small cache still reads each table block once"""
+        with Ext2Image(self.path, cache_blocks=32) as img:
+            ino = img.resolve('/big')
+            tables = set()
+            for desc in img.group_descriptors:
+                n = img.superblock.inodes_per_group * 128 // 1024
+                tables.update(range(desc.inode_table, desc.inode_table + n))
+            blocks = []
+            reads = []
+            read = img.read
+
+            def recording(offset, size):
+                first = offset // 1024
+                reads.append(first)
+                blocks.extend(range(first, first + -(-size // 1024)))
+                return read(offset, size)
+
+            img.read = recording
+            list(img.scandir(ino))
+            table_reads = [b for b in blocks if b in tables]
+            self.assertTrue(table_reads)
+            self.assertEqual(len(table_reads), len(set(table_reads)))
+            # The blocks are fetched in coalesced runs, not one by one
+            self.assertLess(len([b for b in reads if b in tables]),
+                            len(table_reads))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from ext2_image import (EXT2_S_IFLNK, EXT2_S_IFMT, EXT2_S_IFREG, Ext2Error,
+                        Ext2Image)
+from ext2_server import (INODE_RECORD, OP_BLOCKS, OP_INODES, OP_PATHS,
+                         BlockClient, ServerImage, open_image, socket_path)
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'ext2_server.py')
+
+
+def contents(img):
+    """Every path in an image with its inode and data or target"""
+    found = {}
+    for name, inode in img.walk():
+        kind = inode.mode & EXT2_S_IFMT
+        data = None
+        if kind == EXT2_S_IFLNK:
+            data = img.read_symlink(inode)
+        elif kind == EXT2_S_IFREG:
+            with img.open_file(inode) as f:
+                data = f.read()
+        found[name] = (inode, data)
+    return found
+
+
+def walk_through_server(path):
+    with ServerImage(path) as img:
+        return sorted((name, inode.ino) for name, inode in img.walk())
+
+
+class TestServer(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Serve a copy of a several group image from a server process"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+        cls.tmpdir = tempfile.mkdtemp()
+        subprocess.run(['./ext2-create', '-g', '4'], check=True)
+        cls.image = os.path.join(cls.tmpdir, 'base.img')
+        shutil.copy('cs111-base.img', cls.image)
+        cls.socket = socket_path(cls.image)
+        cls.server = subprocess.Popen([sys.executable, SERVER, cls.image],
+                                      stdout=subprocess.PIPE, text=True)
+        cls.server.stdout.readline()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.terminate()
+        cls.server.wait()
+        shutil.rmtree(cls.tmpdir)
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def test_same_contents(self):
+        """Test that the served image reads like the image itself"""
+        with Ext2Image(self.image) as img:
+            expected = contents(img)
+        with ServerImage(self.socket) as img:
+            self.assertEqual(contents(img), expected)
+            self.assertEqual(img.resolve('/group-3/data'),
+                             expected['/group-3/data'][0].ino)
+            with self.assertRaises(FileNotFoundError):
+                img.resolve('/missing')
+
+    def test_shared_cache(self):
+        """Test that processes walking the same tree share what the server
+        decodes"""
+        with BlockClient(self.socket) as client:
+            before = client.stats()
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(4) as pool:
+                walks = pool.map(walk_through_server, [self.socket] * 8)
+            after = client.stats()
+        self.assertEqual(len({tuple(walk) for walk in walks}), 1)
+        inodes = {ino for _, ino in walks[0]}
+        # A warm cache decodes nothing again, a cold one each inode once
+        self.assertLessEqual(after['inodes_decoded'] - before['inodes_decoded'],
+                             len(inodes))
+        self.assertGreaterEqual(after['connections'] - before['connections'],
+                                8)
+
+    def test_pipelined_batches(self):
+        """Test that replies to requests sent ahead come back tagged, and an
+        error in one leaves the rest alone"""
+        with Ext2Image(self.image) as img:
+            bs = img.block_size
+            blocks = [img.read_block(n) for n in (5, 6, 7, 30, 2)]
+            blocks_count = img.superblock.blocks_count
+            root = img.inode(2)
+        with BlockClient(self.socket) as client:
+            first = client.send(OP_BLOCKS, b''.join(
+                n.to_bytes(4, 'little') for n in (5, 6, 7, 30, 2)))
+            bad = client.send(OP_BLOCKS, blocks_count.to_bytes(4, 'little'))
+            paths = client.send(OP_PATHS, b'/\0/hello\0/nope')
+            inodes = client.send(OP_INODES, (2).to_bytes(4, 'little'))
+            self.assertEqual(client.inodes([2])[0], root)
+            self.assertEqual(client.reply(paths),
+                             b''.join(n.to_bytes(4, 'little')
+                                      for n in (2, 13, 0)))
+            self.assertEqual(client.reply(first), b''.join(blocks))
+            with self.assertRaises(Ext2Error):
+                client.reply(bad)
+            self.assertEqual(len(client.reply(inodes)), INODE_RECORD.size)
+            self.assertEqual(client.read([(0, 0), (bs * 5, 10)]),
+                             [b'', blocks[0][:10]])
+            self.assertEqual(client.resolve(['/lost+found', '/x']), [11, None])
+
+    def test_image_replaced(self):
+        """Test that the server notices a rebuilt image"""
+        with open_image(self.image) as img:
+            self.assertIsInstance(img, ServerImage)
+            self.assertEqual(img.superblock.rev_level, 0)
+        subprocess.run(['./ext2-create', '-r', '-g', '2'], check=True)
+        replaced = os.path.join(self.tmpdir, 'replaced.img')
+        shutil.copy(self.image, replaced)
+        try:
+            with BlockClient(self.socket) as client:
+                reloads = client.stats()['reloads']
+                self.replace_image()
+                with ServerImage(self.socket) as img:
+                    self.assertEqual(img.superblock.rev_level, 1)
+                    self.assertIsNone(img.lookup(2, 'group-3'))
+                self.assertEqual(client.stats()['reloads'], reloads + 1)
+        finally:
+            os.replace(replaced, self.image)
+
+    def test_reload_drops_client_cache(self):
+        """Test that a client open across a reload stops answering from the
+        blocks and inodes it cached before it"""
+        subprocess.run(['./ext2-create', '-r', '-g', '2'], check=True)
+        replaced = os.path.join(self.tmpdir, 'replaced.img')
+        shutil.copy(self.image, replaced)
+        try:
+            with ServerImage(self.socket) as img:
+                self.assertIsNotNone(img.lookup(2, 'group-3'))
+                self.replace_image()
+                img.resolve('/lost+found')
+                self.assertEqual(img.superblock.rev_level, 1)
+                self.assertIsNone(img.lookup(2, 'group-3'))
+        finally:
+            os.replace(replaced, self.image)
+
+    def replace_image(self):
+        """Put the freshly built image in place of the served one"""
+        tmp = self.image + '.new'
+        shutil.copy('cs111-base.img', tmp)
+        os.replace(tmp, self.image)
+
+    def test_rebuilt_in_place(self):
+        """Test that rebuilding a served image in place while requests are
+        running gives errors or answers, never a dead server"""
+        create = os.path.abspath('ext2-create')
+        subprocess.run([create, '-g', '8'], cwd=self.tmpdir, check=True)
+        image = os.path.join(self.tmpdir, 'cs111-base.img')
+        server = subprocess.Popen([sys.executable, SERVER, image],
+                                  stdout=subprocess.PIPE, text=True)
+        done = threading.Event()
+        finished = []
+        try:
+            server.stdout.readline()
+
+            def hammer():
+                with BlockClient(socket_path(image)) as client:
+                    while not done.is_set():
+                        try:
+                            client.read([(0, 2048), (60 << 20, 1024)])
+                            client.resolve(['/group-7/data'])
+                        except Ext2Error:
+                            pass
+                    finished.append(client.stats()['requests'])
+
+            threads = [threading.Thread(target=hammer) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for i in range(10):
+                args = ['-g', '8'] if i % 2 else ['-g', '2', '-r']
+                subprocess.run([create, *args], cwd=self.tmpdir, check=True)
+            subprocess.run([create, '-g', '8'], cwd=self.tmpdir, check=True)
+            done.set()
+            for thread in threads:
+                thread.join()
+            self.assertIsNone(server.poll())
+            # Each thread's connection still answers once the rebuilds end
+            self.assertEqual(len(finished), 4)
+            with Ext2Image(image) as img:
+                expected = img.resolve('/group-7/data')
+            with ServerImage(socket_path(image)) as img:
+                self.assertEqual(img.superblock.rev_level, 0)
+                self.assertEqual(img.resolve('/group-7/data'), expected)
+        finally:
+            done.set()
+            server.terminate()
+            server.wait()
+
+    def test_fallback(self):
+        """Test that an image nobody serves is opened directly"""
+        with open_image('cs111-base.img') as img:
+            self.assertIs(type(img), Ext2Image)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import json
+import subprocess
+import unittest
+
+
+class TestExt2Stats(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build ext2-create"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+    @classmethod
+    def tearDownClass(cls):
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def stats(self, *args):
+        result = subprocess.run(['./ext2-create', '--stats', *args],
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout)
+
+    def test_quiet_by_default(self):
+        """Test that nothing is printed without --stats"""
+        result = subprocess.run(['./ext2-create'], capture_output=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, b'')
+
+    def test_base_image(self):
+        """Test the phases and write totals of the base image"""
+        stats = self.stats()
+        self.assertEqual(list(stats['phases_ns']), [
+            'write_block_bitmap', 'write_inode_bitmap', 'write_inode_table',
+            'write_root_dir_block', 'write_lost_and_found_dir_block',
+            'write_hello_world_file_block', 'write_superblock',
+            'write_block_group_descriptor_table',
+        ])
+        self.assertGreaterEqual(stats['total_ns'],
+                                sum(stats['phases_ns'].values()))
+        syscalls = stats['syscalls']
+        # Superblock, descriptors, two bitmaps, four inodes, two directory
+        # blocks and "Hello world\n"
+        self.assertEqual(syscalls['write']['bytes'],
+                         4 * 1024 + 4 * 128 + 2 * 1024 + 12)
+        self.assertEqual(syscalls['pwrite'], {'calls': 0, 'bytes': 0})
+        self.assertGreater(syscalls['lseek']['calls'], 0)
+        self.assertGreater(stats['peak_rss_kb'], 0)
+
+    def test_groups(self):
+        """Test that the writes of the groups after the first are
+        counted"""
+        stats = self.stats('-g', '4')
+        self.assertEqual(stats['groups'], 4)
+        self.assertIn('write_groups', stats['phases_ns'])
+        # Bitmaps, inode table, directory and file of each extra group
+        per_group = 2 * 1024 + 16 * 1024 + 1024 + 12 * 1024
+        self.assertEqual(stats['syscalls']['pwrite'],
+                         {'calls': 3 * 5, 'bytes': 3 * per_group})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
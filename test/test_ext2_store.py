@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from ext2_build import build
+from ext2_image import EXT2_S_IFLNK, EXT2_S_IFMT, EXT2_S_IFREG, Ext2Image
+from ext2_store import BlockStore, StoreImage
+
+EPOCH = 1700000000
+
+
+def contents(img):
+    """Every non-directory path in an image with its data or target"""
+    found = {}
+    for name, inode in img.walk():
+        kind = inode.mode & EXT2_S_IFMT
+        if kind == EXT2_S_IFLNK:
+            found[name] = img.read_symlink(inode)
+        elif kind == EXT2_S_IFREG:
+            with img.open_file(inode) as f:
+                found[name] = f.read()
+    return found
+
+
+class TestBlockStore(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build two images of a tree that differ in one small file"""
+        cls.tmpdir = tempfile.mkdtemp()
+        src = os.path.join(cls.tmpdir, 'src')
+        os.makedirs(os.path.join(src, 'a', 'b'))
+        with open(os.path.join(src, 'a', 'random'), 'wb') as f:
+            f.write(random.Random(1).randbytes(400 * 1024))
+        with open(os.path.join(src, 'a', 'b', 'sparse'), 'wb') as f:
+            f.write(b'head')
+            f.seek(2 << 20)
+            f.write(b'tail')
+        os.symlink('a/random', os.path.join(src, 'link'))
+        cls.images = []
+        for version in range(2):
+            with open(os.path.join(src, 'version'), 'w') as f:
+                f.write(f'version {version}\n')
+            os.utime(os.path.join(src, 'version'), (EPOCH, EPOCH))
+            path = os.path.join(cls.tmpdir, f'v{version}.img')
+            build(src, path, size_blocks=8192, epoch=EPOCH, seed=1,
+                  owner=(0, 0))
+            cls.images.append(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(dir=self.tmpdir)
+
+    def test_dedup(self):
+        """Test that a near identical image stores only what changed"""
+        v0, v1 = self.images
+        with BlockStore(self.root) as store:
+            first = store.put('v0', v0)
+            self.assertEqual(first.chunks, os.path.getsize(v0) // 1024)
+            self.assertGreater(first.zero, first.chunks // 2)
+            self.assertEqual(first.new, first.chunks - first.zero)
+            second = store.put('v1', v1)
+            self.assertEqual(second.chunks, first.chunks)
+            self.assertGreater(second.new, 0)
+            self.assertLess(second.new, 5)
+            stats = store.stats()
+        self.assertEqual(stats['images'], 2)
+        self.assertEqual(stats['unique_chunks'], first.new + second.new)
+        self.assertEqual(os.path.getsize(os.path.join(self.root, 'pack')),
+                         stats['stored_bytes'])
+
+    def test_restore_sparse(self):
+        """Test that a restored image matches and keeps its zeros as holes"""
+        out = os.path.join(self.root, 'out.img')
+        with BlockStore(self.root) as store:
+            store.put('v1', self.images[1])
+            store.restore('v1', out)
+        with open(self.images[1], 'rb') as a, open(out, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        st = os.stat(out)
+        self.assertLess(st.st_blocks * 512, st.st_size // 2)
+
+    def test_read_in_place(self):
+        """Test that a stored image reads like the image itself"""
+        with BlockStore(self.root) as store:
+            for path in self.images:
+                store.put(os.path.basename(path), path)
+            for path in self.images:
+                with Ext2Image(path) as img:
+                    expected = contents(img)
+                with StoreImage(store, os.path.basename(path)) as img:
+                    self.assertEqual(contents(img), expected)
+                    self.assertEqual(img.read(img.manifest.size - 4, 100),
+                                     b'\0' * 4)
+            with self.assertRaises(KeyError):
+                StoreImage(store, 'missing')
+
+    def test_reopen(self):
+        """Test that the index persists and a torn append is dropped"""
+        with BlockStore(self.root) as store:
+            store.put('v0', self.images[0])
+            unique = len(store.ids)
+        with open(os.path.join(self.root, 'index'), 'ab') as f:
+            f.write(b'x' * 30)
+        with BlockStore(self.root, chunk_size=4096) as store:
+            self.assertEqual(store.chunk_size, 1024)
+            self.assertEqual(len(store.ids), unique)
+            self.assertEqual(store.put('again', self.images[0]).new, 0)
+            self.assertEqual(store.names(), ['again', 'v0'])
+        self.assertEqual(os.path.getsize(os.path.join(self.root, 'index')),
+                         unique * 20)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
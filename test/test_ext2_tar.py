@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from ext2_server import open_image
+from ext2_tar import export
+
+
+class TestExt2Tar(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Export the base image to an in-memory archive"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+        result = subprocess.run(['./ext2-create'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to create filesystem")
+
+        cls.buf = io.BytesIO()
+        with open_image('cs111-base.img') as img:
+            cls.count = export(img, cls.buf)
+        cls.buf.seek(0)
+        cls.tar = tarfile.open(fileobj=cls.buf, mode='r')
+        cls.members = {m.name: m for m in cls.tar.getmembers()}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tar.close()
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def test_members(self):
+        """Test that every inode in the tree is archived"""
+        self.assertEqual(self.count, 4)
+        self.assertEqual(sorted(self.members),
+                         ['.', './hello', './hello-world', './lost+found'])
+
+    def test_regular_file(self):
+        """Test the hello-world file's data and metadata"""
+        member = self.members['./hello-world']
+        self.assertTrue(member.isreg())
+        self.assertEqual(member.mode, 0o644)
+        self.assertEqual((member.uid, member.gid), (1000, 1000))
+        self.assertGreater(member.mtime, 0)
+        self.assertIn('atime', member.pax_headers)
+        self.assertEqual(self.tar.extractfile(member).read(), b'Hello world\n')
+
+    def test_inline_symlink(self):
+        """Test that the fast symlink target comes from i_block"""
+        member = self.members['./hello']
+        self.assertTrue(member.issym())
+        self.assertEqual(member.linkname, 'hello-world')
+
+    def test_directories(self):
+        """Test directory entries"""
+        for name in ('.', './lost+found'):
+            self.assertTrue(self.members[name].isdir())
+            self.assertEqual(self.members[name].mode, 0o755)
+            self.assertEqual(self.members[name].uid, 0)
+
+
+class TestExt2TarLargeFiles(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Copy files that need indirect blocks and holes into an image"""
+        for tool in ('mke2fs', 'debugfs'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'files.img')
+        subprocess.run(['mke2fs', '-q', '-t', 'ext2', '-b', '1024', cls.path,
+                        '8M'], check=True, capture_output=True)
+
+        cls.big = os.urandom(300 * 1024 + 17)
+        big_path = os.path.join(cls.tmpdir, 'big')
+        with open(big_path, 'wb') as f:
+            f.write(cls.big)
+        sparse_path = os.path.join(cls.tmpdir, 'sparse')
+        with open(sparse_path, 'wb') as f:
+            f.seek(2 * 1024 * 1024)
+            f.write(b'tail')
+        commands = [f'write {big_path} big', f'write {sparse_path} sparse',
+                    'symlink long /' + 'a' * 100]
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.path],
+                       input='\n'.join(commands), text=True,
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_round_trip(self):
+        """Test that file data and long symlinks survive the export"""
+        out_path = os.path.join(self.tmpdir, 'out.tar')
+        result = subprocess.run(
+            ['python3', os.path.join(os.path.dirname(__file__), 'ext2_tar.py'),
+             '-o', out_path, self.path], capture_output=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with tarfile.open(out_path) as tar:
+            self.assertEqual(tar.extractfile('./big').read(), self.big)
+            sparse = tar.extractfile('./sparse').read()
+            self.assertEqual(len(sparse), 2 * 1024 * 1024 + 4)
+            self.assertEqual(sparse[-4:], b'tail')
+            self.assertEqual(sparse.count(0), 2 * 1024 * 1024)
+            self.assertEqual(tar.getmember('./long').linkname, '/' + 'a' * 100)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from ext2_image import EXT2_ROOT_INO, Ext2Image, StripedCache
+
+
+def describe(img, path):
+    """Resolve path and summarize what a query would return for it"""
+    ino = img.resolve(path)
+    inode = img.inode(ino)
+    with img.open_file(inode) as f:
+        data = f.read()
+    return ino, inode.mode, inode.size, data, list(img.iter_extents(inode))
+
+
+class TestStripedCache(unittest.TestCase):
+
+    def test_evicts_least_recent(self):
+        """Test that each stripe keeps its most recently used keys"""
+        loads = []
+        cache = StripedCache(2, stripes=1)
+        for key in (1, 2, 1, 3, 1, 2):
+            cache.get(key, lambda k: loads.append(k) or k * 10)
+        self.assertEqual(loads, [1, 2, 3, 2])
+        self.assertEqual(cache.get(1, None), 10)
+
+
+class TestConcurrentReads(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Make an image with a few hundred small files"""
+        for tool in ('mke2fs', 'debugfs'):
+            if shutil.which(tool) is None:
+                raise unittest.SkipTest(f"{tool} not available")
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.path = os.path.join(cls.tmpdir, 'threads.img')
+        subprocess.run(['mke2fs', '-q', '-t', 'ext2', '-b', '1024', '-N',
+                        '1024', '-O', '^resize_inode', cls.path, '4M'],
+                       check=True, capture_output=True)
+        commands = []
+        cls.paths = []
+        for d in range(8):
+            commands.append(f'mkdir d{d}')
+            for f in range(40):
+                source = os.path.join(cls.tmpdir, f'src-{d}-{f}')
+                with open(source, 'wb') as out:
+                    out.write(bytes([d, f]) * (f * 40 + 1))
+                commands.append(f'write {source} d{d}/f{f}')
+                cls.paths.append(f'/d{d}/f{f}')
+        subprocess.run(['debugfs', '-w', '-f', '-', cls.path],
+                       input='\n'.join(commands), text=True,
+                       check=True, capture_output=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_threads_match_serial(self):
+        """Test that many threads on one handle see what one thread sees"""
+        with Ext2Image(self.path) as img:
+            serial = [describe(img, p) for p in self.paths]
+        self.assertEqual(serial[41][3], bytes([1, 1]) * 41)
+
+        # Small caches force evictions while other threads are reading
+        with Ext2Image(self.path, cache_blocks=32, cache_inodes=32) as img:
+            with ThreadPoolExecutor(8) as pool:
+                for _ in range(3):
+                    results = list(pool.map(lambda p: describe(img, p),
+                                            self.paths))
+                    self.assertEqual(results, serial)
+
+    def test_concurrent_checks(self):
+        """Test bitmap checks and walks running alongside lookups"""
+        with Ext2Image(self.path, cache_blocks=16) as img:
+            groups = range(img.group_count)
+            expected_counts = [img.bitmap_free_counts(g) for g in groups]
+            expected_walk = sorted(p for p, _ in img.walk(EXT2_ROOT_INO))
+            img.block_cache.clear()
+            img.inode_cache.clear()
+
+            with ThreadPoolExecutor(8) as pool:
+                walks = [pool.submit(lambda: sorted(
+                    p for p, _ in img.walk(EXT2_ROOT_INO))) for _ in range(4)]
+                counts = [pool.submit(img.bitmap_free_counts, g)
+                          for g in groups for _ in range(4)]
+                lookups = list(pool.map(img.resolve, self.paths))
+            self.assertEqual([w.result() for w in walks], [expected_walk] * 4)
+            self.assertEqual([c.result() for c in counts],
+                             [c for c in expected_counts for _ in range(4)])
+            self.assertEqual(len(set(lookups)), len(self.paths))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_fuzz import check_groups, check_tree
+from ext2_image import Ext2Error, Ext2Image
+import ext2_watch
+from ext2_watch import Watcher
+
+
+def full_check(path):
+    """What checking the image from scratch reports"""
+    with open(path, 'rb') as f:
+        buffer = f.read()
+    problems = check_groups(buffer)
+    try:
+        problems.extend(check_tree(buffer))
+    except Ext2Error as e:
+        problems.append(f"tree: {e}")
+    return problems
+
+
+class TestExt2Watch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        """Build a multi-group image and keep a pristine copy"""
+        subprocess.run(['make', 'clean'], capture_output=True)
+        result = subprocess.run(['make'], capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to compile")
+
+        result = subprocess.run(['./ext2-create', '-g', '8'],
+                                capture_output=True)
+        if result.returncode != 0:
+            raise Exception("Failed to create filesystem")
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.pristine = os.path.join(cls.tmpdir, 'pristine.img')
+        shutil.copy('cs111-base.img', cls.pristine)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+        subprocess.run(['make', 'clean'], capture_output=True)
+
+    def setUp(self):
+        self.path = os.path.join(self.tmpdir, 'watched.img')
+        shutil.copy(self.pristine, self.path)
+        self.watcher = Watcher(self.path)
+        self.first = self.watcher.poll()
+
+    def patch(self, offset, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(offset)
+            f.write(data)
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    def test_first_check(self):
+        """Test that the first check computes everything and finds nothing"""
+        self.assertIsNone(self.first.changed)
+        self.assertEqual(self.first.problems, [])
+        self.assertGreater(self.first.rerun, 8)
+        self.assertIsNone(self.watcher.poll(), "Nothing changed")
+
+    def test_inode_change(self):
+        """Test that a changed inode reruns only what reads its slot"""
+        with Ext2Image(self.path) as img:
+            offset = img.inode_offset(5 * 128 + 2)
+        self.patch(offset + 26, (4).to_bytes(2, 'little'))
+        report = self.watcher.poll()
+        self.assertEqual(report.changed, [offset // 1024])
+        self.assertEqual(report.problems,
+                         ["inode 642: i_links_count is 4, counted 1"])
+        self.assertEqual(report.problems, full_check(self.path))
+        # The group scan, and the inodes in that table block with their
+        # block maps and listings
+        self.assertLess(report.rerun, 10)
+
+        self.patch(offset + 26, (1).to_bytes(2, 'little'))
+        self.assertEqual(self.watcher.poll().problems, [])
+
+    def test_bitmap_change(self):
+        """Test that a changed bitmap reruns only its group"""
+        with Ext2Image(self.path) as img:
+            bitmap = img.group_descriptors[3].inode_bitmap
+        self.patch(bitmap * 1024, b'\x07')
+        report = self.watcher.poll()
+        self.assertEqual(report.changed, [bitmap])
+        self.assertEqual(report.rerun, 1)
+        self.assertEqual(report.problems, full_check(self.path))
+        self.assertTrue(report.problems)
+
+    def test_directory_change(self):
+        """Test that a broken directory block is reported like a full check"""
+        with Ext2Image(self.path) as img:
+            block = img.inode(img.resolve('/group-2')).block[0]
+        self.patch(block * 1024 + 4, (3).to_bytes(2, 'little'))
+        report = self.watcher.poll()
+        self.assertEqual(report.changed, [block])
+        self.assertEqual(report.problems, full_check(self.path))
+        self.assertTrue(report.problems[-1].startswith('tree: '))
+
+    def test_superblock_change(self):
+        """Test that a changed superblock reruns everything"""
+        self.patch(1024 + 12, (5).to_bytes(4, 'little'))
+        report = self.watcher.poll()
+        self.assertEqual(report.rerun, self.first.rerun)
+        self.assertEqual(report.problems, full_check(self.path))
+
+    def test_large_blocks(self):
+        """Test that changes are reported in the image's own blocks, and
+        that only a digest per chunk and per 1K block is kept between
+        polls"""
+        subprocess.run(['./ext2-create', '-b', '4096', '-g', '2'],
+                       check=True)
+        shutil.copy('cs111-base.img', self.path)
+        first = self.watcher.poll()
+        self.assertIsNone(first.changed)
+        self.assertEqual(first.problems, [])
+        digests = self.watcher.digests
+        size = os.path.getsize(self.path)
+        self.assertEqual(len(digests.blocks),
+                         size // ext2_watch.BLOCK_SIZE * ext2_watch.DIGEST_SIZE)
+        self.assertEqual(len(digests.buffer), ext2_watch.CHUNK_SIZE)
+        with Ext2Image(self.path) as img:
+            bitmap = img.group_descriptors[1].inode_bitmap
+        self.patch(bitmap * 4096 + 3000, b'\x01')
+        report = self.watcher.poll()
+        self.assertEqual(report.changed, [bitmap])
+        self.assertEqual(report.problems, full_check(self.path))
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
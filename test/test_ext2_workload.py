@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import math
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from ext2_image import (EXT2_DIND_BLOCK, EXT2_S_IFDIR, EXT2_S_IFLNK,
+                        EXT2_S_IFMT, EXT2_TIND_BLOCK, Ext2Image)
+from ext2_build import Layout
+from ext2_image import EXT2_GOOD_OLD_FIRST_INO
+from ext2_workload import Workload, generate, load_spec, resolve_size
+
+SMALL = {
+    'size_mib': 8,
+    'fill_ratio': 0.5,
+    'depth': 3,
+    'fanout': [1, 4],
+    'file_sizes': [[60, 0, 'ind'], [30, 'ind', 'dind'],
+                   [10, 'dind', 'dind+65536']],
+    'symlink_ratio': 0.2,
+    'long_symlink_ratio': 0.5,
+}
+
+
+class TestWorkload(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def generate(self, name, **spec):
+        path = os.path.join(self.tmpdir, name)
+        return path, generate(load_spec(**{**SMALL, **spec}), path)
+
+    def test_reproducible(self):
+        """Test that a seed always gives the same image"""
+        _, first = self.generate('a.img', seed=11)
+        _, second = self.generate('b.img', seed=11)
+        _, other = self.generate('c.img', seed=12)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first['sha256'], other['sha256'])
+
+    def test_matches_summary(self):
+        """Test that the image holds the tree the summary describes"""
+        path, summary = self.generate('summary.img', seed=3)
+        counts = {'dirs': 0, 'files': 0, 'short': 0, 'long': 0,
+                  'double': 0}
+        depth = 0
+        with Ext2Image(path) as img:
+            for name, inode in img.walk():
+                kind = inode.mode & EXT2_S_IFMT
+                if kind == EXT2_S_IFDIR:
+                    if name != '/lost+found':
+                        counts['dirs'] += 1
+                        depth = max(depth, name.count('/') - (name == '/'))
+                elif kind == EXT2_S_IFLNK:
+                    counts['short' if img.is_fast_symlink(inode)
+                           else 'long'] += 1
+                else:
+                    counts['files'] += 1
+                    counts['double'] += bool(inode.block[EXT2_DIND_BLOCK])
+        self.assertEqual(counts['dirs'], summary['dirs'])
+        self.assertEqual(depth, summary['max_depth'])
+        self.assertEqual(counts['files'], summary['files'])
+        self.assertEqual(counts['double'],
+                         summary['files_by_indirection'].get('double', 0))
+        self.assertEqual((counts['short'], counts['long']),
+                         (summary['symlinks']['short'],
+                          summary['symlinks']['long']))
+        self.assertGreater(counts['short'], 0)
+        self.assertGreater(counts['long'], 0)
+        # Files fill close to half of the 8192 blocks
+        self.assertGreater(summary['data_blocks'], 0.45 * 8192)
+        self.assertLessEqual(summary['data_blocks'], 0.5 * 8192)
+
+    def test_size_histogram(self):
+        """Test that the files drawn follow the size distribution, without
+        a run of empty files once the image is full"""
+        counts = None
+        empty = total = 0
+        for seed in range(8):
+            workload = Workload(load_spec(seed=seed))
+            if counts is None:
+                counts = [0] * len(workload.buckets)
+            for _, size, _, _ in workload.files:
+                bucket = next(i for i, (_, low, high)
+                              in enumerate(workload.buckets)
+                              if low <= size <= high)
+                counts[bucket] += 1
+                empty += size == 0
+            total += len(workload.files)
+        weights = [weight for weight, _, _ in workload.buckets]
+        for count, weight in zip(counts, weights):
+            self.assertAlmostEqual(count / total, weight / sum(weights),
+                                   delta=0.05)
+        # A log-uniform draw from [0, high] is 0 with chance
+        # log 2 / log(high + 1)
+        _, _, high = workload.buckets[0]
+        expected = weights[0] / sum(weights) * math.log(2) / math.log(high + 1)
+        self.assertLess(empty / total, 2 * expected)
+
+    def test_bad_sizes(self):
+        """Test that buckets that are malformed or draw only empty files
+        are refused"""
+        for sizes in ([], [[1, 0, 0]], [[0, 1, 2]], [[1, 5]], [[1, 10, 5]],
+                      [[1, 0, 'quad']], [[-1, 0, 10], [1, 0, 0]]):
+            with self.subTest(sizes=sizes), self.assertRaises(ValueError):
+                load_spec(file_sizes=sizes)
+
+    def test_inode_cap(self):
+        """Test that small files stop at the inodes the image can hold"""
+        spec = load_spec(file_sizes=[[1, 1, 100]], fill_ratio=1.0,
+                         size_mib=16)
+        workload = Workload(spec)
+        inodes = EXT2_GOOD_OLD_FIRST_INO + 1 + len(workload.dirs) + \
+            len(workload.files) + len(workload.symlinks)
+        self.assertGreater(len(workload.symlinks), 0)
+        # Enough inodes for every entry, and no more than two groups
+        layout = Layout(1024, 0, inodes, size_blocks=16 * 1024)
+        self.assertEqual(layout.groups, 2)
+        with self.assertRaises(ValueError):
+            Layout(1024, 0, inodes + 2, size_blocks=16 * 1024)
+
+    def test_triple_indirect(self):
+        """Test that the largest bucket reaches the triple indirect block"""
+        path, summary = self.generate(
+            'triple.img', seed=5, sparse_ratio=1,
+            file_sizes=[[1, 'tind', 'tind+4096']])
+        self.assertGreater(summary['files_by_indirection']['triple'], 0)
+        with Ext2Image(path) as img:
+            triple = [name for name, inode in img.walk()
+                      if inode.block[EXT2_TIND_BLOCK]
+                      and not img.is_fast_symlink(inode)]
+        self.assertEqual(len(triple),
+                         summary['files_by_indirection']['triple'])
+
+    def test_fsck_clean(self):
+        """Test that fsck finds nothing to fix, for each block size"""
+        if shutil.which('e2fsck') is None:
+            self.skipTest("e2fsck not available")
+        for block_size in (1024, 4096):
+            path, _ = self.generate(f'fsck-{block_size}.img', seed=7,
+                                    block_size=block_size)
+            result = subprocess.run(['e2fsck', '-f', '-n', path],
+                                    capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stdout)
+
+    def test_size_names(self):
+        """Test the indirection names a size bucket may use"""
+        self.assertEqual(resolve_size('ind', 1024), 12 * 1024)
+        self.assertEqual(resolve_size('dind+1', 1024), (12 + 256) * 1024 + 1)
+        self.assertEqual(resolve_size('tind', 4096),
+                         (12 + 1024 + 1024 ** 2) * 4096)
+        with self.assertRaises(ValueError):
+            resolve_size('quad', 1024)
+        with self.assertRaises(ValueError):
+            load_spec(depht=3)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)